@@ -0,0 +1,121 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark measuring the end-to-end latency of fanning out the messages
+published in one process to the worker processes over the Unix domain socket
+backend of the broker. The messages are published one at a time (the latency
+is the time it takes the message to reach the last worker) and in bursts,
+which are sent in batches (the throughput is the number of messages per
+second each worker receives).
+"""
+
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from shirow.broker import Broker, UnixSocketBackend
+
+BURST_LENGTH = 10000
+
+MESSAGES_NUMBER = 1000
+
+WORKERS_NUMBERS = (1, 4, 16)
+
+
+async def serve_worker(path, queue):
+    """Receives the messages and reports when they were received. """
+
+    broker = Broker(UnixSocketBackend(path))
+    received_at = []
+    done = asyncio.Event()
+
+    def receive(message):
+        received_at.append(time.monotonic())
+        if message == 'done':
+            done.set()
+
+    broker.subscribe('bench', receive)
+    await broker.start()
+    queue.put(None)  # ready
+    await done.wait()
+    await broker.stop()
+    queue.put(received_at[:-1])
+
+
+def run_worker(path, queue):
+    """The entry point of the worker processes. """
+
+    asyncio.run(serve_worker(path, queue))
+
+
+async def run(context, path, workers_number):
+    """Publishes the messages to the specified number of workers and returns
+    the p50 and p99 latencies (in milliseconds) and the throughput.
+    """
+
+    loop = asyncio.get_running_loop()
+    # The publisher starts first, so it's the leader relaying the messages to
+    # the workers.
+    broker = Broker(UnixSocketBackend(path))
+    await broker.start()
+    queue = context.Queue()
+    workers = [context.Process(target=run_worker, args=(path, queue))
+               for _ in range(workers_number)]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        await loop.run_in_executor(None, queue.get)
+    await asyncio.sleep(0.2)  # let the leader accept all the connections
+
+    sent_at = []
+    for i in range(MESSAGES_NUMBER):
+        sent_at.append(time.monotonic())
+        broker.publish('bench', i)
+        await asyncio.sleep(0.001)
+
+    burst_sent_at = time.monotonic()
+    for i in range(BURST_LENGTH):
+        broker.publish('bench', i)
+    broker.publish('bench', 'done')
+
+    reports = [await loop.run_in_executor(None, queue.get) for _ in workers]
+    for worker in workers:
+        worker.join()
+    await broker.stop()
+
+    latencies = [max(report[i] for report in reports) - sent_at[i]
+                 for i in range(MESSAGES_NUMBER)]
+    quantiles = statistics.quantiles(latencies, n=100)
+    burst_duration = max(report[-1] for report in reports) - burst_sent_at
+    return quantiles[49] * 1e3, quantiles[98] * 1e3, BURST_LENGTH / burst_duration
+
+
+def main():
+    """The main entry point. """
+
+    # The workers are spawned, so they don't inherit the event loop.
+    context = multiprocessing.get_context('spawn')
+    print(f'{"workers":>7} {"p50, ms":>8} {"p99, ms":>8} {"burst, msg/s":>13}')
+    for workers_number in WORKERS_NUMBERS:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'broker.sock')
+            p50, p99, throughput = asyncio.run(run(context, path, workers_number))
+            print(f'{workers_number:>7} {p50:>8.3f} {p99:>8.3f} {throughput:>13.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark measuring the throughput of the available codecs on small, medium
+and large payloads. The size column shows the bandwidth each codec needs. It
+also compares responding with the results received from another service as
+JSON by decoding them with responding with them wrapped into RawJSON.
+"""
+
+import time
+
+from shirow.codec import CODECS, MsgPackCodec, RawJSON
+from shirow.request import Request
+
+DURATION = 0.5  # seconds per measurement
+
+
+def make_payloads():
+    """Returns the payloads resembling the messages Shirow services exchange. """
+
+    record = {
+        'id': 12345,
+        'name': 'raspberrypi-buster-armhf',
+        'status': 'succeeded',
+        'started_at': '2026-10-17T10:20:30Z',
+        'duration': 1234.5,
+        'tags': ['armhf', 'buster', 'lite'],
+    }
+    return {
+        'small': {
+            'function_name': 'get_build_status',
+            'parameters_list': [12345],
+            'marker': 42,
+        },
+        'medium': {
+            'eod': 1,
+            'marker': 42,
+            'result': [dict(record, id=i) for i in range(100)],
+        },
+        'large': {
+            'eod': 0,
+            'marker': 42,
+            'result': {
+                'log': 'Unpacking linux-image-armmp (4.19.0-16) ...\r\n' * 2000,
+                'records': [dict(record, id=i) for i in range(2000)],
+            },
+        },
+    }
+
+
+def measure(func, arg):
+    """Returns the number of calls per second of the specified function. """
+
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(10):
+            func(arg)
+        calls += 10
+        elapsed = time.perf_counter() - start
+        if elapsed >= DURATION:
+            return calls / elapsed
+
+
+def main():
+    """The main entry point. """
+
+    payloads = make_payloads()
+    print(f'{"codec":>8} {"payload":>8} {"size, B":>9} {"encode, op/s":>14} '
+          f'{"decode, op/s":>14} {"encode, MB/s":>13}')
+    for codec_class in (*CODECS.values(), MsgPackCodec):
+        name = codec_class.name
+        try:
+            codec = codec_class()
+        except ImportError:
+            print(f'{name:>8} is not installed, skipping')
+            continue
+
+        for payload_name, payload in payloads.items():
+            encoded = codec.encode(payload)
+            encode_rate = measure(codec.encode, payload)
+            decode_rate = measure(codec.decode, encoded)
+            print(f'{name:>8} {payload_name:>8} {len(encoded):>9} {encode_rate:>14.0f} '
+                  f'{decode_rate:>14.0f} {encode_rate * len(encoded) / 1e6:>13.1f}')
+
+    print()
+    print(f'{"codec":>8} {"payload":>8} {"decoded, op/s":>14} {"RawJSON, op/s":>14}')
+    for codec_class in CODECS.values():
+        try:
+            codec = codec_class()
+        except ImportError:
+            continue
+
+        request = Request(42, None, codec)
+        respond = request._get_successful_response  # pylint: disable=protected-access
+        for payload_name in ('medium', 'large'):
+            upstream = codec.encode(payloads[payload_name]['result'])
+            decoded_rate = measure(lambda data: respond(codec.decode(data)), upstream)  # pylint: disable=cell-var-from-loop
+            raw_rate = measure(lambda data: respond(RawJSON(data)), upstream)  # pylint: disable=cell-var-from-loop
+            print(f'{codec.name:>8} {payload_name:>8} {decoded_rate:>14.0f} {raw_rate:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark comparing the dir()/getattr based lookup of remote
+procedures with the lookup in the per-class registry.
+"""
+
+import timeit
+
+from shirow.exceptions import UndefinedMethod
+from shirow.server import RPCServer, remote
+
+ATTRIBUTES_NUMBERS = (10, 100, 1000)
+
+NUMBER = 10000
+
+
+def legacy_get_method(handler, method_name):
+    """Looks up a remote procedure the way RPCServer did it before the registry
+    was introduced.
+    """
+
+    method = getattr(handler, method_name, None)
+    if method_name in dir(handler) and hasattr(method, 'remote'):
+        return method
+
+    raise UndefinedMethod
+
+
+def make_handler(attributes_number):
+    """Creates an instance of an RPC server class which has the specified
+    number of attributes (a tenth of them are remote procedures).
+    """
+
+    async def procedure(_self, _request):
+        pass
+
+    namespace = {}
+    for i in range(attributes_number):
+        if i % 10 == 0:
+            namespace[f'procedure_{i}'] = remote(procedure)
+        else:
+            namespace[f'attribute_{i}'] = i
+
+    cls = type(f'Server{attributes_number}', (RPCServer, ), namespace)
+    # Bypass WebSocketHandler.__init__ since only the lookup is measured.
+    return cls.__new__(cls)
+
+
+def main():
+    """The main entry point. """
+
+    print(f'{"attributes":>10} {"legacy, us":>12} {"registry, us":>14} {"speedup":>8}')
+    for attributes_number in ATTRIBUTES_NUMBERS:
+        handler = make_handler(attributes_number)
+        method_name = f'procedure_{attributes_number - 10}'
+
+        legacy = timeit.timeit(lambda: legacy_get_method(handler, method_name),  # pylint: disable=cell-var-from-loop
+                               number=NUMBER)
+        registry = timeit.timeit(lambda: handler.remote_procedures[method_name],  # pylint: disable=cell-var-from-loop
+                                 number=NUMBER)
+
+        print(f'{attributes_number:>10} {legacy / NUMBER * 1e6:>12.3f} '
+              f'{registry / NUMBER * 1e6:>14.3f} {legacy / registry:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark comparing the event loop implementations the RPC server can run
+on. It measures the throughput and the latency of echo calls as well as the
+throughput of a streaming procedure. uvloop is measured only if it's
+installed.
+"""
+
+import asyncio
+import multiprocessing
+import statistics
+import time
+
+from tornado.escape import json_decode, json_encode
+from tornado.options import options
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from shirow.ioloop import EVENT_LOOPS, IOLoop, uvloop
+from shirow.server import MOCK_TOKEN, RPCServer, TOKEN_PATTERN, remote
+
+CONNECTIONS = 10
+
+DURATION = 5  # seconds
+
+PORT = 18890
+
+STREAM_LENGTH = 10000
+
+
+class BenchmarkRPCServer(RPCServer):  # pylint: disable=abstract-method
+    """An RPC server with an echo and a streaming remote procedures. """
+
+    @remote
+    async def echo(self, _request, message):
+        """Returns the specified message. """
+
+        return message
+
+    @remote
+    async def produce(self, request, length):
+        """Sends the specified number of messages, the last of which
+        terminates the stream.
+        """
+
+        for i in range(length - 1):
+            await request.send(i)
+
+        return length - 1
+
+
+def serve(event_loop):
+    """Runs the RPC server on the specified event loop implementation. """
+
+    options.allow_mock_token = True
+    options.event_loop = event_loop
+    options.token_key = 'secret'
+
+    app = Application([('/rpc/token/' + TOKEN_PATTERN, BenchmarkRPCServer)])
+    IOLoop().start(app, PORT)
+
+
+def encode_call(function_name, parameters_list, marker):
+    """Encodes the call of the specified remote procedure. """
+
+    return json_encode({
+        'function_name': function_name,
+        'parameters_list': parameters_list,
+        'marker': marker,
+    })
+
+
+async def connect():
+    """Connects to the RPC server, waiting for it to start listening. """
+
+    for _ in range(100):
+        try:
+            return await websocket_connect(f'ws://127.0.0.1:{PORT}/rpc/token/{MOCK_TOKEN}')
+        except OSError:
+            await asyncio.sleep(0.1)
+
+    raise RuntimeError('the RPC server did not start')
+
+
+async def measure_echo(connections):
+    """Makes echo calls over the specified connections for DURATION seconds and
+    returns their latencies.
+    """
+
+    latencies = []
+    stop_at = time.time() + DURATION
+
+    async def call(ws_conn):
+        marker = 0
+        while time.time() < stop_at:
+            marker += 1
+            start = time.perf_counter()
+            ws_conn.write_message(encode_call('echo', ['ping'], marker))
+            json_decode(await ws_conn.read_message())
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(call(ws_conn) for ws_conn in connections))
+    return latencies
+
+
+async def measure_stream(connections):
+    """Makes each of the specified connections receive STREAM_LENGTH messages
+    and returns the number of messages received per second.
+    """
+
+    async def call(ws_conn):
+        ws_conn.write_message(encode_call('produce', [STREAM_LENGTH], 1))
+        while not json_decode(await ws_conn.read_message())['eod']:
+            pass
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call(ws_conn) for ws_conn in connections))
+    return len(connections) * STREAM_LENGTH / (time.perf_counter() - start)
+
+
+async def run():
+    """Runs the measurements against the RPC server. """
+
+    connections = [await connect() for _ in range(CONNECTIONS)]
+    latencies = await measure_echo(connections)
+    stream = await measure_stream(connections)
+    for ws_conn in connections:
+        ws_conn.close()
+
+    return latencies, stream
+
+
+def main():
+    """The main entry point. """
+
+    event_loops = [name for name in EVENT_LOOPS if name != 'uvloop' or uvloop is not None]
+    print(f'{"loop":>8} {"echo, msg/s":>12} {"p50, ms":>8} {"p99, ms":>8} '
+          f'{"stream, msg/s":>14}')
+    for event_loop in event_loops:
+        server = multiprocessing.Process(target=serve, args=(event_loop, ))
+        server.start()
+        try:
+            latencies, stream = asyncio.run(run())
+        finally:
+            server.terminate()
+            server.join()
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f'{event_loop:>8} {len(latencies) / DURATION:>12.0f} '
+              f'{quantiles[49] * 1000:>8.2f} {quantiles[98] * 1000:>8.2f} {stream:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark measuring the WebSocket handshake throughput of an RPC server with
+the cache of verified tokens cold and warm. RS256 is measured only if the
+cryptography package is installed.
+"""
+
+import asyncio
+import time
+
+import jwt
+from tornado.options import options
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from shirow.server import RPCServer, TOKEN_PATTERN
+from shirow.tokens import TOKEN_CACHE
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:
+    rsa = None
+
+CONCURRENCY = 10
+
+HANDSHAKES = 500
+
+PORT = 18888
+
+
+class BenchmarkRPCServer(RPCServer):  # pylint: disable=abstract-method
+    """An RPC server without remote procedures. """
+
+
+def make_keys(algorithm):
+    """Returns the keys for signing and verifying tokens. """
+
+    if algorithm == 'HS256':
+        return 'secret', 'secret'
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    signing_key = private_key.private_bytes(serialization.Encoding.PEM,
+                                            serialization.PrivateFormat.PKCS8,
+                                            serialization.NoEncryption())
+    verifying_key = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf8')
+    return signing_key, verifying_key
+
+
+async def run_handshakes(tokens):
+    """Performs a handshake for each of the specified tokens and returns the
+    number of handshakes per second.
+    """
+
+    queue = list(tokens)
+
+    async def connect():
+        while queue:
+            token = queue.pop()
+            ws_conn = await websocket_connect(f'ws://127.0.0.1:{PORT}/rpc/token/{token}')
+            ws_conn.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect() for _ in range(CONCURRENCY)))
+    return len(tokens) / (time.perf_counter() - start)
+
+
+async def main():
+    """The main entry point. """
+
+    app = Application([('/rpc/token/' + TOKEN_PATTERN, BenchmarkRPCServer)])
+    server = app.listen(PORT, address='127.0.0.1')
+
+    algorithms = ['HS256'] + (['RS256'] if rsa is not None else [])
+    print(f'{"algorithm":>9} {"cold, hs/s":>11} {"warm, hs/s":>11}')
+    for algorithm in algorithms:
+        signing_key, verifying_key = make_keys(algorithm)
+        options.token_algorithm = algorithm
+        options.token_key = verifying_key
+
+        # A few hundred users reconnecting with the same tokens.
+        tokens = [jwt.encode({'user_id': i}, signing_key, algorithm=algorithm).decode('utf8')
+                  for i in range(1, HANDSHAKES // 2 + 1)] * 2
+
+        TOKEN_CACHE.clear()
+        options.token_cache_size = 0
+        cold = await run_handshakes(tokens)
+
+        options.token_cache_size = HANDSHAKES
+        await run_handshakes(tokens)  # warm the cache up
+        warm = await run_handshakes(tokens)
+
+        print(f'{algorithm:>9} {cold:>11.0f} {warm:>11.0f}')
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
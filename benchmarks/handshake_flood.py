@@ -0,0 +1,158 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark measuring the latency of calls made over the established
+connections while new connections flood the RPC server. The tokens are signed
+with RS256, so the benchmark requires the cryptography package.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import statistics
+import time
+
+import jwt
+from tornado.escape import json_decode, json_encode
+from tornado.ioloop import IOLoop
+from tornado.options import options
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from handshake import make_keys
+from shirow.executors import shutdown_executors
+from shirow.server import RPCServer, TOKEN_PATTERN, remote
+
+CONNECTIONS = 10
+
+DURATION = 5  # seconds
+
+FLOOD_CONCURRENCY = 50
+
+MODES = ('none', 'thread', 'process')
+
+PORT = 18889
+
+
+class BenchmarkRPCServer(RPCServer):  # pylint: disable=abstract-method
+    """An RPC server with a single remote procedure. """
+
+    @remote
+    async def echo(self, _request, message):
+        """Returns the specified message. """
+
+        return message
+
+
+def serve(mode, verifying_key):
+    """Runs the RPC server verifying tokens in the specified mode until
+    SIGINT. The executor is shut down on exit, so its workers don't outlive the
+    server.
+    """
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    options.token_algorithm = 'RS256'
+    options.token_cache_size = 0  # every handshake verifies its token
+    options.token_key = verifying_key
+    options.token_verification_executor = mode
+
+    app = Application([('/rpc/token/' + TOKEN_PATTERN, BenchmarkRPCServer)])
+    app.listen(PORT, address='127.0.0.1')
+    try:
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_executors()
+
+
+def flood(tokens, stop_at):
+    """Keeps establishing new connections until the specified time. """
+
+    async def connect():
+        while time.time() < stop_at:
+            for token in tokens:
+                try:
+                    ws_conn = await websocket_connect(f'ws://127.0.0.1:{PORT}/rpc/token/{token}')
+                    ws_conn.close()
+                except Exception:  # pylint: disable=broad-except
+                    pass  # rejected handshakes are expected
+
+    async def run():
+        await asyncio.gather(*(connect() for _ in range(FLOOD_CONCURRENCY)))
+
+    asyncio.run(run())
+
+
+async def measure_latencies(token, stop_at):
+    """Makes calls over the established connections until the specified time
+    and returns their latencies.
+    """
+
+    latencies = []
+
+    async def call(ws_conn):
+        marker = 0
+        while time.time() < stop_at:
+            marker += 1
+            start = time.perf_counter()
+            ws_conn.write_message(json_encode({
+                'function_name': 'echo',
+                'parameters_list': ['ping'],
+                'marker': marker,
+            }))
+            json_decode(await ws_conn.read_message())
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.01)
+
+    connections = [await websocket_connect(f'ws://127.0.0.1:{PORT}/rpc/token/{token}')
+                   for _ in range(CONNECTIONS)]
+    await asyncio.gather(*(call(ws_conn) for ws_conn in connections))
+    for ws_conn in connections:
+        ws_conn.close()
+
+    return latencies
+
+
+def main():
+    """The main entry point. """
+
+    signing_key, verifying_key = make_keys('RS256')
+    tokens = [jwt.encode({'user_id': i}, signing_key, algorithm='RS256').decode('utf8')
+              for i in range(1, 101)]
+
+    print(f'{"executor":>8} {"calls":>6} {"p50, ms":>8} {"p99, ms":>8} {"max, ms":>8}')
+    for mode in MODES:
+        server = multiprocessing.Process(target=serve, args=(mode, verifying_key))
+        server.start()
+        try:
+            time.sleep(1)  # let the server start listening
+
+            stop_at = time.time() + DURATION
+            flooder = multiprocessing.Process(target=flood, args=(tokens, stop_at))
+            flooder.start()
+            latencies = asyncio.run(measure_latencies(tokens[0], stop_at))
+            flooder.join()
+        finally:
+            os.kill(server.pid, signal.SIGINT)
+            server.join()
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f'{mode:>8} {len(latencies):>6} {quantiles[49] * 1000:>8.2f} '
+              f'{quantiles[98] * 1000:>8.2f} {max(latencies) * 1000:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
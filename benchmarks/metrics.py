@@ -0,0 +1,70 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark measuring the overhead of the metrics RPCServer collects.
+It measures the cost of the individual updates, the cost of all the updates
+made per call and the time it takes to format the metrics for Prometheus.
+"""
+
+import time
+import timeit
+
+from shirow.metrics import Registry, format_text
+
+NUMBER = 100000
+
+PROCEDURES_NUMBERS = (10, 100, 1000)
+
+
+def main():
+    """The main entry point. """
+
+    registry = Registry()
+    frames = registry.counter('frames_total', 'Frames')
+    calls = registry.counter('calls_total', 'Calls', ['procedure'])
+    duration = registry.histogram('call_duration_seconds', 'Duration', ['procedure'])
+    labels = ('echo', )
+
+    def update_per_call():
+        # A call costs a frame in and out, the call counter and the latency.
+        frames.inc()
+        frames.inc()
+        calls.inc(labels=labels)
+        start = time.monotonic()
+        duration.observe(time.monotonic() - start, labels=labels)
+
+    print(f'{"operation":>28} {"ns":>8}')
+    for name, func in (('counter', frames.inc),
+                       ('labelled counter', lambda: calls.inc(labels=labels)),
+                       ('histogram', lambda: duration.observe(0.003, labels=labels)),
+                       ('all the updates per call', update_per_call)):
+        elapsed = timeit.timeit(func, number=NUMBER)
+        print(f'{name:>28} {elapsed / NUMBER * 1e9:>8.0f}')
+
+    print()
+    print(f'{"procedures":>10} {"formatting, ms":>16}')
+    for procedures_number in PROCEDURES_NUMBERS:
+        registry = Registry()
+        calls = registry.counter('calls_total', 'Calls', ['procedure'])
+        duration = registry.histogram('call_duration_seconds', 'Duration', ['procedure'])
+        for i in range(procedures_number):
+            calls.inc(labels=(f'procedure_{i}', ))
+            duration.observe(0.003, labels=(f'procedure_{i}', ))
+
+        elapsed = timeit.timeit(lambda: format_text(registry), number=10)  # pylint: disable=cell-var-from-loop
+        print(f'{procedures_number:>10} {elapsed / 10 * 1e3:>16.3f}')
+
+
+if __name__ == '__main__':
+    main()
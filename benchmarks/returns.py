@@ -0,0 +1,132 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark comparing the ways remote procedures return their values:
+the return statement, Request.ret and, for streams, ret_and_continue and
+async generators. Each style is measured with the way RPCServer invoked the
+procedures before returning values stopped raising exceptions (legacy) and
+with the current one.
+"""
+
+import asyncio
+import logging
+import time
+
+from shirow.codec import get_codec
+from shirow.request import Request, Ret
+from shirow.server import RPCServer, remote
+
+NUMBER = 100000
+
+STREAM_LENGTH = 10
+
+
+class BenchmarkRPCServer(RPCServer):  # pylint: disable=abstract-method
+    """An RPC server returning values in different ways. """
+
+    @remote
+    async def return_value(self, _request):
+        """Returns a value using the return statement. """
+
+        return 'spam'
+
+    @remote
+    async def ret_value(self, request):
+        """Returns a value using ret. """
+
+        request.ret('spam')
+
+    @remote
+    async def continue_stream(self, request):
+        """Streams the values using ret_and_continue. """
+
+        for i in range(STREAM_LENGTH - 1):
+            request.ret_and_continue(i)
+
+        return STREAM_LENGTH - 1
+
+    @remote
+    async def yield_stream(self, _request):
+        """Streams the values using an async generator. """
+
+        for i in range(STREAM_LENGTH):
+            yield i
+
+
+async def legacy_invoke_procedure(handler, procedure, request):
+    """Invokes the remote procedure the way RPCServer did it before returning
+    values stopped raising exceptions.
+    """
+
+    try:
+        try:
+            result = await procedure.function(handler, request)
+            if result is not None:
+                request.ret(result)
+        except Ret:
+            pass
+    except Ret:  # raised by ret_error in the past
+        pass
+
+
+async def invoke_procedure(handler, procedure, request):
+    """Invokes the remote procedure the way RPCServer does it now. """
+
+    try:
+        await handler._invoke_procedure(procedure, request, [])  # pylint: disable=protected-access
+    except Ret:
+        pass
+
+
+async def measure(invoke, handler, procedure_name):
+    """Returns the number of calls per second of the specified procedure. """
+
+    procedure = handler.remote_procedures[procedure_name]
+    codec = get_codec('stdlib')
+    responses = []
+    start = time.perf_counter()
+    for marker in range(NUMBER):
+        await invoke(handler, procedure, Request(marker, responses.append, codec))
+
+    return NUMBER / (time.perf_counter() - start)
+
+
+async def run():
+    """Runs the benchmark. """
+
+    # Bypass WebSocketHandler.__init__ since only invoking the procedures is
+    # measured.
+    handler = BenchmarkRPCServer.__new__(BenchmarkRPCServer)
+    handler.codec = get_codec('stdlib')
+    handler.logger = logging.getLogger('tornado.application')
+
+    print(f'{"procedure":>16} {"legacy, calls/s":>16} {"current, calls/s":>17}')
+    for procedure_name in ('return_value', 'ret_value', 'continue_stream', 'yield_stream'):
+        if procedure_name == 'yield_stream':
+            legacy = '-'  # async generators were not supported
+        else:
+            legacy = f'{await measure(legacy_invoke_procedure, handler, procedure_name):.0f}'
+
+        current = await measure(invoke_procedure, handler, procedure_name)
+        print(f'{procedure_name:>16} {legacy:>16} {current:>17.0f}')
+
+
+def main():
+    """The main entry point. """
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+/*
+ * Copyright 2026 Evgeny Golyshev <eugulixes@gmail.com>
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+ */
+
+import {decode, encode} from '@msgpack/msgpack'
+import {Codec} from './types'
+
+/**
+ * The WebSocket subprotocol the client asks for when it wants to use MessagePack.
+ */
+export const MSGPACK_SUBPROTOCOL = 'shirow.msgpack'
+
+/**
+ * Decodes the binary frames the RPC server sends over JSON connections to carry raw bytes.
+ * Such a frame consists of the length of the header (uint32, big-endian), the header (the
+ * response without the result) and the result itself.
+ */
+function decodeBinaryFrame (data: ArrayBuffer) {
+    const headerLength = new DataView(data).getUint32(0)
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(data, 4, headerLength)))
+    header.result = new Uint8Array(data, 4 + headerLength)
+    return header
+}
+
+/**
+ * Encodes messages as JSON text frames. It's the default codec.
+ */
+export const jsonCodec: Codec = {
+    encode: (data) => JSON.stringify(data),
+    decode: (data) => data instanceof ArrayBuffer ? decodeBinaryFrame(data) : JSON.parse(data),
+}
+
+/**
+ * Encodes messages as MessagePack binary frames.
+ */
+export const msgpackCodec: Codec = {
+    encode: (data) => encode(data),
+    decode: (data) => decode(new Uint8Array(data as ArrayBuffer)),
+}
@@ -18,24 +18,28 @@
  */
 
 import {EventEmitter} from 'events'
+import {jsonCodec, msgpackCodec, MSGPACK_SUBPROTOCOL} from './codec'
 import {HostValidationError} from './errors'
-import {Callback, MessageData, ResultCache} from './types'
+import {CallData, Callback, CancelData, Codec, MessageData, ResultCache, ShirowOptions} from './types'
 import {diagnoseConnection, isWsHost, log} from './utils'
 
 const RETRIES_COUNT = 5
 
 /**
  * Creates a connection with an RPC-server and acts as an RPC-client, allowing remote procedures
- * to be called.
+ * to be called. The MessagePack format is used only if the RPC server agrees to it, otherwise
+ * the client falls back to JSON.
  */
-export const Shirow = (wsHost: string) => {
+export const Shirow = (wsHost: string, options: ShirowOptions = {}) => {
     let attempt = 1
     let client: WebSocket
+    let codec: Codec = jsonCodec
     let isOpened = false
     let doNotReconnect = false
     let isDiagnosed = false
     let callNumber = 0
-    let queue: string[] = []
+    let queue: (CallData | CancelData)[] = []
+    let batch: (CallData | CancelData)[] = []
     const resultCache: ResultCache = {}
 
     if (!isWsHost(wsHost)) {
@@ -55,12 +59,15 @@ export const Shirow = (wsHost: string) => {
     // Private methods
 
     function _connect () {
-        client = new WebSocket(wsHost)
+        const protocols = options.format === 'msgpack' ? [MSGPACK_SUBPROTOCOL] : []
+        client = new WebSocket(wsHost, protocols)
+        client.binaryType = 'arraybuffer'
 
         client.onopen = () => {
             log('connection is established')
             attempt = 1
             isOpened = true
+            codec = client.protocol === MSGPACK_SUBPROTOCOL ? msgpackCodec : jsonCodec
 
             queue.forEach(_send)
             queue = []
@@ -97,19 +104,45 @@ export const Shirow = (wsHost: string) => {
         }
 
         client.onmessage = (event) => {
-            const data = JSON.parse(event.data) as MessageData
-            const strMarker = String(data.marker)
+            const data = codec.decode(event.data) as MessageData | MessageData[]
 
-            if (typeof data.result !== 'undefined') {
-                messageEmitter.emit(strMarker, data.result)
+            // The RPC server may combine several responses into a single frame.
+            if (Array.isArray(data)) {
+                data.forEach(_handleMessage)
             } else {
-                errorEmitter.emit(strMarker, data.error)
+                _handleMessage(data)
             }
+        }
+    }
 
-            if (data.eod === 1) {
-                messageEmitter.removeAllListeners(strMarker)
-                errorEmitter.removeAllListeners(strMarker)
-            }
+    function _flushBatch () {
+        const calls = batch
+        batch = []
+
+        if (!isOpened) {
+            queue.push(...calls)
+        } else if (calls.length === 1) {
+            client.send(codec.encode(calls[0]))
+        } else {
+            client.send(codec.encode(calls))
+        }
+    }
+
+    function _handleMessage (data: MessageData) {
+        const strMarker = String(data.marker)
+
+        if (typeof data.result !== 'undefined') {
+            messageEmitter.emit(strMarker, data.result)
+        } else if (typeof data.error !== 'undefined') {
+            // The code is set for the errors reported by the RPC server itself (such as busy).
+            errorEmitter.emit(strMarker, data.error, data.code)
+        }
+        // Otherwise, the message only terminates a stream (for example, produced by an
+        // async generator).
+
+        if (data.eod === 1) {
+            messageEmitter.removeAllListeners(strMarker)
+            errorEmitter.removeAllListeners(strMarker)
         }
     }
 
@@ -125,11 +158,20 @@ export const Shirow = (wsHost: string) => {
         }
     }
 
-    function _send (data: string) {
-        if (isOpened) {
-            client.send(data)
-        } else {
+    function _send (data: CallData | CancelData) {
+        if (!isOpened) {
             queue.push(data)
+        } else if (options.batch) {
+            /*
+             * The calls made in the same tick are sent to the RPC server as a single frame
+             * containing an array of calls.
+             */
+            if (batch.length === 0) {
+                Promise.resolve().then(_flushBatch)
+            }
+            batch.push(data)
+        } else {
+            client.send(codec.encode(data))
         }
     }
 
@@ -144,19 +186,22 @@ export const Shirow = (wsHost: string) => {
          * client is able to call the corresponding handler function. The call
          * number is used as a marker.
          */
-        const data = {
+        const data: CallData = {
             function_name: procedureName,
             parameters_list: parametersList,
             marker: callNumber++,
         }
-        const jsonData = JSON.stringify(data)
+        // The RPC server cancels the call if it doesn't complete in time (in seconds).
+        if (options.timeout) {
+            data.timeout = options.timeout
+        }
 
         const cacheKey = `${data.function_name}${JSON.stringify(data.parameters_list)}`
         const strMarker = String(data.marker)
 
         // When force is set to true we don't cache the result.
         if (force) {
-            _send(jsonData)
+            _send(data)
         } else {
             const cachedValue = resultCache[cacheKey]
             if (cachedValue) {
@@ -164,11 +209,27 @@ export const Shirow = (wsHost: string) => {
                     messageEmitter.emit(strMarker, cachedValue)
                 })
             } else {
-                _send(jsonData)
+                _send(data)
             }
         }
 
         return {
+            /*
+             * Asks the RPC server to cancel the call. The handlers registered with then and
+             * catch are not invoked anymore.
+             */
+            cancel: function () {
+                messageEmitter.removeAllListeners(strMarker)
+                errorEmitter.removeAllListeners(strMarker)
+
+                const queued = queue.indexOf(data)
+                if (queued !== -1) { // the call hasn't been sent yet
+                    queue.splice(queued, 1)
+                } else {
+                    _send({cancel: data.marker})
+                }
+                return this
+            },
             then: function (cb: Callback) {
                 messageEmitter.on(strMarker, (result) => {
                     if (!force) {
@@ -17,7 +17,26 @@
 
 export type Callback = (...args: any) => void
 
+export type CallData = {
+    function_name: string,
+    parameters_list: any[],
+    marker: number,
+    timeout?: number,
+}
+
+export type CancelData = {
+    cancel: number,
+}
+
+export type Codec = {
+    encode: (data: any) => string | Uint8Array,
+    decode: (data: string | ArrayBuffer) => any,
+}
+
+export type Format = 'json' | 'msgpack'
+
 export type MessageData = {
+    code?: string,
     eod?: 1 | 0,
     marker: number,
     result?: any,
@@ -27,3 +46,9 @@ export type MessageData = {
 export type ResultCache = {
     [key: string]: any,
 }
+
+export type ShirowOptions = {
+    batch?: boolean,
+    format?: Format,
+    timeout?: number,
+}
@@ -0,0 +1,174 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the admission control of RPC servers. The lag of the
+event loop is taken from the heartbeat shared with the lag watchdog, while the
+memory usage of the process is sampled periodically. While
+either of them exceeds its limit, the server is considered overloaded, so it
+rejects new connections and calls, leaving alone the calls which are already
+running.
+"""
+
+import os
+import resource
+import sys
+
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+
+from shirow.heartbeat import HEARTBEAT
+from shirow.metrics import REGISTRY
+
+define('admission_interval',
+       help='the interval (in seconds) at which the event loop lag and the '
+            'memory usage are sampled for admission control', default=0.1,
+       type=float)
+define('max_loop_lag',
+       help='reject new connections and calls while the event loop lag '
+            'exceeds the specified time (in seconds; 0 means no limit)',
+       default=0.0, type=float)
+define('max_rss',
+       help='reject new connections and calls while the resident set size of '
+            'the process exceeds the specified number of megabytes (0 means '
+            'no limit)', default=0, type=int)
+
+PRESSURE = REGISTRY.gauge(
+    'shirow_admission_pressure',
+    'Ratio of the last sample to its limit (1 and above means overloaded)',
+    ['resource'])
+REJECTIONS = REGISTRY.counter(
+    'shirow_admission_rejections_total',
+    'Number of connections and calls rejected since the server was overloaded',
+    ['kind', 'resource'])
+RSS = REGISTRY.gauge(
+    'shirow_admission_rss_bytes',
+    'Resident set size of the process measured by the last sample')
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def get_rss():
+    """Returns the resident set size of the process in bytes. Where /proc is
+    not available, returns the peak resident set size instead.
+    """
+
+    try:
+        with open('/proc/self/statm', 'rb') as infile:
+            return int(infile.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in bytes on macOS, but in kilobytes elsewhere.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class AdmissionController:
+    """Samples the memory usage of the process, keeps the heartbeat measuring
+    the event loop lag going and tells whether new connections and calls can
+    be admitted. The samples are taken by periodic callbacks, so the check
+    itself costs a couple of comparisons.
+    """
+
+    def __init__(self):
+        self.rss = 0
+
+        self._io_loop = None
+        self._timeout = None
+
+    #
+    # Internal methods
+    #
+
+    @staticmethod
+    def _has_limits():
+        return options.max_loop_lag > 0 or options.max_rss > 0
+
+    def _sample(self):
+        if not self._has_limits():  # the limits were unset
+            self.stop()
+            return
+
+        if options.max_loop_lag > 0:
+            HEARTBEAT.start(self._io_loop, self, options.admission_interval)
+            PRESSURE.set(HEARTBEAT.lag / options.max_loop_lag, labels=('loop_lag', ))
+        else:
+            HEARTBEAT.stop(self)
+
+        if options.max_rss > 0:
+            self.rss = get_rss()
+            RSS.set(self.rss)
+            PRESSURE.set(self.rss / (options.max_rss * 1024 * 1024), labels=('memory', ))
+
+        self._timeout = self._io_loop.call_later(options.admission_interval, self._sample)
+
+    #
+    # User visible methods
+    #
+
+    def admit(self, kind):
+        """Returns True if a new connection or call (see kind) can be
+        admitted. Otherwise, counts the rejection and returns False.
+        """
+
+        if self._io_loop is None and self._has_limits():  # the limits were set later
+            self.start(IOLoop.current())
+
+        overloaded_resource = self.get_overloaded_resource()
+        if overloaded_resource is None:
+            return True
+
+        REJECTIONS.inc(labels=(kind, overloaded_resource))
+        return False
+
+    def get_overloaded_resource(self):
+        """Returns the name of the resource (loop_lag or memory) which
+        exceeds its limit or None if the server is not overloaded.
+        """
+
+        if 0 < options.max_loop_lag <= HEARTBEAT.lag:
+            return 'loop_lag'
+
+        if 0 < options.max_rss * 1024 * 1024 <= self.rss:
+            return 'memory'
+
+        return None
+
+    def start(self, io_loop):
+        """Starts sampling on the specified event loop unless it's started
+        already or neither --max_loop_lag nor --max_rss is set. The first
+        sample is taken immediately.
+        """
+
+        if self._io_loop is io_loop:
+            return
+
+        self.stop()
+        if not self._has_limits():
+            return
+
+        self._io_loop = io_loop
+        self._sample()
+
+    def stop(self):
+        """Stops sampling. """
+
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+
+        HEARTBEAT.stop(self)
+        self.rss = 0
+        self._io_loop = None
+        self._timeout = None
+
+
+ADMISSION = AdmissionController()
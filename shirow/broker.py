@@ -0,0 +1,403 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the broker delivering the messages published on a
+channel to the subscribers of the channel in all the processes of a service.
+The messages are delivered to the subscribers in the publishing process right
+away, while a backend delivers them to the other processes. The values
+published to the topics of the pub/sub hub and the invalidations of the cached
+results go through the broker, so they reach the clients and the caches of
+all the workers.
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+
+from shirow import results
+from shirow.codec import get_codec
+from shirow.metrics import REGISTRY
+from shirow.pubsub import HUB
+
+define('broker',
+       help='the backend delivering the published messages to the other '
+            'processes (memory or unix)', default='memory', type=str)
+define('broker_batch_bytes',
+       help='the number of bytes of the messages published during an event '
+            'loop iteration, after which they are sent to the other processes '
+            'without waiting for the end of the iteration', default=65536,
+       type=int)
+define('broker_max_buffer_bytes',
+       help='the number of bytes buffered for another process after which it '
+            'is considered stalled and disconnected', default=16 * 1024 * 1024,
+       type=int)
+define('broker_socket',
+       help='the path to the Unix domain socket the processes of the service '
+            'exchange the published messages over (must be unique per '
+            'service)', default='/tmp/shirow-broker.sock', type=str)
+
+INVALIDATE_CHANNEL = 'shirow.invalidate'
+
+PUBSUB_CHANNEL = 'shirow.pubsub'
+
+# The time (in seconds) to wait before connecting to the leader once again
+# when it's starting or has just exited.
+RETRY_INTERVAL = 0.05
+
+LOGGER = logging.getLogger('tornado.application')
+
+BATCHES_RECEIVED = REGISTRY.counter(
+    'shirow_broker_batches_received_total',
+    'Number of batches of messages received from the other processes')
+BATCHES_SENT = REGISTRY.counter(
+    'shirow_broker_batches_sent_total',
+    'Number of batches of messages sent to the other processes')
+DISCONNECTED_PEERS = REGISTRY.counter(
+    'shirow_broker_disconnected_peers_total',
+    'Number of stalled processes disconnected since their buffers were full')
+DROPPED_MESSAGES = REGISTRY.counter(
+    'shirow_broker_dropped_messages_total',
+    'Number of messages not sent to the other processes since the process '
+    'was not connected to them')
+MESSAGES_SENT = REGISTRY.counter(
+    'shirow_broker_messages_sent_total',
+    'Number of messages sent to the other processes')
+
+
+class BrokerBackend:
+    """Base class for the backends delivering the published messages to the
+    other processes.
+    """
+
+    async def start(self, deliver):
+        """Starts delivering the messages. The messages published by the other
+        processes are passed to deliver along with their channels.
+        """
+
+    async def stop(self):
+        """Stops delivering the messages. """
+
+    def publish(self, channel, message):
+        """Sends the specified message published on the channel to the other
+        processes.
+        """
+
+        raise NotImplementedError
+
+
+class MemoryBackend(BrokerBackend):
+    """Backend for the services running as a single process, so the messages
+    are delivered within the process only.
+    """
+
+    def publish(self, channel, message):
+        pass
+
+
+class UnixSocketBackend(BrokerBackend):  # pylint: disable=too-many-instance-attributes
+    """Backend exchanging the messages between the processes on the same host
+    over a Unix domain socket. The process which manages to lock the socket
+    becomes the leader: it listens on the socket and relays the messages of
+    each process to the rest. When the leader exits, the others elect a new
+    one. The messages published during an event loop iteration are sent as a
+    single frame, which the leader relays without decoding it again. A
+    process which doesn't read the frames sent to it is disconnected once
+    more than max_buffer_bytes are buffered for it.
+    """
+
+    def __init__(self, path=None, batch_bytes=None, max_buffer_bytes=None):
+        self.batch_bytes = options.broker_batch_bytes if batch_bytes is None else batch_bytes
+        self.max_buffer_bytes = (options.broker_max_buffer_bytes if max_buffer_bytes is None
+                                 else max_buffer_bytes)
+        self.path = path or options.broker_socket
+
+        self._batch = []
+        self._batch_bytes = 0
+        self._codec = get_codec(options.json_codec)
+        self._deliver = None
+        self._flush_scheduled = False
+        self._lock_file = None
+        self._peers = {}  # the writers of the followers and the tasks serving them
+        self._server = None
+        self._stopping = False
+        self._task = None
+        self._writer = None
+
+    #
+    # Internal methods
+    #
+
+    async def _connect(self):
+        while not self._stopping:
+            if self._lock():
+                # The socket may be left by the leader which crashed.
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+
+                self._server = await asyncio.start_unix_server(self._serve_peer, self.path)
+                return
+
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                await asyncio.sleep(RETRY_INTERVAL)
+                continue
+
+            self._task = asyncio.ensure_future(self._follow(reader))
+            return
+
+    def _deliver_batch(self, payload):
+        BATCHES_RECEIVED.inc()
+        for channel, message in self._codec.decode(payload):
+            self._deliver(channel, message)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        batch, self._batch = self._batch, []
+        self._batch_bytes = 0
+        if not batch:
+            return
+
+        if self._server is not None:
+            writers = self._peers
+        elif self._writer is not None:
+            writers = (self._writer, )
+        else:  # reconnecting to the leader at the moment
+            DROPPED_MESSAGES.inc(len(batch))
+            return
+
+        if not writers:
+            return
+
+        payload = self._codec.join(batch)
+        frame = len(payload).to_bytes(4, 'big') + payload
+        for writer in list(writers):
+            self._write(writer, frame)
+
+        BATCHES_SENT.inc()
+        MESSAGES_SENT.inc(len(batch))
+
+    async def _follow(self, reader):
+        try:
+            while True:
+                self._deliver_batch(await self._read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        self._writer.close()
+        self._writer = None
+        if not self._stopping:
+            LOGGER.warning('Lost the connection to the broker leader, reconnecting')
+            await self._connect()
+
+    def _lock(self):
+        lock_file = open(f'{self.path}.lock', 'wb')  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self._lock_file = lock_file
+        return True
+
+    @staticmethod
+    async def _read_frame(reader):
+        header = await reader.readexactly(4)
+        return await reader.readexactly(int.from_bytes(header, 'big'))
+
+    async def _serve_peer(self, reader, writer):
+        self._peers[writer] = asyncio.current_task()
+        try:
+            while True:
+                payload = await self._read_frame(reader)
+                frame = len(payload).to_bytes(4, 'big') + payload
+                for peer in list(self._peers):
+                    if peer is not writer:
+                        self._write(peer, frame)
+
+                self._deliver_batch(payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._peers[writer]
+            writer.close()
+
+    def _write(self, writer, frame):
+        transport = writer.transport
+        if transport.is_closing():
+            return
+
+        if transport.get_write_buffer_size() > self.max_buffer_bytes:
+            LOGGER.warning('Disconnecting the broker peer which stopped reading')
+            DISCONNECTED_PEERS.inc()
+            # Unlike close, abort doesn't wait for the buffer to be flushed.
+            transport.abort()
+            return
+
+        writer.write(frame)
+
+    #
+    # User visible methods
+    #
+
+    @property
+    def is_leader(self):
+        """Whether the process relays the messages of the other processes. """
+
+        return self._server is not None
+
+    def publish(self, channel, message):
+        encoded_message = self._codec.encode([channel, message])
+        self._batch.append(encoded_message)
+        self._batch_bytes += len(encoded_message)
+        if self._batch_bytes >= self.batch_bytes:
+            self._flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            IOLoop.current().add_callback(self._flush)
+
+    async def start(self, deliver):
+        """Connects to the leader or becomes the leader. """
+
+        self._deliver = deliver
+        self._stopping = False
+        await self._connect()
+
+    async def stop(self):
+        self._stopping = True
+        self._flush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        if self._server is not None:
+            self._server.close()
+            tasks = list(self._peers.values())
+            for writer in list(self._peers):
+                writer.close()
+
+            await asyncio.gather(*tasks)
+            await self._server.wait_closed()
+            self._server = None
+            os.unlink(self.path)
+
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+BACKEND_CLASSES = {
+    'memory': MemoryBackend,
+    'unix': UnixSocketBackend,
+}
+
+
+class Broker:
+    """Delivers the messages published on a channel to the subscribers of the
+    channel in all the processes using the backend. Unless the backend is set,
+    it's chosen by the --broker option when the broker is started. Until then,
+    the messages are delivered within the process only.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+        self._subscribers = {}
+
+    #
+    # Internal methods
+    #
+
+    def _deliver(self, channel, message):
+        for callback in list(self._subscribers.get(channel, ())):
+            try:
+                callback(message)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('A subscriber of the %s channel failed', channel)
+
+    #
+    # User visible methods
+    #
+
+    def publish(self, channel, message):
+        """Delivers the specified message to the subscribers of the channel in
+        all the processes. The message must be serializable to JSON.
+        """
+
+        self._deliver(channel, message)
+        if self.backend is not None:
+            self.backend.publish(channel, message)
+
+    async def start(self):
+        """Starts the backend. """
+
+        if self.backend is None:
+            try:
+                backend_class = BACKEND_CLASSES[options.broker]
+            except KeyError as exc:
+                raise ValueError(f'unknown broker {options.broker}') from exc
+
+            self.backend = backend_class()
+
+        await self.backend.start(self._deliver)
+
+    async def stop(self):
+        """Stops the backend. """
+
+        if self.backend is not None:
+            await self.backend.stop()
+
+    def subscribe(self, channel, callback):
+        """Registers the callback to be invoked with each message published on
+        the specified channel.
+        """
+
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        """Unregisters the callback registered with subscribe. """
+
+        self._subscribers[channel].remove(callback)
+
+
+BROKER = Broker()
+
+
+def invalidate(procedure=None, prefix=(), user_id=None):
+    """Removes the cached results in all the processes of the service. See
+    shirow.results.invalidate for the arguments.
+    """
+
+    BROKER.publish(INVALIDATE_CHANNEL, [procedure, list(prefix), user_id])
+
+
+def publish(topic, value):
+    """Publishes the specified value to the topic of the pub/sub hub in all
+    the processes of the service.
+    """
+
+    BROKER.publish(PUBSUB_CHANNEL, [topic, value])
+
+
+BROKER.subscribe(INVALIDATE_CHANNEL, lambda message: results.invalidate(*message))
+BROKER.subscribe(PUBSUB_CHANNEL, lambda message: HUB.publish(*message))
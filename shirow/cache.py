@@ -0,0 +1,97 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the caches used by Shirow. """
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Bounded mapping which evicts the least recently used entries when it's
+    full. Each entry may also have its own expiration time measured by the
+    specified clock.
+    """
+
+    def __init__(self, max_entries, clock=time.monotonic):
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def max_entries(self):
+        """The maximum number of entries the cache keeps. """
+
+        return self._max_entries
+
+    def clear(self):
+        """Removes all the entries from the cache. """
+
+        self._entries.clear()
+
+    def get(self, key, default=None):
+        """Returns the value for the specified key if it's in the cache and
+        isn't expired, else default.
+        """
+
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            return default
+
+        if expires_at is not None and expires_at <= self._clock():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        """Removes the specified key from the cache and returns its value. """
+
+        try:
+            value, _expires_at = self._entries.pop(key)
+        except KeyError:
+            return default
+
+        return value
+
+    def put(self, key, value, expires_at=None):
+        """Puts the value into the cache. The entry expires when the clock
+        reaches expires_at, if specified.
+        """
+
+        max_entries = self.max_entries
+        if max_entries <= 0:
+            return
+
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+
+    def remove_if(self, predicate):
+        """Removes the entries for which predicate(key, value) is true and
+        returns their number.
+        """
+
+        keys = [key for key, (value, _expires_at) in self._entries.items()
+                if predicate(key, value)]
+        for key in keys:
+            del self._entries[key]
+
+        return len(keys)
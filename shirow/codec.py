@@ -0,0 +1,254 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the codecs used to decode the messages received from
+RPC clients and encode the messages sent to them. The codecs produce bytes, so
+the encoded messages can be passed to `write_message` as is.
+
+Remote procedures may return the values which are already encoded as JSON
+wrapped into RawJSON. JSON codecs pass them through as is, so they are never
+decoded and encoded again.
+"""
+
+import json
+import logging
+from functools import lru_cache
+
+from tornado.escape import json_encode
+from tornado.options import define
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+LOGGER = logging.getLogger('tornado.application')
+
+
+class BinaryFrame(bytes):
+    """Encoded message which must be sent in a binary frame whatever the codec
+    of the connection is.
+    """
+
+
+class RawJSON:  # pylint: disable=too-few-public-methods
+    """Value which is already encoded as JSON (for example, taken from a cache
+    or received from another service). The value is either str or bytes.
+    """
+
+    __slots__ = ('data', )
+
+    def __init__(self, data):
+        self.data = data.encode('utf-8') if isinstance(data, str) else data
+
+
+class Codec:
+    """Base class for codecs. """
+
+    name = None
+
+    # Whether the encoded messages must be sent in binary frames.
+    binary = False
+
+    def decode(self, data):
+        """Decodes the specified str or bytes object. """
+
+        raise NotImplementedError
+
+    def embed(self, obj, key, encoded_value):
+        """Encodes the specified dict adding the key the value of which is
+        already encoded, so the encoded values can be reused without decoding
+        them.
+        """
+
+        prefix, suffix = self.get_embedding_template(obj, key)
+        return prefix + encoded_value + suffix
+
+    def encode(self, obj):
+        """Encodes the specified object into bytes. """
+
+        raise NotImplementedError
+
+    def encode_result(self, value):
+        """Encodes the specified result of a remote procedure. Unlike encode,
+        takes RawJSON into account.
+        """
+
+        raise NotImplementedError
+
+    def get_embedding_template(self, obj, key):
+        """Returns the prefix and the suffix the encoded value must be put
+        between to get the specified dict with the key added (see embed). The
+        template can be reused for any number of values.
+        """
+
+        raise NotImplementedError
+
+    def join(self, encoded_objs):
+        """Combines the specified encoded objects into an encoded array without
+        decoding them.
+        """
+
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):  # pylint: disable=abstract-method
+    """Base class for JSON codecs. """
+
+    def encode_result(self, value):
+        if isinstance(value, RawJSON):
+            return value.data
+
+        return self.encode(value)
+
+    def get_embedding_template(self, obj, key):
+        separator = b',' if obj else b''
+        return self.encode(obj)[:-1] + separator + self.encode(key) + b':', b'}'
+
+    def join(self, encoded_objs):
+        return b'[' + b','.join(encoded_objs) + b']'
+
+
+class StdlibCodec(JSONCodec):
+    """Codec based on the json module from the standard library. """
+
+    name = 'stdlib'
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode(self, obj):
+        # json_encode escapes "</" to make it safe to embed the result in HTML,
+        # so the codec produces exactly what Shirow produced before.
+        return json_encode(obj).encode('utf-8')
+
+
+class OrjsonCodec(JSONCodec):
+    """Codec based on orjson. """
+
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+
+    def decode(self, data):
+        return orjson.loads(data)  # pylint: disable=no-member
+
+    def encode(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)  # pylint: disable=no-member
+
+
+class UjsonCodec(JSONCodec):
+    """Codec based on ujson. """
+
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError('ujson is not installed')
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+    def encode(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+class MsgPackCodec(Codec):
+    """Codec based on MessagePack. Unlike the other codecs, it's not a JSON
+    codec, so it's negotiated with the client via a WebSocket subprotocol
+    instead of being configured server-wide.
+    """
+
+    name = 'msgpack'
+
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    @staticmethod
+    def _get_map_header(length):
+        if length < 16:
+            return bytes((0x80 | length, ))  # fixmap
+        if length < 2 ** 16:
+            return b'\xde' + length.to_bytes(2, 'big')  # map 16
+
+        return b'\xdf' + length.to_bytes(4, 'big')  # map 32
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def encode_result(self, value):
+        if isinstance(value, RawJSON):  # it has to be converted to MessagePack
+            return self.encode(json.loads(value.data))
+
+        return self.encode(value)
+
+    def get_embedding_template(self, obj, key):
+        header_length = len(self._get_map_header(len(obj)))
+        return (self._get_map_header(len(obj) + 1) + self.encode(obj)[header_length:] +
+                self.encode(key), b'')
+
+    def join(self, encoded_objs):
+        length = len(encoded_objs)
+        if length < 16:
+            header = bytes((0x90 | length, ))  # fixarray
+        elif length < 2 ** 16:
+            header = b'\xdc' + length.to_bytes(2, 'big')  # array 16
+        else:
+            header = b'\xdd' + length.to_bytes(4, 'big')  # array 32
+
+        return header + b''.join(encoded_objs)
+
+
+CODECS = {codec.name: codec for codec in (StdlibCodec, OrjsonCodec, UjsonCodec)}
+
+define('json_codec',
+       help=f"use the specified JSON codec ({'|'.join(CODECS)}); falls back "
+            f"to stdlib if the library is not installed", default='stdlib')
+
+
+@lru_cache(maxsize=None)
+def get_codec(name):
+    """Returns the codec with the specified name. If the library the codec is
+    based on is not installed, falls back to the stdlib codec.
+    """
+
+    try:
+        codec_class = CODECS[name]
+    except KeyError as exc:
+        raise ValueError(f'unknown codec {name}') from exc
+
+    try:
+        return codec_class()
+    except ImportError:
+        LOGGER.warning('The %s codec is not available, falling back to %s',
+                       name, StdlibCodec.name)
+        return StdlibCodec()
@@ -23,3 +23,9 @@ class UndefinedMethod(Exception):
     """Exception raised when attempting to get a method which either does not exist or is not
     public.
     """
+
+
+class TooManyPendingVerifications(Exception):
+    """Exception raised when the number of tokens waiting for verification
+    exceeds the limit.
+    """
@@ -0,0 +1,87 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the executors Shirow uses to run CPU-bound code
+without blocking the event loop.
+"""
+
+import importlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from tornado.options import define, options
+
+define('pool_workers',
+       help='the number of workers of the named pools running remote '
+            'procedures, e.g. images=4 (defaults to the number of '
+            'processors)', default=[], multiple=True, type=str)
+
+EXECUTOR_CLASSES = {
+    'process': ProcessPoolExecutor,
+    'thread': ThreadPoolExecutor,
+}
+
+_EXECUTORS = {}
+
+
+def call_by_name(module_name, qualname, args):
+    """Calls the function decorated by the remote decorator, given the name
+    of the module and the qualified name of the function. Only the names and
+    the arguments cross the process boundary, so neither the RPC server nor
+    the request need to be pickled.
+    """
+
+    obj = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+
+    return obj.__wrapped__(*args)
+
+
+def get_executor(kind, name, max_workers=None):
+    """Returns the executor of the specified kind (thread or process) and name,
+    creating it if necessary. max_workers is taken into account only when the
+    executor is created.
+    """
+
+    executor = _EXECUTORS.get((kind, name))
+    if executor is None:
+        try:
+            executor_class = EXECUTOR_CLASSES[kind]
+        except KeyError as exc:
+            raise ValueError(f'unknown executor kind {kind}') from exc
+
+        executor = _EXECUTORS[(kind, name)] = executor_class(max_workers=max_workers)
+
+    return executor
+
+
+def get_pool_workers(name):
+    """Returns the number of workers of the specified pool set by
+    --pool_workers or None.
+    """
+
+    for item in options.pool_workers:
+        pool, _, workers = item.partition('=')
+        if pool == name:
+            return int(workers)
+
+    return None
+
+
+def shutdown_executors(wait=True):
+    """Shuts down all the executors created so far. """
+
+    while _EXECUTORS:
+        _key, executor = _EXECUTORS.popitem()
+        executor.shutdown(wait=wait)
@@ -0,0 +1,156 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the implementation of single-flight calls. The
+concurrent calls of a single-flight procedure with the same arguments share a
+single execution of the procedure, which is called a flight.
+"""
+
+import asyncio
+from functools import partial
+
+from tornado.websocket import WebSocketClosedError
+
+from shirow.metrics import REGISTRY
+from shirow.request import RUNNING_REQUESTS, Request, Ret
+
+FLIGHTS = {}
+
+JOINED_CALLS = REGISTRY.counter(
+    'shirow_joined_calls_total',
+    'Number of calls which joined the flights started by other calls')
+
+
+class Flight(Request):
+    """Request passed to a single-flight procedure instead of the requests of
+    the calls sharing its execution. Each value the procedure returns is
+    encoded once per codec and sent to every request which has joined the
+    flight, so the requests joined late receive only the values produced
+    after they joined. The flight is cancelled when all the requests leave it.
+    """
+
+    # The flight responds on behalf of the requests which joined it, so it
+    # uses their internals.
+    # pylint: disable=protected-access
+
+    def __init__(self, procedure_name=None):
+        super().__init__(None, None, drain=self._drain_all, procedure_name=procedure_name)
+
+        self.requests = []
+        self.task = None
+
+    #
+    # Internal methods
+    #
+
+    async def _drain_all(self):
+        for request in list(self.requests):
+            if request._drain is not None:
+                await request._drain()
+
+    def _finish(self):
+        if self.done:
+            return
+
+        super()._finish()
+        for request in self.requests:
+            request._finish()
+
+    def _leave(self, request):
+        self.requests.remove(request)
+        if not self.requests:
+            self.cancel()
+            if self.task is not None:
+                self.task.cancel()
+
+    def _fan_out(self, get_response):
+        for request in list(self.requests):
+            try:
+                request._respond(get_response(request))
+            except WebSocketClosedError:
+                pass  # the request leaves the flight when the connection is closed
+
+    async def _run(self, coro):
+        task = asyncio.current_task()
+        RUNNING_REQUESTS[task] = self
+        try:
+            await coro
+        except Ret:
+            pass
+        finally:
+            del RUNNING_REQUESTS[task]
+            # The flight is over unless the procedure keeps responding after
+            # it returns.
+            if not self.has_cancel_callbacks:
+                self._finish()
+
+    def _send_end(self):
+        self._fan_out(lambda request: request._get_end_response())
+
+    def _send_error(self, message, code=None):
+        self._fan_out(lambda request: request._get_error_response(message, code))
+
+    def _send_result(self, value, eod=True):
+        if isinstance(value, bytes):  # may be sent in binary frames
+            self._fan_out(lambda request: request._get_successful_response(value, eod))
+            return
+
+        encoded_values = {}
+
+        def get_response(request):
+            codec = request._codec
+            if codec.name not in encoded_values:
+                encoded_values[codec.name] = codec.encode_result(value)
+
+            return request._get_embedded_response(encoded_values[codec.name], eod)
+
+        self._fan_out(get_response)
+
+    #
+    # User visible methods
+    #
+
+    def join(self, request):
+        """Makes the specified request receive the values the procedure
+        returns from now on.
+        """
+
+        self.requests.append(request)
+        request.add_cancel_callback(partial(self._leave, request))
+
+    def start(self, coro):
+        """Starts the flight running the specified coroutine, which calls the
+        procedure.
+        """
+
+        self.task = asyncio.ensure_future(self._run(coro))
+
+
+def join_flight(key, request, start):
+    """Makes the specified request join the flight with the specified key. If
+    there is no such flight, starts a new one passing it to start, which must
+    return the coroutine calling the procedure. Returns the flight.
+    """
+
+    flight = FLIGHTS.get(key)
+    if flight is None:
+        flight = FLIGHTS[key] = Flight(request.procedure_name)
+        flight.add_done_callback(partial(FLIGHTS.pop, key))
+        flight.join(request)
+        flight.start(start(flight))
+    else:
+        JOINED_CALLS.inc()
+        flight.join(request)
+
+    return flight
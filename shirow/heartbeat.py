@@ -0,0 +1,101 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the heartbeat measuring the lag of the event loop,
+i.e. how late a callback scheduled on the loop periodically runs. The lag
+watchdog and the admission control share the heartbeat, so a single timer
+measures the lag for both of them.
+"""
+
+import time
+
+from shirow.metrics import REGISTRY
+
+LOOP_LAG = REGISTRY.histogram(
+    'shirow_loop_lag_seconds',
+    'Time the callbacks of the event loop were delayed by')
+
+
+class Heartbeat:
+    """Periodic callback measuring the lag of the event loop. Each user starts
+    the heartbeat with the interval it needs, and the shortest one is used.
+    The heartbeat stops when the last user stops it.
+    """
+
+    def __init__(self):
+        self.expected_at = None
+        self.lag = 0.0
+
+        self._interval = None
+        self._intervals = {}  # keyed on the users
+        self._io_loop = None
+        self._timeout = None
+
+    #
+    # Internal methods
+    #
+
+    def _beat(self):
+        now = time.monotonic()
+        if self.expected_at is not None:
+            self.lag = max(now - self.expected_at, 0)
+            LOOP_LAG.observe(self.lag)
+
+        self.expected_at = now + self._interval
+        self._timeout = self._io_loop.call_later(self._interval, self._beat)
+
+    def _cancel(self):
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+
+        self.expected_at = None
+        self.lag = 0.0
+        self._timeout = None
+
+    #
+    # User visible methods
+    #
+
+    def start(self, io_loop, user, interval):
+        """Starts measuring the lag of the specified event loop at least every
+        interval seconds on behalf of the user. The first beat is immediate.
+        """
+
+        if io_loop is not self._io_loop:  # the users of the old loop are gone
+            self._cancel()
+            self._intervals.clear()
+            self._io_loop = io_loop
+
+        self._intervals[user] = interval
+        interval = min(self._intervals.values())
+        if self._timeout is None or interval < self._interval:
+            self._interval = interval
+            self._cancel()
+            self._beat()
+
+    def stop(self, user):
+        """Stops measuring the lag on behalf of the user. """
+
+        if self._intervals.pop(user, None) is None:
+            return
+
+        if self._intervals:  # takes effect from the next beat
+            self._interval = min(self._intervals.values())
+        else:
+            self._cancel()
+            self._interval = None
+            self._io_loop = None
+
+
+HEARTBEAT = Heartbeat()
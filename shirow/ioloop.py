@@ -15,9 +15,159 @@
 """Utility code intended to simplify initializing the event loop. """
 
 import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
 
+import tornado.ioloop
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.options import define, options
 from tornado.platform.asyncio import AsyncIOMainLoop
 
+from shirow.broker import BROKER
+from shirow.executors import shutdown_executors
+from shirow.heartbeat import HEARTBEAT
+from shirow.metrics import REGISTRY
+from shirow.request import RUNNING_REQUESTS
+from shirow.server import RPCServer
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+define('drain_timeout',
+       help='the time (in seconds) given to the calls in flight to finish '
+            'when the server is shutting down', default=10.0, type=float)
+define('event_loop',
+       help='the event loop implementation (asyncio or uvloop)',
+       default='asyncio', type=str)
+define('loop_lag_threshold',
+       help='report the event loop stalls longer than the specified time (in '
+            'seconds) along with the calls responsible for them (0 disables '
+            'the watchdog)', default=0.0, type=float)
+define('max_restarts',
+       help='the maximum number of times crashed worker processes are '
+            'restarted', default=100, type=int)
+define('reuse_port',
+       help='make each worker process bind its own socket using SO_REUSEPORT '
+            'instead of sharing the socket bound by the parent process',
+       default=False, type=bool)
+define('workers',
+       help='the number of worker processes (0 means the number of '
+            'processors)', default=1, type=int)
+
+# The time (in seconds) given to the connections to complete the closing
+# handshake once the calls in flight are drained.
+CLOSE_TIMEOUT = 1.0
+
+EVENT_LOOPS = ('asyncio', 'uvloop')
+
+LOGGER = logging.getLogger('tornado.general')
+
+SLOW_CALLS = REGISTRY.counter(
+    'shirow_slow_calls_total',
+    'Number of times the calls blocked the event loop longer than '
+    '--loop_lag_threshold',
+    ['procedure'])
+
+
+def install_event_loop_policy(name):
+    """Makes asyncio create the event loops of the specified implementation.
+    If uvloop is requested but not installed, falls back to asyncio. Returns
+    the name of the implementation actually installed.
+    """
+
+    if name not in EVENT_LOOPS:
+        raise ValueError(f'unknown event loop {name}')
+
+    if name == 'uvloop':
+        if uvloop is None:
+            LOGGER.warning('uvloop is not available, falling back to asyncio')
+            return 'asyncio'
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    return name
+
+
+class LagWatchdog:
+    """Measures the lag of the event loop and reports the stalls longer than
+    the threshold. The loop updates the shared heartbeat periodically, while a
+    separate thread checks it. When the heartbeat is late, the thread captures the stack
+    of the loop thread and looks up the call running in the current task, so
+    the stall is attributed to the procedure responsible for it. The watchdog
+    must be started from the thread running the loop.
+    """
+
+    def __init__(self, io_loop, threshold, interval=None):
+        self.interval = interval or threshold / 2
+        self.threshold = threshold
+
+        self._io_loop = io_loop
+        self._reported_at = None  # the beat the last stall was reported for
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_id = None
+
+    #
+    # Internal methods
+    #
+
+    def _report(self, lag):
+        frame = sys._current_frames().get(self._thread_id)  # pylint: disable=protected-access
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+
+        task = asyncio.current_task(self._io_loop.asyncio_loop)
+        request = RUNNING_REQUESTS.get(task)
+        if request is None:
+            LOGGER.warning('The event loop has been blocked for %.3fs\n%s', lag, stack)
+            procedure_name = ''
+        else:
+            procedure_name = request.procedure_name or ''
+            LOGGER.warning('The event loop has been blocked for %.3fs by the %s call '
+                           '(marker %s)\n%s', lag, procedure_name, request.marker, stack)
+
+        # The metrics are updated only from the thread running the loop.
+        self._io_loop.add_callback(SLOW_CALLS.inc, labels=(procedure_name, ))
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            expected_at = HEARTBEAT.expected_at
+            if expected_at is None or expected_at == self._reported_at:
+                continue
+
+            lag = time.monotonic() - expected_at
+            if lag >= self.threshold:
+                self._reported_at = expected_at
+                self._report(lag)
+
+    #
+    # User visible methods
+    #
+
+    def start(self):
+        """Starts measuring the lag. """
+
+        self._thread_id = threading.get_ident()
+        HEARTBEAT.start(self._io_loop, self, self.interval)
+        self._thread = threading.Thread(target=self._watch, name='shirow-lag-watchdog',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops measuring the lag. """
+
+        self._stopped.set()
+        HEARTBEAT.stop(self)
+        self._thread.join()
+
 
 class Singleton(type):
     """Metaclass which helps to create singletons. """
@@ -33,16 +183,151 @@ class Singleton(type):
 
 class IOLoop(metaclass=Singleton):  # pylint: disable=too-few-public-methods
     """A singleton intended to create the event loop based on the AsyncIO Event
-    Loop.
+    Loop. The implementation of the loop is chosen by the --event_loop
+    option.
     """
 
     def __init__(self):
+        self._draining = False
         self._io_loop = None
+        self._server = None
+        self.worker_id = None
+        self.event_loop = install_event_loop_policy(options.event_loop)
+        AsyncIOMainLoop().install()
+
+    #
+    # Internal methods
+    #
+
+    async def _drain(self):
+        if self._draining:  # the second signal stops the server immediately
+            self._io_loop.stop()
+            return
+
+        self._draining = True
+        LOGGER.info('Draining %d call(s) over %d connection(s)', len(RUNNING_REQUESTS),
+                    len(RPCServer.connections))
+        self._server.stop()  # stop accepting new connections
+
+        # The connections are closed only when the calls in flight are over,
+        # since closing a connection cancels its calls.
+        deadline = self._io_loop.time() + options.drain_timeout
+        while RUNNING_REQUESTS and self._io_loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        for connection in list(RPCServer.connections):
+            connection.close(1001, 'the server is shutting down')  # Going Away
+
+        deadline = self._io_loop.time() + CLOSE_TIMEOUT
+        while RPCServer.connections and self._io_loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        await BROKER.stop()
+        # The workers of the pools exit once they finish the jobs at hand.
+        shutdown_executors(wait=False)
+        self._io_loop.stop()
+
+    def _fork_workers(self, workers):
+        """Forks the specified number of worker processes and supervises them,
+        restarting the crashed ones. Returns the id of the worker in the
+        children. The parent process exits when all the workers exit, with a
+        non-zero status if it gave up restarting them.
+        """
+
+        children = {}
+        stopping = False
+
+        def spawn(worker_id):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                return True
+
+            children[pid] = worker_id
+            return False
+
+        def stop(signum, _frame):
+            nonlocal stopping
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM if signum == signal.SIGINT else signum)
+
+        for worker_id in range(workers):
+            if spawn(worker_id):
+                return worker_id
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        gave_up = False
+        restarts = 0
+        while children:
+            pid, status = os.wait()
+            worker_id = children.pop(pid)
+            if stopping or os.waitstatus_to_exitcode(status) == 0:
+                continue
+
+            LOGGER.warning('Worker %d (pid %d) exited with status %d', worker_id, pid,
+                           os.waitstatus_to_exitcode(status))
+            restarts += 1
+            if restarts > options.max_restarts:
+                LOGGER.error('Too many restarts, giving up')
+                gave_up = True
+                stop(signal.SIGTERM, None)
+                continue
+
+            if spawn(worker_id):
+                return worker_id
+
+        sys.exit(1 if gave_up else 0)
+
+    def _handle_signal(self, _signum, _frame):
+        self._io_loop.add_callback_from_signal(self._drain)
+
+    @staticmethod
+    def _reinit_after_fork():
+        """Replaces the event loop inherited from the parent process, since
+        the underlying selector must not be shared between processes.
+        """
+
+        tornado.ioloop.IOLoop.current().close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
         AsyncIOMainLoop().install()
 
-    def start(self, app, port):
-        """Starts the event loop. """
+    #
+    # User visible methods
+    #
+
+    def start(self, app, port, workers=None):
+        """Starts the event loop. If the number of workers is greater than 1,
+        forks the worker processes first, each of which serves the
+        application. The number of workers is taken from the --workers option
+        unless specified.
+        """
+
+        if workers is None:
+            workers = options.workers
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+
+        if workers == 1:
+            self._server = app.listen(port)
+        else:
+            sockets = None if options.reuse_port else bind_sockets(port)
+            self.worker_id = self._fork_workers(workers)
+            self._reinit_after_fork()
+            if sockets is None:
+                sockets = bind_sockets(port, reuse_port=True)
+
+            self._server = HTTPServer(app)
+            self._server.add_sockets(sockets)
+
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        self._io_loop.add_callback(BROKER.start)
+        if options.loop_lag_threshold > 0:
+            LagWatchdog(self._io_loop, options.loop_lag_threshold).start()
 
-        app.listen(port)
-        self._io_loop = asyncio.get_event_loop()
-        self._io_loop.run_forever()
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        self._io_loop.start()
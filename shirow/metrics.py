@@ -0,0 +1,242 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the metrics Shirow collects about itself. The metrics
+are updated only from the thread running the event loop, so they don't need
+any locks. MetricsHandler exposes them in the Prometheus text format.
+"""
+
+import math
+from bisect import bisect_left
+
+from tornado.web import RequestHandler
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Metric:  # pylint: disable=too-few-public-methods
+    """Base class for metrics. """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def get(self, labels=()):
+        """Returns the current value for the specified label values. """
+
+        return self.values.get(labels, 0)
+
+
+class Counter(Metric):
+    """Monotonically increasing value, optionally partitioned by labels. """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """Increments the value for the specified label values. """
+
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value which can go up and down, optionally partitioned by labels. """
+
+    kind = 'gauge'
+
+    def inc(self, amount=1, labels=()):
+        """Increments the value for the specified label values. """
+
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        """Decrements the value for the specified label values. """
+
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value, labels=()):
+        """Sets the value for the specified label values. """
+
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values (such as latencies) counted in
+    buckets, optionally partitioned by labels. The value of a histogram is the
+    number of observations.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_values = {}
+        self.sums = {}
+
+    def get_buckets(self, labels=()):
+        """Returns the list of the (upper bound, cumulative count) pairs for
+        the specified label values. The last upper bound is infinity.
+        """
+
+        counts = self.bucket_values.get(labels, [0] * (len(self.buckets) + 1))
+        result, total = [], 0
+        for upper_bound, count in zip(self.buckets + (math.inf, ), counts):
+            total += count
+            result.append((upper_bound, total))
+
+        return result
+
+    def get_sum(self, labels=()):
+        """Returns the sum of the observed values for the specified label
+        values.
+        """
+
+        return self.sums.get(labels, 0)
+
+    def observe(self, value, labels=()):
+        """Records the specified value for the specified label values. """
+
+        counts = self.bucket_values.get(labels)
+        if counts is None:
+            counts = self.bucket_values[labels] = [0] * (len(self.buckets) + 1)
+
+        # The buckets are inclusive of their upper bounds.
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] = self.sums.get(labels, 0) + value
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+
+class Registry:
+    """Collection of metrics. """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def _register(self, metric_class, name, documentation, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_class(name, documentation, labelnames,
+                                                        **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f'{name} is already registered as a {metric.kind}')
+
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Returns the counter with the specified name, creating it if
+        necessary.
+        """
+
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Returns the gauge with the specified name, creating it if
+        necessary.
+        """
+
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def get(self, name):
+        """Returns the metric with the specified name or None. """
+
+        return self._metrics.get(name)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Returns the histogram with the specified name, creating it if
+        necessary.
+        """
+
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+REGISTRY = Registry()
+
+
+def _escape(value, quotes=True):
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(value)
+
+
+def format_text(registry=REGISTRY):
+    """Returns the metrics from the specified registry in the Prometheus text
+    format.
+    """
+
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {_escape(metric.documentation, quotes=False)}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        if isinstance(metric, Histogram):
+            for labels in sorted(metric.values, key=str):
+                for upper_bound, count in metric.get_buckets(labels):
+                    label_string = _format_labels(metric.labelnames, labels,
+                                                  [('le', _format_value(upper_bound))])
+                    lines.append(f'{metric.name}_bucket{label_string} {count}')
+
+                label_string = _format_labels(metric.labelnames, labels)
+                lines.append(f'{metric.name}_sum{label_string} '
+                             f'{_format_value(metric.get_sum(labels))}')
+                lines.append(f'{metric.name}_count{label_string} {metric.get(labels)}')
+        elif not metric.labelnames:
+            lines.append(f'{metric.name} {_format_value(metric.get())}')
+        else:
+            for labels in sorted(metric.values, key=str):
+                label_string = _format_labels(metric.labelnames, labels)
+                lines.append(f'{metric.name}{label_string} {_format_value(metric.values[labels])}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(RequestHandler):  # pylint: disable=abstract-method
+    """Request handler exposing the metrics in the Prometheus text format.
+    The registry can be passed as the registry argument of the handler (the
+    Shirow registry is used by default).
+    """
+
+    def initialize(self, registry=REGISTRY):  # pylint: disable=arguments-differ
+        """Sets the registry the metrics are taken from. """
+
+        self.registry = registry  # pylint: disable=attribute-defined-outside-init
+
+    def get(self, *_args, **_kwargs):
+        """Writes the metrics. """
+
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(format_text(self.registry))
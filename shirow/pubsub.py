@@ -0,0 +1,229 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the hub of the topics the calls of remote procedures
+can subscribe to. A value published to a topic is encoded once per codec and
+sent to all the subscribers as the results of their calls. The values
+published while the write buffer of a subscriber is full wait in its queue,
+which is bounded according to the slow-subscriber policy.
+"""
+
+import asyncio
+from collections import deque
+from functools import partial
+
+from tornado.options import define, options
+from tornado.websocket import WebSocketClosedError
+
+from shirow.codec import BinaryFrame
+from shirow.metrics import REGISTRY
+
+define('pubsub_max_pending',
+       help='the maximum number of published values waiting for the write '
+            'buffer of a slow subscriber to drain', default=1000, type=int)
+define('pubsub_policy',
+       help='what to do with a slow subscriber when its queue is full '
+            '(drop_oldest|coalesce_latest|disconnect)', default='drop_oldest',
+       type=str)
+
+# The close code sent to the slow subscribers which are disconnected.
+TRY_AGAIN_LATER = 1013
+
+POLICIES = ('coalesce_latest', 'disconnect', 'drop_oldest')
+
+DISCONNECTED_SUBSCRIBERS = REGISTRY.counter(
+    'shirow_disconnected_subscribers_total',
+    'Number of slow subscribers disconnected since their queues were full')
+DROPPED_VALUES = REGISTRY.counter(
+    'shirow_dropped_values_total',
+    'Number of published values dropped since the subscribers were slow',
+    ['policy'])
+PUBLISHED_VALUES = REGISTRY.counter(
+    'shirow_published_values_total',
+    'Number of values published to the topics')
+SUBSCRIPTIONS = REGISTRY.gauge(
+    'shirow_subscriptions',
+    'Number of subscriptions at the moment')
+
+
+class Subscription:
+    """Subscription of a call to a topic. The published values are sent to
+    the client right away unless the write buffer of the connection is full.
+    Otherwise, they wait in the queue, which is bounded according to the
+    policy.
+    """
+
+    # The subscription writes to the connection on behalf of the call, so it
+    # uses the internals of both.
+    # pylint: disable=protected-access
+
+    def __init__(self, topic, connection, request, policy, max_pending):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown slow-subscriber policy {policy}')
+
+        self.connection = connection
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.policy = policy
+        self.request = request
+        self.topic = topic
+
+        self._flush_task = None
+
+    #
+    # Internal methods
+    #
+
+    def _enqueue(self, encoded_value):
+        if self.policy == 'coalesce_latest':
+            if self.pending:
+                self.pending.clear()
+                DROPPED_VALUES.inc(labels=(self.policy, ))
+        elif len(self.pending) >= self.max_pending:
+            if self.policy == 'disconnect':
+                DISCONNECTED_SUBSCRIBERS.inc()
+                self.request.cancel()  # unsubscribes right away
+                self.connection.close(TRY_AGAIN_LATER, 'the subscriber is too slow')
+                return
+
+            self.pending.popleft()
+            DROPPED_VALUES.inc(labels=(self.policy, ))
+
+        self.pending.append(encoded_value)
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        try:
+            while self.pending:
+                await self.connection._drain()
+                self._write(self.pending.popleft())
+        except WebSocketClosedError:
+            pass  # the subscription is cancelled when the connection is closed
+        finally:
+            self._flush_task = None
+
+    def _write(self, encoded_value):
+        if isinstance(encoded_value, BinaryFrame):  # bytes over a text codec
+            response = self.request._get_binary_response(encoded_value, eod=False)
+        else:
+            response = self.request._get_embedded_response(encoded_value, eod=False)
+
+        self.request._respond(response)
+
+    #
+    # User visible methods
+    #
+
+    def cancel(self):
+        """Stops sending the published values to the client. """
+
+        self.pending.clear()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+
+    def deliver(self, encoded_value):
+        """Sends the specified value, which is encoded with the codec of the
+        connection, to the client or puts it into the queue if the subscriber
+        is slow.
+        """
+
+        if (self.pending or
+                self.connection._pending_write_bytes > options.write_high_water_mark):
+            self._enqueue(encoded_value)
+            return
+
+        try:
+            self._write(encoded_value)
+        except WebSocketClosedError:
+            pass
+
+
+class Hub:
+    """Collection of the topics and their subscribers. """
+
+    def __init__(self):
+        self._topics = {}
+
+    def get_subscribers_number(self, topic):
+        """Returns the number of the subscribers of the specified topic. """
+
+        return len(self._topics.get(topic, ()))
+
+    def publish(self, topic, value):
+        """Sends the specified value to the subscribers of the specified topic.
+        The value is encoded once per codec before it's sent to anyone, so if
+        a codec fails to encode it, the error is raised and none of the
+        subscribers get the value. Returns the number of the subscribers.
+        """
+
+        subscriptions = self._topics.get(topic)
+        if not subscriptions:
+            return 0
+
+        # pylint: disable=protected-access
+        codecs = {subscription.request._codec.name: subscription.request._codec
+                  for subscription in subscriptions}
+        encoded_values = {}
+        for name, codec in codecs.items():
+            # Like the results of the calls, bytes are sent in binary frames
+            # over the codecs which can't carry them.
+            if isinstance(value, bytes) and not codec.binary:
+                encoded_values[name] = BinaryFrame(value)
+            else:
+                encoded_values[name] = codec.encode_result(value)
+
+        PUBLISHED_VALUES.inc()
+        for subscription in list(subscriptions):
+            subscription.deliver(encoded_values[subscription.request._codec.name])
+
+        return len(subscriptions)
+
+    def subscribe(self, topic, connection, request, policy=None, max_pending=None):  # pylint: disable=too-many-arguments
+        """Subscribes the specified call made over the specified connection
+        (i.e. self in remote procedures) to the topic. The procedure may
+        return right after that, since the call stays in-flight until the
+        subscription is over. The subscription is cancelled when the call is over, i.e.
+        when the client cancels it or disconnects. The policy and the maximum
+        number of the values waiting for a slow subscriber default to
+        --pubsub_policy and --pubsub_max_pending. Returns the subscription.
+        """
+
+        subscription = Subscription(topic, connection, request,
+                                    policy or options.pubsub_policy,
+                                    options.pubsub_max_pending if max_pending is None
+                                    else max_pending)
+        # The subscriptions of a topic are kept in a dict to preserve their
+        # order.
+        self._topics.setdefault(topic, {})[subscription] = None
+        # The cancel callback also keeps the call in-flight after the
+        # procedure returns.
+        unsubscribe = partial(self.unsubscribe, subscription)
+        request.add_cancel_callback(unsubscribe)
+        request.add_done_callback(unsubscribe)
+        SUBSCRIPTIONS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Cancels the specified subscription. """
+
+        subscriptions = self._topics.get(subscription.topic, {})
+        if subscriptions.pop(subscription, False) is None:
+            SUBSCRIPTIONS.dec()
+            subscription.cancel()
+            if not subscriptions:
+                del self._topics[subscription.topic]
+
+
+HUB = Hub()
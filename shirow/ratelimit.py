@@ -0,0 +1,174 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the rate limits of the users of RPC servers. The
+limits are implemented as token buckets. A bucket holds up to burst tokens and
+is refilled at rate tokens per second, while each connection or call takes a
+token. The state of the buckets is kept by a backend. The default one keeps it
+in memory, so the limits apply per process. Backends shared by several
+processes or hosts make the limits apply to all of them.
+"""
+
+import math
+import time
+
+from tornado.options import define, options
+
+from shirow.cache import LRUCache
+from shirow.metrics import REGISTRY
+
+define('rate_limit_calls',
+       help='the number of calls per second each user may make (0 means no '
+            'limit)', default=0.0, type=float)
+define('rate_limit_calls_burst',
+       help='the number of calls each user may make at once (defaults to '
+            '--rate_limit_calls)', default=0, type=int)
+define('rate_limit_handshakes',
+       help='the number of connections per second each user may open (0 '
+            'means no limit)', default=0.0, type=float)
+define('rate_limit_handshakes_burst',
+       help='the number of connections each user may open at once (defaults '
+            'to --rate_limit_handshakes)', default=0, type=int)
+define('rate_limit_max_buckets',
+       help='the maximum number of token buckets kept in memory; the least '
+            'recently used ones are evicted', default=100000, type=int)
+
+RATE_LIMITED = REGISTRY.counter(
+    'shirow_rate_limited_total',
+    'Number of connections and calls rejected since their users exceeded the '
+    'rate limits',
+    ['kind'])
+
+
+class RateLimitBackend:  # pylint: disable=too-few-public-methods
+    """Base class for the backends keeping the state of token buckets. """
+
+    # Whether the state is kept in the process. The local backends implement
+    # consume_now, which takes the tokens without waiting.
+    local = False
+
+    async def consume(self, buckets):
+        """Takes a token from each of the buckets specified as (key, rate,
+        burst) tuples if every one of them has a token. Returns True if so.
+        Otherwise, takes no tokens and returns False.
+        """
+
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    """Backend keeping the state of token buckets in memory. A bucket is
+    dropped as soon as it is full again, since a full bucket is no different
+    from a new one.
+    """
+
+    local = True
+
+    def __init__(self, max_buckets=None, clock=time.monotonic):
+        if max_buckets is None:
+            max_buckets = options.rate_limit_max_buckets
+
+        self._buckets = LRUCache(max_buckets, clock)
+        self._clock = clock
+
+    async def consume(self, buckets):
+        return self.consume_now(buckets)
+
+    def consume_now(self, buckets):
+        """Same as consume, but without waiting. """
+
+        now = self._clock()
+        updates = []
+        for key, rate, burst in buckets:
+            state = self._buckets.get(key)
+            if state is None:
+                tokens = burst
+            else:
+                tokens, updated_at = state
+                tokens = min(tokens + (now - updated_at) * rate, burst)
+
+            if tokens < 1:
+                return False
+
+            updates.append((key, tokens - 1, rate, burst))
+
+        for key, tokens, rate, burst in updates:
+            self._buckets.put(key, (tokens, now), now + (burst - tokens) / rate)
+
+        return True
+
+
+class RateLimiter:
+    """Applies the rate limits keeping the state of the buckets in the
+    backend. Unless the backend is set, MemoryBackend is created on first use.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    #
+    # Internal methods
+    #
+
+    def _get_backend(self):
+        if self.backend is None:
+            self.backend = MemoryBackend()
+
+        return self.backend
+
+    @staticmethod
+    def _count(kind, consumed):
+        if not consumed:
+            RATE_LIMITED.inc(labels=(kind, ))
+
+        return consumed
+
+    @staticmethod
+    def _normalize(buckets):
+        return [(key, rate, burst or math.ceil(rate)) for key, rate, burst in buckets]
+
+    #
+    # User visible methods
+    #
+
+    @property
+    def is_local(self):
+        """Whether the backend keeps the state in the process, so
+        consume_now can be used.
+        """
+
+        return self._get_backend().local
+
+    async def consume(self, kind, buckets):
+        """Takes a token from each of the buckets specified as (key, rate,
+        burst) tuples, if every one of them has a token. A bucket is refilled
+        at the specified rate and holds up to burst tokens (the rate rounded
+        up if burst is 0). Returns True if there were tokens. Otherwise, takes
+        no tokens, counts the rejection of the connection or call (see kind)
+        and returns False.
+        """
+
+        backend = self._get_backend()
+        return self._count(kind, await backend.consume(self._normalize(buckets)))
+
+    def consume_now(self, kind, buckets):
+        """Same as consume, but without waiting. Can be used only if the
+        backend is local (see is_local).
+        """
+
+        backend = self._get_backend()
+        return self._count(kind, backend.consume_now(self._normalize(buckets)))
+
+
+RATE_LIMITER = RateLimiter()
@@ -19,7 +19,14 @@ necessary to allow the remote procedure to "find" its client when returning the
 result.
 """
 
-from tornado.escape import json_encode
+import time
+
+from shirow import streams
+from shirow.codec import BinaryFrame, RawJSON, get_codec
+
+# The requests of the calls running in the tasks at the moment, keyed on the
+# tasks. It lets the watchdog of the event loop tell which call blocks the loop.
+RUNNING_REQUESTS = {}
 
 
 class Ret(Exception):
@@ -32,54 +39,246 @@ class Ret(Exception):
         self.value = value
 
 
-class Request:
+class Request:  # pylint: disable=too-many-instance-attributes
     """Base class for requests.
 
     The instance of the class is passed as the first argument to a remote
     procedure before invoking it.
     """
 
-    def __init__(self, marker, callback):
+    def __init__(self, marker, callback, codec=None, drain=None, deadline=None, *,  # pylint: disable=too-many-arguments
+                 procedure_name=None):
         self._callback = callback
+        self._cancel_callbacks = []
+        self._codec = codec or get_codec('stdlib')
+        self._deadline = deadline
+        self._done_callbacks = []
+        self._drain = drain
         self._marker = marker
+        self._templates = {}
+
+        self.cancelled = False
+        self.done = False
+        self.procedure_name = procedure_name
 
     #
     # Internal methods
     #
-    def _get_error_response(self, message):
+    def _get_error_response(self, message, code=None):
         response = {
             'error': message,
             'marker': self._marker,
         }
-        return json_encode(response)
+        if code is not None:
+            response['code'] = code
+        return self._codec.encode(response)
+
+    def _get_end_response(self):
+        response = {
+            'eod': 1,
+            'marker': self._marker,
+        }
+        return self._codec.encode(response)
+
+    def _get_binary_response(self, payload, eod=True):
+        header = self._codec.encode({
+            'eod': 1 if eod else 0,
+            'marker': self._marker,
+        })
+        return BinaryFrame(len(header).to_bytes(4, 'big') + header + payload)
+
+    def _get_embedded_response(self, encoded_result, eod=True):
+        # The envelope with the marker is encoded once per call, so the
+        # responses come down to concatenating bytes.
+        template = self._templates.get(eod)
+        if template is None:
+            response = {
+                'eod': 1 if eod else 0,
+                'marker': self._marker,
+            }
+            template = self._templates[eod] = self._codec.get_embedding_template(response,
+                                                                                'result')
+        prefix, suffix = template
+        return prefix + encoded_result + suffix
 
     def _get_successful_response(self, result, eod=True):
+        if isinstance(result, RawJSON):
+            return self._get_embedded_response(self._codec.encode_result(result), eod)
+
+        # JSON can't carry bytes, so they are sent in binary frames.
+        if isinstance(result, bytes) and not self._codec.binary:
+            return self._get_binary_response(result, eod)
+
         response = {
             'eod': 1 if eod else 0,
             'marker': self._marker,
             'result': result,
         }
-        return json_encode(response)
+        return self._codec.encode(response)
+
+    def _finish(self):
+        if self.done:
+            return
+
+        self.done = True
+        for callback in self._done_callbacks:
+            callback()
+
+    def _respond(self, response):
+        # The client is not interested in the responses to cancelled calls.
+        if not self.cancelled:
+            self._callback(response)
+
+    def _send_end(self):
+        self._respond(self._get_end_response())
+
+    def _send_error(self, message, code=None):
+        self._respond(self._get_error_response(message, code))
+
+    def _send_result(self, value, eod=True):
+        self._respond(self._get_successful_response(value, eod))
 
     #
     # User visible methods
     #
+    @property
+    def has_cancel_callbacks(self):
+        """Whether the call has cleanup to do when it is cancelled. """
+        return bool(self._cancel_callbacks)
+
+    @property
+    def marker(self):
+        """The marker the client associated the call with. """
+        return self._marker
+
+    def add_cancel_callback(self, callback):
+        """Registers the callback to be invoked when the call is cancelled
+        either by the client or because the client disconnected. Procedures
+        which keep responding after they return (for example, from the
+        handlers registered with io_loop.add_handler) must release their
+        resources in such callbacks.
+        """
+        self._cancel_callbacks.append(callback)
+
+    def add_done_callback(self, callback):
+        """Registers the callback to be invoked when the call is over, i.e.
+        when the last response is sent or the call is cancelled.
+        """
+        self._done_callbacks.append(callback)
+
+    def cancel(self, message=None, code=None):
+        """Cancels the call. The cancel callbacks are invoked and the responses
+        are not sent to the client anymore. If the message is specified, the
+        client is informed that the call failed with the error.
+        """
+        if self.cancelled or self.done:
+            return
+
+        if message is not None:
+            self._callback(self._get_error_response(message, code))
+
+        self.cancelled = True
+        for callback in self._cancel_callbacks:
+            callback()
+
+        self._finish()
+
+    def complete(self, value):
+        """Returns the specified value to the RPC client as the last one. Unlike
+        ret, the method doesn't raise an exception, so it's cheaper, but doesn't
+        cause the procedure to exit. Returning a value from a procedure comes
+        down to the method.
+        """
+        self._send_result(value)
+        self._finish()
+
+    def complete_encoded(self, encoded_value):
+        """Same as complete, but the value is already encoded with the codec of
+        the connection (for example, it's taken from a cache).
+        """
+        self._respond(self._get_embedded_response(encoded_value))
+        self._finish()
+
+    def end(self):
+        """Informs the RPC client that the procedure has returned all the
+        values. Unlike complete, the last response carries no value. The end of
+        an async generator procedure comes down to the method.
+        """
+        self._send_end()
+        self._finish()
+
+    def fail(self, message, code=None):
+        """Same as ret_error, but doesn't raise an exception, so it doesn't
+        cause the procedure to exit.
+        """
+        self._send_error(message, code)
+        self._finish()
+
+    def time_remaining(self):
+        """Returns the number of seconds left before the call times out or
+        None if the call has no deadline. Procedures may pass it on to the
+        downstream I/O.
+        """
+        if self._deadline is None:
+            return None
+
+        return max(self._deadline - time.monotonic(), 0)
+
     def ret(self, value):
         """Causes a remote procedure to exit and return the specified value to
         the RPC client. The return statement can be used instead.
         """
-        self._callback(self._get_successful_response(value))
+        self._send_result(value)
+        self._finish()
+        raise Ret(value)
+
+    def ret_encoded(self, encoded_value):
+        """Same as ret, but the value is already encoded with the codec of the
+        connection (for example, it's taken from a cache).
+        """
+        self._respond(self._get_embedded_response(encoded_value))
+        self._finish()
         raise Ret()
 
     def ret_and_continue(self, value):
         """Causes a remote procedure to return the specified value to the RPC
         client. Unlike ret, the method doesn't cause the procedure to exit.
         """
-        self._callback(self._get_successful_response(value, False))
+        self._send_result(value, False)
+
+    async def send(self, value):
+        """Returns the specified value to the RPC client the same way as
+        ret_and_continue does. If too much data is buffered for the client,
+        waits until the buffer drains. Producers streaming a lot of data should
+        prefer the method to ret_and_continue.
+        """
+        self.ret_and_continue(value)
+        if self._drain is not None:
+            await self._drain()
+
+    async def stream_fd(self, fd, *, encoding='utf-8', lines=False, window=None,
+                        max_bytes=None):
+        """Streams the output read from the file descriptor (for example, the
+        master side of a pty) to the RPC client in coalesced chunks until the
+        end of file, then ends the call. See shirow.streams.stream_fd.
+        """
+        await streams.stream_fd(self, fd, encoding=encoding, lines=lines, window=window,
+                               max_bytes=max_bytes)
+
+    async def stream_subprocess(self, process, *, encoding='utf-8', lines=False, window=None,
+                                max_bytes=None):
+        """Streams the standard output of the asyncio subprocess to the RPC
+        client in coalesced chunks and completes the call with its exit code.
+        See shirow.streams.stream_subprocess.
+        """
+        await streams.stream_subprocess(self, process, encoding=encoding, lines=lines,
+                                       window=window, max_bytes=max_bytes)
 
-    def ret_error(self, message):
+    def ret_error(self, message, code=None):
         """Causes a remote procedure to exit and inform the the client that an
-        error occurred.
+        error occurred. The optional code lets the client tell the errors
+        reported by Shirow itself (such as busy) from each other.
         """
-        self._callback(self._get_error_response(message))
+        self._send_error(message, code)
+        self._finish()
         raise Ret()
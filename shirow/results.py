@@ -0,0 +1,104 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the caches of the results of remote procedures. The
+results are cached encoded, so a hit costs neither calling the procedure nor
+encoding its result.
+"""
+
+from shirow.cache import LRUCache
+from shirow.metrics import REGISTRY
+from shirow.util import canonicalize
+
+HITS = REGISTRY.counter('shirow_result_cache_hits_total',
+                        'Number of calls answered from the cache of results',
+                        ['procedure'])
+MISSES = REGISTRY.counter('shirow_result_cache_misses_total',
+                          'Number of calls the results of which were not cached',
+                          ['procedure'])
+
+_CACHES = []
+
+
+class ResultCache(LRUCache):
+    """Cache of the encoded results of a remote procedure. The results are
+    keyed on the arguments of the calls and, if per_user is true, on the
+    users who made the calls.
+    """
+
+    def __init__(self, procedure, ttl, max_entries, per_user=False):
+        super().__init__(max_entries)
+
+        self.per_user = per_user
+        self.procedure = procedure
+        self.ttl = ttl
+
+        _CACHES.append(self)
+
+    @property
+    def hit_rate(self):
+        """The share of the calls answered from the cache. """
+
+        hits = HITS.get((self.procedure, ))
+        total = hits + MISSES.get((self.procedure, ))
+        return hits / total if total else 0.0
+
+    def get_key(self, codec_name, user_id, arguments):
+        """Returns the key for the results of the call with the specified
+        arguments encoded with the specified codec.
+        """
+
+        user_id = user_id if self.per_user else None
+        return (codec_name, user_id) + tuple(canonicalize(argument) for argument in arguments)
+
+    def get_result(self, key):
+        """Returns the encoded result for the specified key or None. """
+
+        encoded_result = self.get(key)
+        if encoded_result is None:
+            MISSES.inc(labels=(self.procedure, ))
+        else:
+            HITS.inc(labels=(self.procedure, ))
+
+        return encoded_result
+
+    def invalidate(self, prefix=(), user_id=None):
+        """Removes the results of the calls the arguments of which start with
+        the specified ones (all the results by default) and returns their
+        number. If user_id is specified, only the results of the user are
+        removed.
+        """
+
+        prefix = tuple(canonicalize(argument) for argument in prefix)
+
+        def matches(key, _value):
+            return (key[2:2 + len(prefix)] == prefix and
+                    (user_id is None or key[1] == user_id))
+
+        return self.remove_if(matches)
+
+    def put_result(self, key, encoded_result):
+        """Puts the encoded result into the cache for ttl seconds. """
+
+        self.put(key, encoded_result, self._clock() + self.ttl)
+
+
+def invalidate(procedure=None, prefix=(), user_id=None):
+    """Removes the cached results of the specified procedure (of all the
+    procedures by default). See ResultCache.invalidate for the other arguments.
+    Returns the number of the removed results.
+    """
+
+    return sum(cache.invalidate(prefix, user_id) for cache in _CACHES
+               if procedure is None or cache.procedure == procedure)
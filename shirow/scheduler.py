@@ -0,0 +1,189 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the scheduler of remote procedure calls. The scheduler
+limits the number of calls running at the same time per connection, per user
+and per process. The calls exceeding the limits wait in per-connection queues,
+which are served round-robin, so a client firing a lot of calls can't starve
+the other clients.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+
+from tornado.options import define, options
+
+from shirow.metrics import REGISTRY
+
+define('max_calls',
+       help='the maximum number of calls running at the same time in the '
+            'process (0 means no limit)', default=0, type=int)
+define('max_calls_per_connection',
+       help='the maximum number of calls running at the same time per '
+            'connection (0 means no limit)', default=16, type=int)
+define('max_calls_per_user',
+       help='the maximum number of calls running at the same time per user '
+            '(0 means no limit)', default=0, type=int)
+define('max_queued_calls_per_connection',
+       help='the maximum number of calls waiting for their turn per '
+            'connection; the calls exceeding the limit are rejected as busy',
+       default=1000, type=int)
+
+BUSY_CALLS = REGISTRY.counter(
+    'shirow_busy_calls_total',
+    'Number of calls rejected since the queue of their connection was full')
+CALLS_IN_FLIGHT = REGISTRY.gauge(
+    'shirow_calls_in_flight',
+    'Number of calls running at the moment')
+QUEUED_CALLS = REGISTRY.gauge(
+    'shirow_queued_calls',
+    'Number of calls waiting for their turn at the moment')
+QUEUED_CALLS_TOTAL = REGISTRY.counter(
+    'shirow_queued_calls_total',
+    'Number of calls which had to wait for their turn')
+QUEUE_WAIT_SECONDS = REGISTRY.counter(
+    'shirow_queue_wait_seconds_total',
+    'Total time the calls spent waiting for their turn')
+
+
+def _is_within(limit, value):
+    return limit <= 0 or value < limit
+
+
+class Scheduler:
+    """Runs remote procedure calls within the limits on the number of calls
+    running at the same time. The calls exceeding the limits are queued. The
+    calls with a higher priority go first, while the calls with the same
+    priority are taken from the queues of the connections in turn.
+    """
+
+    def __init__(self):
+        self._in_flight = 0
+        self._in_flight_by_connection = {}
+        self._in_flight_by_user = {}
+        self._queues = OrderedDict()
+        self._sequence = itertools.count()
+        self._tasks = set()
+
+    #
+    # Internal methods
+    #
+
+    def _can_run(self, connection, user_id):
+        return (_is_within(options.max_calls, self._in_flight) and
+                _is_within(options.max_calls_per_connection,
+                           self._in_flight_by_connection.get(connection, 0)) and
+                _is_within(options.max_calls_per_user,
+                           self._in_flight_by_user.get(user_id, 0)))
+
+    def _dispatch(self):
+        while True:
+            picked, picked_priority = None, None
+            # The connection served last is moved to the end, so the
+            # connections with the calls of the same priority are served in
+            # turn.
+            for connection, queue in self._queues.items():
+                priority, _, _, user_id, _ = queue[0]
+                if picked is not None and priority >= picked_priority:
+                    continue
+
+                if self._can_run(connection, user_id):
+                    picked, picked_priority = connection, priority
+
+            if picked is None:
+                return
+
+            queue = self._queues[picked]
+            _, _, enqueued_at, user_id, run = heapq.heappop(queue)
+            if queue:
+                self._queues.move_to_end(picked)
+            else:
+                del self._queues[picked]
+
+            QUEUED_CALLS.dec()
+            QUEUE_WAIT_SECONDS.inc(time.monotonic() - enqueued_at)
+            self._start(picked, user_id, run)
+
+    async def _run(self, connection, user_id, run):
+        try:
+            await run()
+        finally:
+            self._in_flight -= 1
+            self._in_flight_by_connection[connection] -= 1
+            if not self._in_flight_by_connection[connection]:
+                del self._in_flight_by_connection[connection]
+            self._in_flight_by_user[user_id] -= 1
+            if not self._in_flight_by_user[user_id]:
+                del self._in_flight_by_user[user_id]
+            CALLS_IN_FLIGHT.dec()
+
+            self._dispatch()
+
+    def _start(self, connection, user_id, run):
+        self._in_flight += 1
+        self._in_flight_by_connection[connection] = \
+            self._in_flight_by_connection.get(connection, 0) + 1
+        self._in_flight_by_user[user_id] = self._in_flight_by_user.get(user_id, 0) + 1
+        CALLS_IN_FLIGHT.inc()
+
+        task = asyncio.ensure_future(self._run(connection, user_id, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    #
+    # User visible methods
+    #
+
+    def discard(self, connection):
+        """Drops the calls of the specified connection waiting for their turn.
+        The calls which are already running are not affected.
+        """
+
+        queue = self._queues.pop(connection, [])
+        QUEUED_CALLS.dec(len(queue))
+
+    def get_queue_depth(self, connection):
+        """Returns the number of calls of the specified connection waiting for
+        their turn.
+        """
+
+        return len(self._queues.get(connection, ()))
+
+    def submit(self, connection, user_id, priority, run):
+        """Runs the specified coroutine function as soon as the limits allow.
+        Returns False if the queue of the connection is full and the call was
+        rejected, else True.
+        """
+
+        if connection not in self._queues and self._can_run(connection, user_id):
+            self._start(connection, user_id, run)
+            return True
+
+        queue = self._queues.setdefault(connection, [])
+        if len(queue) >= options.max_queued_calls_per_connection:
+            if not queue:
+                del self._queues[connection]
+            BUSY_CALLS.inc()
+            return False
+
+        heapq.heappush(queue, (-priority, next(self._sequence), time.monotonic(), user_id, run))
+        QUEUED_CALLS.inc()
+        QUEUED_CALLS_TOTAL.inc()
+        return True
+
+
+SCHEDULER = Scheduler()
@@ -16,49 +16,193 @@
 simplify creating microservices using Tornado.
 """
 
+import asyncio
+import inspect
 import logging
-from functools import wraps
+import time
+from collections import namedtuple
+from functools import partial, wraps
+from types import MappingProxyType, MethodType
 
 import jwt
 import jwt.exceptions
 from jwt.exceptions import DecodeError, ExpiredSignatureError
-from tornado.escape import json_decode
 from tornado.ioloop import IOLoop
 from tornado.options import define, options
-from tornado.websocket import WebSocketHandler
-
-from shirow.exceptions import CouldNotDecodeToken, UndefinedMethod
-from shirow.request import Ret, Request
-from shirow.util import check_number_of_args
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+
+from shirow.admission import ADMISSION
+from shirow.codec import BinaryFrame, MsgPackCodec, get_codec
+from shirow.exceptions import CouldNotDecodeToken, TooManyPendingVerifications, UndefinedMethod
+from shirow.executors import EXECUTOR_CLASSES, call_by_name, get_executor, get_pool_workers
+from shirow.flights import join_flight
+from shirow.metrics import REGISTRY
+from shirow.ratelimit import RATE_LIMITER
+from shirow.request import RUNNING_REQUESTS, Ret, Request
+from shirow.results import ResultCache
+from shirow.scheduler import SCHEDULER
+from shirow.tokens import TOKEN_CACHE
+from shirow.util import canonicalize, check_number_of_args, split_into_chunks
 
 MOCK_TOKEN = 'mock_token'
 MOCK_USER_ID = 1
+MSGPACK_SUBPROTOCOL = 'shirow.msgpack'
+RETRY_AFTER = 1  # seconds
 TOKEN_PATTERN = r'([_\-\w\.]+)'
 
+BYTES_RECEIVED = REGISTRY.counter(
+    'shirow_received_bytes_total',
+    'Number of bytes received in the frames from clients')
+BYTES_SENT = REGISTRY.counter(
+    'shirow_sent_bytes_total',
+    'Number of bytes sent in the frames to clients')
+CALLS = REGISTRY.counter(
+    'shirow_calls_total',
+    'Number of calls of remote procedures',
+    ['procedure'])
+CALL_DURATION = REGISTRY.histogram(
+    'shirow_call_duration_seconds',
+    'Time remote procedures took to return',
+    ['procedure'])
+# The calls of undefined procedures are counted with an empty procedure label,
+# since the names come from clients.
+CALL_ERRORS = REGISTRY.counter(
+    'shirow_call_errors_total',
+    'Number of calls failed since the procedure was undefined (undefined), '
+    'the number of arguments mismatched (arity) or the procedure raised an '
+    'exception (exception)',
+    ['procedure', 'reason'])
+FRAMES_RECEIVED = REGISTRY.counter(
+    'shirow_received_frames_total',
+    'Number of frames received from clients')
+FRAMES_SENT = REGISTRY.counter(
+    'shirow_sent_frames_total',
+    'Number of frames sent to clients')
+HANDSHAKE_FAILURES = REGISTRY.counter(
+    'shirow_handshake_failures_total',
+    'Number of connection requests rejected during the handshake',
+    ['reason'])
+OPEN_CONNECTIONS = REGISTRY.gauge(
+    'shirow_open_connections',
+    'Number of connections open at the moment')
+PENDING_TOKEN_VERIFICATIONS = REGISTRY.gauge(
+    'shirow_pending_token_verifications',
+    'Number of tokens waiting for verification in the executor')
+THROTTLED_WRITES = REGISTRY.counter(
+    'shirow_throttled_writes_total',
+    'Number of times remote procedures waited for the write buffer to drain')
+THROTTLED_SECONDS = REGISTRY.counter(
+    'shirow_throttled_seconds_total',
+    'Total time remote procedures spent waiting for the write buffer to drain')
+
+RemoteProcedure = namedtuple('RemoteProcedure',
+                             ['name', 'function', 'arguments_range', 'options'])
+
 define('allow_mock_token',
        help=f"allow using '{MOCK_TOKEN}' instead of real token (for testing "
             f"purposes only)", default=False, type=bool)
+define('call_timeout',
+       help='the time (in seconds) after which the calls of the procedures '
+            'not specifying their own timeout are cancelled (0 means no '
+            'timeout)', default=0, type=float)
+define('coalesce_max_bytes',
+       help='send the coalesced responses as soon as their total size '
+            'reaches the specified number of bytes', default=64 * 1024, type=int)
+define('coalesce_window',
+       help='the time window (in milliseconds) during which the responses are '
+            'coalesced; 0 means a single event loop iteration', default=0,
+       type=float)
 define('config_file',
        help='load parameters from the specified configuration '
             'file', default='shirow.conf')
+define('max_chunk_bytes',
+       help='split the strings and bytes async generator procedures yield into '
+            'the chunks of the specified size in bytes, splitting the strings '
+            'on character boundaries (0 means no limit)', default=0, type=int)
+define('max_pending_token_verifications',
+       help='the maximum number of tokens waiting for verification in the '
+            'executor; the handshakes exceeding the limit are rejected',
+       default=1000, type=int)
 define('port',
        help='listen on a specific port', default=8888)
 define('token_algorithm',
        help='specify the algorithm used to sign the token', default='HS256')
 define('token_key',
        help='encrypt the token using the specified secret key', default=None)
-
-
-def remote(func):
+define('token_verification_executor',
+       help='verify tokens in a thread or process pool instead of the event '
+            'loop (none|thread|process); makes sense for asymmetric '
+            'algorithms such as RS256', default='none')
+define('token_verification_workers',
+       help='the number of workers verifying tokens (defaults to the number '
+            'of processors)', default=None, type=int)
+define('write_high_water_mark',
+       help='the number of bytes buffered for a connection after which '
+            'Request.send waits for the buffer to drain', default=1024 * 1024,
+       type=int)
+
+
+def remote(func=None, *, cache_max_entries=1024, cache_ttl=None, coalesce=False,  # pylint: disable=too-many-arguments,too-many-locals
+           executor=None, max_chunk_bytes=None, per_user=False, pool='default', priority=0,
+           rate_limit=None, rate_limit_burst=0, single_flight=False, timeout=None):
     """Decorator to mark some of the methods of RPC servers as remote. The
     decorated methods can be considered as a part of the public interface,
     since they are accessible from the client side.
+
+    The decorated methods are either coroutines or async generators. The
+    values an async generator yields are sent to the client as they are
+    produced, and the end of the generator ends the call.
+
+    The decorator can be used both with and without arguments. The arguments
+    are the following:
+    * cache_ttl: cache the results of the procedure for the specified number
+      of seconds (see shirow.results); the calls with the same arguments are
+      answered from the cache without calling the procedure;
+    * cache_max_entries: the maximum number of cached results;
+    * coalesce: send the responses produced by the procedure during the
+      coalescing window (see --coalesce_window) as a single frame;
+    * executor: run the procedure in a thread or process pool (thread or
+      process). Such a procedure must be a regular function (preferably, a
+      staticmethod) which receives only the arguments of the call. Its return
+      value is sent to the client as if it was passed to ret, and its
+      exceptions are reported as if ret_error was called;
+    * per_user: whether the results are cached and the flights (see
+      single_flight) are shared per user;
+    * max_chunk_bytes: split the strings and bytes an async generator yields
+      into the chunks of the specified size in bytes (UTF-8 for strings,
+      which are split on character boundaries; overrides --max_chunk_bytes);
+    * pool: the name of the pool the procedure runs in (see --pool_workers);
+    * priority: the calls of the procedures with a higher priority are taken
+      from the queue first when the limits on the number of calls running at
+      the same time are reached;
+    * rate_limit: the number of calls of the procedure per second each user
+      may make (in addition to --rate_limit_calls);
+    * rate_limit_burst: the number of calls of the procedure each user may
+      make at once (defaults to rate_limit);
+    * single_flight: the concurrent calls with the same arguments share a
+      single execution of the procedure (see shirow.flights);
+    * timeout: the time (in seconds) after which the calls of the procedure
+      are cancelled (overrides --call_timeout). Clients may ask for a shorter
+      timeout.
     """
 
-    @wraps(func)
-    async def wrapper(self, *args, **kwargs):
-        args += tuple(kwargs.values())
-        return await func(self, *args)
+    if func is None:
+        return partial(remote, cache_max_entries=cache_max_entries, cache_ttl=cache_ttl,
+                       coalesce=coalesce, executor=executor, max_chunk_bytes=max_chunk_bytes,
+                       per_user=per_user, pool=pool, priority=priority, rate_limit=rate_limit,
+                       rate_limit_burst=rate_limit_burst, single_flight=single_flight,
+                       timeout=timeout)
+
+    if executor is not None:
+        wrapper = _run_in_executor(func, executor, pool)
+        func = wrapper.__wrapped__
+    elif inspect.isasyncgenfunction(func):
+        wrapper = _stream_values(func, max_chunk_bytes)
+    else:
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            args += tuple(kwargs.values())
+            return await func(self, *args)
 
     try:
         defaults_number = len(func.__defaults__)
@@ -67,110 +211,507 @@ def remote(func):
         defaults_number = 0
 
     arguments_number = func.__code__.co_argcount
+    if executor is not None:  # self and request are not passed to the function
+        arguments_number += 2
     wrapper.arguments_range = (
         arguments_number - defaults_number,  # min
         arguments_number  # max
     )
     wrapper.remote = True
+    wrapper.remote_options = MappingProxyType({
+        'cache': (None if cache_ttl is None else
+                  ResultCache(func.__name__, cache_ttl, cache_max_entries, per_user)),
+        'coalesce': coalesce,
+        'per_user': per_user,
+        'priority': priority,
+        'rate_limit': None if rate_limit is None else (rate_limit, rate_limit_burst),
+        'single_flight': single_flight,
+        'timeout': timeout,
+    })
+
+    return wrapper
+
+
+def _run_in_executor(func, executor, pool):
+    if executor not in EXECUTOR_CLASSES:
+        raise ValueError(f'unknown executor kind {executor}')
+
+    if isinstance(func, staticmethod):
+        func = func.__func__
+
+    if asyncio.iscoroutinefunction(func):
+        raise ValueError(f'{func.__name__} must be a regular function to run in an executor')
+
+    @wraps(func)
+    async def wrapper(self, request, *args, **kwargs):
+        args += tuple(kwargs.values())
+        if executor == 'process':
+            call = partial(call_by_name, func.__module__, func.__qualname__, args)
+        else:
+            call = partial(func, *args)
+
+        result = await self.io_loop.run_in_executor(
+            get_executor(executor, pool, get_pool_workers(pool)), call)
+        request.complete(result)
+
+    return wrapper
+
+
+def _stream_values(func, max_chunk_bytes):
+    @wraps(func)
+    async def wrapper(self, request, *args, **kwargs):
+        args += tuple(kwargs.values())
+        chunk_size = options.max_chunk_bytes if max_chunk_bytes is None else max_chunk_bytes
+        async for value in func(self, request, *args):
+            if chunk_size > 0:
+                for chunk in split_into_chunks(value, chunk_size):
+                    await request.send(chunk)
+            else:
+                await request.send(value)
+
+        request.end()
 
     return wrapper
 
 
-class RPCServer(WebSocketHandler):  # pylint: disable=abstract-method
+class RPCServer(WebSocketHandler):  # pylint: disable=abstract-method,too-many-instance-attributes
     """Base class for RPC servers. """
 
+    # The connections open in the process.
+    connections = set()
+
+    # Whether the responses produced during the coalescing window are sent as
+    # a single frame regardless of the remote procedures options.
+    coalesce_responses = False
+
+    # The registry of the remote procedures available in the class. It's
+    # built once, when the class is created, so dispatching an incoming call
+    # boils down to a single dict lookup.
+    remote_procedures = MappingProxyType({})
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        procedures = {}
+        for name in dir(cls):
+            attr = getattr(cls, name, None)
+            if getattr(attr, 'remote', False):
+                procedures[name] = RemoteProcedure(name, attr, attr.arguments_range,
+                                                   attr.remote_options)
+
+        cls.remote_procedures = MappingProxyType(procedures)
+
     def __init__(self, application, request, **kwargs):
         WebSocketHandler.__init__(self, application, request, **kwargs)
 
+        self.codec = get_codec(options.json_codec)
         self.io_loop = IOLoop.current()
         self.logger = logging.getLogger('tornado.application')
         self.user_id = None
 
+        ADMISSION.start(self.io_loop)
+
+        self._call_tasks = {}
+        self._calls = {}
+        self._last_write_future = None
+        self._outbox = []
+        self._outbox_bytes = 0
+        self._outbox_flush_scheduled = False
+        self._outbox_timeout = None
+        self._pending_write_bytes = 0
+        self._rate_limit_tasks = set()
+
     #
     # Internal methods.
     #
 
+    def _cancel_call(self, marker, message=None, code=None):
+        request = self._calls.pop(marker, None)
+        if request is None:  # the call is over already
+            return
+
+        request.cancel(message, code)
+        task = self._call_tasks.pop(marker, None)
+        if task is not None:
+            task.cancel()
+
+    def _forget_call(self, request):
+        if self._calls.get(request.marker) is request:
+            del self._calls[request.marker]
+
+    def _handle_call(self, call, batched=False):
+        if 'cancel' in call:
+            self._cancel_call(call['cancel'])
+            return
+
+        procedure = self.remote_procedures.get(call['function_name'])
+        coalesce = (batched or self.coalesce_responses or
+                    (procedure is not None and procedure.options['coalesce']))
+
+        # The time spent waiting in the queue counts towards the timeout.
+        timeout = self._get_timeout(procedure, call.get('timeout'))
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        callback = self._queue_response if coalesce else self._write_response
+        request = Request(call['marker'], callback, self.codec, self._drain, deadline,
+                          procedure_name=call['function_name'])
+        # Shedding the new calls when the server is overloaded must be as
+        # cheap as possible, while the calls in flight are left alone.
+        if not ADMISSION.admit('call'):
+            request.fail('the server is overloaded', code='overloaded')
+            return
+
+        request.add_done_callback(partial(self._forget_call, request))
+        self._calls[request.marker] = request
+
+        if timeout is not None:
+            message = f"the {call['function_name']} call timed out"
+            handle = self.io_loop.call_later(timeout, self._cancel_call, request.marker,
+                                             message, 'timeout')
+            request.add_done_callback(partial(self.io_loop.remove_timeout, handle))
+
+        priority = procedure.options['priority'] if procedure is not None else 0
+        run = partial(self._run_call, request, call['function_name'], call['parameters_list'])
+        # The calls exceeding the rate limits must not take the slots of the
+        # scheduler, so the buckets are checked before submitting the calls.
+        buckets = self._get_rate_limit_buckets(procedure, call['function_name'])
+        if not buckets:
+            self._submit_call(request, priority, run)
+        elif RATE_LIMITER.is_local:  # keeps the calls in order
+            if RATE_LIMITER.consume_now('call', buckets):
+                self._submit_call(request, priority, run)
+            else:
+                request.fail('the rate limit is exceeded', code='rate_limited')
+        else:  # the buckets are kept by a shared backend
+            task = asyncio.ensure_future(self._check_rate_limits(request, buckets, priority,
+                                                                 run))
+            self._rate_limit_tasks.add(task)
+            task.add_done_callback(self._rate_limit_tasks.discard)
+
+    def _submit_call(self, request, priority, run):
+        if not SCHEDULER.submit(self, self.user_id, priority, run):
+            request.fail('the server is busy', code='busy')
+
+    async def _run_call(self, request, method_name, arguments_list):
+        if request.cancelled:  # while waiting for its turn
+            return
+
+        task = asyncio.current_task()
+        self._call_tasks[request.marker] = task
+        RUNNING_REQUESTS[task] = request
+        try:
+            await self._call_remote_procedure(request, method_name, arguments_list)
+        except Ret:
+            pass
+        except WebSocketClosedError:
+            self.logger.info('Could not respond to the %s call since the connection was closed',
+                             method_name)
+        finally:
+            del RUNNING_REQUESTS[task]
+            if self._call_tasks.get(request.marker) is task:
+                del self._call_tasks[request.marker]
+
+        # The procedures which keep responding after they return register
+        # cancel callbacks, so they stay in-flight until they are over or
+        # cancelled. The rest are over once they return.
+        if not request.has_cancel_callbacks:
+            self._forget_call(request)
+
+    def _get_rate_limit_buckets(self, procedure, method_name):
+        buckets = []
+        if procedure is not None and procedure.options['rate_limit'] is not None:
+            rate, burst = procedure.options['rate_limit']
+            buckets.append((('call', self.user_id, method_name), rate, burst))
+
+        if options.rate_limit_calls > 0:
+            buckets.append((('call', self.user_id), options.rate_limit_calls,
+                            options.rate_limit_calls_burst))
+
+        return buckets
+
+    async def _check_rate_limits(self, request, buckets, priority, run):
+        try:
+            # A token is taken from neither bucket unless both have one.
+            if not await RATE_LIMITER.consume('call', buckets):
+                request.fail('the rate limit is exceeded', code='rate_limited')
+            elif not request.cancelled:  # while the buckets were checked
+                self._submit_call(request, priority, run)
+        except WebSocketClosedError:
+            self.logger.info('Could not respond to the %s call since the connection was closed',
+                             request.procedure_name)
+
+    async def _check_handshake_rate_limit(self):
+        if options.rate_limit_handshakes <= 0:
+            return True
+
+        return await RATE_LIMITER.consume('connection', [
+            (('connection', self.user_id), options.rate_limit_handshakes,
+             options.rate_limit_handshakes_burst),
+        ])
+
+    @staticmethod
+    def _get_timeout(procedure, requested_timeout):
+        if procedure is not None and procedure.options['timeout'] is not None:
+            timeout = procedure.options['timeout']
+        else:
+            timeout = options.call_timeout or None
+
+        # Clients may only shorten the timeout.
+        if isinstance(requested_timeout, (int, float)) and requested_timeout > 0:
+            timeout = requested_timeout if timeout is None else min(timeout, requested_timeout)
+
+        return timeout
+
+    async def _drain(self):
+        if self._pending_write_bytes <= options.write_high_water_mark:
+            return
+
+        THROTTLED_WRITES.inc()
+        start = time.monotonic()
+        try:
+            # The writes complete in order, so the buffer is empty once the last
+            # one completes.
+            await self._last_write_future
+        finally:
+            THROTTLED_SECONDS.inc(time.monotonic() - start)
+
+    def _flush_outbox(self):
+        if self._outbox_timeout is not None:
+            self.io_loop.remove_timeout(self._outbox_timeout)
+            self._outbox_timeout = None
+
+        self._outbox_flush_scheduled = False
+        responses, self._outbox = self._outbox, []
+        self._outbox_bytes = 0
+        if not responses:
+            return
+
+        if len(responses) == 1:
+            frame = responses[0]
+        else:
+            frame = self.codec.join(responses)
+
+        try:
+            self._write_frame(frame)
+        except WebSocketClosedError:
+            self.logger.info('Could not send %d response(s) since the connection was closed',
+                             len(responses))
+
+    def _queue_response(self, response):
+        # The responses queued during the coalescing window (by default, the
+        # same event loop iteration) are sent to the client as a single frame.
+        if isinstance(response, BinaryFrame):  # can't be joined with the others
+            self._write_response(response)
+            return
+
+        self._outbox.append(response)
+        self._outbox_bytes += len(response)
+        if self._outbox_bytes >= options.coalesce_max_bytes:
+            self._flush_outbox()
+        elif not self._outbox_flush_scheduled:
+            self._outbox_flush_scheduled = True
+            if options.coalesce_window > 0:
+                self._outbox_timeout = self.io_loop.call_later(options.coalesce_window / 1000,
+                                                               self._flush_outbox)
+            else:
+                self.io_loop.add_callback(self._flush_outbox)
+
+    def _on_write_done(self, size, future):
+        self._pending_write_bytes -= size
+        if not future.cancelled():
+            # WebSocketClosedError is the only possible exception here, and the
+            # producers waiting for the buffer to drain get it anyway.
+            future.exception()
+
+    def _write_frame(self, frame):
+        future = self.write_message(frame,
+                                    binary=self.codec.binary or isinstance(frame, BinaryFrame))
+
+        size = len(frame)
+        FRAMES_SENT.inc()
+        BYTES_SENT.inc(size)
+        self._pending_write_bytes += size
+        future.add_done_callback(partial(self._on_write_done, size))
+        self._last_write_future = future
+
+        return future
+
+    def _write_response(self, response):
+        if self._outbox:  # preserve the order of the responses
+            self._flush_outbox()
+
+        return self._write_frame(response)
+
     async def _call_remote_procedure(self, request, method_name, arguments_list):
         try:
-            method = self._get_method(method_name)
-        except UndefinedMethod:
-            request.ret_error(f'the {method_name} function is undefined')
+            procedure = self.remote_procedures[method_name]
+        except KeyError:
+            CALL_ERRORS.inc(labels=('', 'undefined'))
+            request.fail(f'the {method_name} function is undefined')
+            return
 
-        if not check_number_of_args(method, arguments_list):
-            request.ret_error(f'number of arguments mismatch in the {method_name} function call')
+        labels = (method_name, )
+        CALLS.inc(labels=labels)
+        if not check_number_of_args(procedure, arguments_list):
+            CALL_ERRORS.inc(labels=(method_name, 'arity'))
+            request.fail(f'number of arguments mismatch in the {method_name} function call')
+            return
+
+        start = time.monotonic()
+        try:
+            await self._dispatch_call(procedure, request, arguments_list)
+        finally:
+            CALL_DURATION.observe(time.monotonic() - start, labels=labels)
+
+    async def _dispatch_call(self, procedure, request, arguments_list):
+        cache, key = procedure.options['cache'], None
+        if cache is not None:
+            key = cache.get_key(self.codec.name, self.user_id, arguments_list)
+            encoded_result = cache.get_result(key)
+            if encoded_result is not None:
+                request.complete_encoded(encoded_result)
+                return
+
+        if procedure.options['single_flight']:
+            user_id = self.user_id if procedure.options['per_user'] else None
+            flight_key = ((procedure.function, user_id) +
+                          tuple(canonicalize(argument) for argument in arguments_list))
+            flight = join_flight(flight_key, request, lambda flight: self._invoke_procedure(
+                procedure, flight, arguments_list, cache, key))
+            # Cancelling the call must not cancel the flight the other calls
+            # share.
+            await asyncio.shield(flight.task)
+        else:
+            await self._invoke_procedure(procedure, request, arguments_list, cache, key)
 
+    async def _invoke_procedure(self, procedure, request, arguments_list,  # pylint: disable=too-many-arguments
+                                cache=None, key=None):
         try:
-            result = await method(request, *arguments_list)
+            result = await procedure.function(self, request, *arguments_list)
+            # Returning a value doesn't raise any exceptions, unlike ret. The
+            # errors encoding the value are handled as the errors of the
+            # procedure itself.
             if result is not None:  # if the return statement was used
-                request.ret(result)
-        except Ret:
-            pass
+                request.complete(result)
+        except Ret as ret:  # the result is sent already
+            result = ret.value
         except Exception:  # pylint: disable=broad-except
-            message = f'an error occurred while executing the function {method_name}'
+            CALL_ERRORS.inc(labels=(procedure.name, 'exception'))
+            message = f'an error occurred while executing the function {procedure.name}'
             self.logger.exception(message)
-            request.ret_error(message)
+            request.fail(message)
+            return
 
-    def _decode_token(self, encoded_token):
-        try:
-            token = jwt.decode(encoded_token, options.token_key,
-                               algorithms=[options.token_algorithm])
-        except DecodeError as exc:
-            raise CouldNotDecodeToken from exc
+        # The bytes sent in binary frames can't be embedded into the cached
+        # responses.
+        if (cache is not None and result is not None and
+                not (isinstance(result, bytes) and not self.codec.binary)):
+            cache.put_result(key, self.codec.encode_result(result))
+
+    async def _decode_token(self, encoded_token):
+        token = TOKEN_CACHE.get_claims(encoded_token, options.token_key,
+                                       options.token_algorithm)
+        if token is None:
+            try:
+                token = await self._verify_token(encoded_token)
+            except DecodeError as exc:
+                raise CouldNotDecodeToken from exc
+
+            TOKEN_CACHE.put_claims(encoded_token, options.token_key,
+                                   options.token_algorithm, token)
 
         self.user_id = token['user_id']
 
-    def _dismiss_request(self):
+    def _dismiss_request(self, reason):
+        HANDSHAKE_FAILURES.inc(labels=(reason, ))
         self.logger.warning('Authentication request was dismissed')
         self.set_header('WWW-Authenticate', 'Token realm="shirow"')
         self.set_status(401)  # Unauthorized
         self.finish()
 
-    def _fail_request(self, message):
+    def _reject_request(self, message, reason, status=503):  # Service Unavailable
+        HANDSHAKE_FAILURES.inc(labels=(reason, ))
+        self.logger.warning(message)
+        self.set_header('Retry-After', str(RETRY_AFTER))
+        self.set_status(status)
+        self.finish()
+
+    def _fail_request(self, message, reason):
+        HANDSHAKE_FAILURES.inc(labels=(reason, ))
         self.logger.error(message)
         self.set_status(500)  # Internal Server Error
         self.finish()
 
     def _get_method(self, method_name):
-        method = getattr(self, method_name, None)
-        if method_name in dir(self) and hasattr(method, 'remote'):
-            return method
+        try:
+            procedure = self.remote_procedures[method_name]
+        except KeyError as exc:
+            raise UndefinedMethod from exc
+
+        return MethodType(procedure.function, self)
+
+    async def _verify_token(self, encoded_token):
+        verify = partial(jwt.decode, encoded_token, options.token_key,
+                         algorithms=[options.token_algorithm])
+        if options.token_verification_executor == 'none':
+            return verify()
 
-        raise UndefinedMethod
+        if PENDING_TOKEN_VERIFICATIONS.get() >= options.max_pending_token_verifications:
+            raise TooManyPendingVerifications
+
+        executor = get_executor(options.token_verification_executor, 'token_verification',
+                                options.token_verification_workers)
+        PENDING_TOKEN_VERIFICATIONS.inc()
+        try:
+            return await self.io_loop.run_in_executor(executor, verify)
+        finally:
+            PENDING_TOKEN_VERIFICATIONS.dec()
 
     async def get(self, *args, **kwargs):
+        if not ADMISSION.admit('connection'):
+            self._reject_request('The server is overloaded', 'overloaded')
+            return
+
         try:
             encoded_token = args[0]
         except IndexError:  # The request doesn't contain a token.
-            self._dismiss_request()
+            self._dismiss_request('no_token')
             return
 
         if options.token_key is None:
             self._fail_request('A token key must be specified either in the '
-                               'configuration file or on the command line')
+                               'configuration file or on the command line', 'no_token_key')
             return
 
         if options.allow_mock_token and encoded_token == MOCK_TOKEN:
             self.user_id = MOCK_USER_ID
         else:
             try:
-                self._decode_token(encoded_token)
+                await self._decode_token(encoded_token)
+            except TooManyPendingVerifications:
+                self._reject_request('Too many tokens are waiting for verification',
+                                     'too_many_pending_verifications')
+                return
             except CouldNotDecodeToken:
                 self.logger.info('Could not decode the token %s', encoded_token)
-                self._dismiss_request()
+                self._dismiss_request('invalid_token')
                 return
             except ExpiredSignatureError:
                 self.logger.info('The token %s is expired', encoded_token)
-                self._dismiss_request()
+                self._dismiss_request('expired_token')
                 return
 
-        if self.user_id:
+        if not self.user_id:
+            self._dismiss_request('no_user')
+        elif not await self._check_handshake_rate_limit():
+            self._reject_request(f'The user {self.user_id} opens connections too often',
+                                 'rate_limited', 429)  # Too Many Requests
+        else:
             # The WebSocket connection request must not contain any parameters.
             # The only parameter we needed has already been processed. Now we
             # have to get rid of it.
             args = ()
             await WebSocketHandler.get(self, *args, **kwargs)
-        else:
-            self._dismiss_request()
 
     def create(self):
         """Invoked when a connection to the RPC server is established. """
@@ -189,23 +730,50 @@ class RPCServer(WebSocketHandler):  # pylint: disable=abstract-method
             WebSocketHandler.log_exception(self, typ, value, tb)
 
     def open(self, *args, **kwargs):
+        RPCServer.connections.add(self)
+        OPEN_CONNECTIONS.set(len(RPCServer.connections))
         self.create()
 
+    def select_subprotocol(self, subprotocols):
+        """Switches the connection to MessagePack if the client asks for it.
+        Otherwise, the connection keeps using JSON.
+        """
+        if MSGPACK_SUBPROTOCOL in subprotocols:
+            try:
+                self.codec = MsgPackCodec()
+            except ImportError:
+                self.logger.warning('The client asked for %s, but msgpack is not installed',
+                                    MSGPACK_SUBPROTOCOL)
+                return None
+
+            return MSGPACK_SUBPROTOCOL
+
+        return None
+
+    def on_connection_close(self):
+        RPCServer.connections.discard(self)
+        OPEN_CONNECTIONS.set(len(RPCServer.connections))
+        SCHEDULER.discard(self)
+        for task in self._rate_limit_tasks:
+            task.cancel()
+        self._rate_limit_tasks.clear()
+        for marker in list(self._calls):
+            self._cancel_call(marker)
+        WebSocketHandler.on_connection_close(self)
+
     def on_close(self):
         self.destroy()
 
-    async def on_message(self, message):  # pylint: disable=invalid-overridden-method
-        parsed = json_decode(message)
-
-        def callback(response):
-            self.write_message(response)
-
-        request = Request(parsed['marker'], callback)
-
-        method_name = parsed['function_name']
-        params = parsed['parameters_list']
-
-        try:
-            await self._call_remote_procedure(request, method_name, params)
-        except Ret:
-            pass
+    def on_message(self, message):
+        FRAMES_RECEIVED.inc()
+        BYTES_RECEIVED.inc(len(message))
+        parsed = self.codec.decode(message)
+
+        # The calls run concurrently within the limits set by the scheduler.
+        # A client may send a batch of calls in a single frame. The responses
+        # to such calls are batched as well.
+        if isinstance(parsed, list):
+            for call in parsed:
+                self._handle_call(call, batched=True)
+        else:
+            self._handle_call(parsed)
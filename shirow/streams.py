@@ -0,0 +1,204 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the helpers streaming the output of file descriptors
+(including ptys) and subprocesses to the clients. The output is read in large
+chunks and coalesced during the time window or until enough bytes are read,
+so a chatty process doesn't flood the client with tiny frames. The text
+output is decoded incrementally, so the multi-byte characters split between
+reads are never broken.
+"""
+
+import asyncio
+import codecs
+import errno
+import os
+from contextlib import suppress
+
+from tornado.options import define, options
+
+define('stream_max_bytes',
+       help='send the output of a streamed file descriptor or subprocess as '
+            'soon as the specified number of bytes is read', default=64 * 1024,
+       type=int)
+define('stream_read_size',
+       help='the maximum number of bytes read from a streamed file descriptor '
+            'or subprocess at once', default=64 * 1024, type=int)
+define('stream_window',
+       help='the time window (in milliseconds) during which the output of a '
+            'streamed file descriptor or subprocess is coalesced; 0 means '
+            'sending it as soon as it is read', default=20.0, type=float)
+
+
+class _Coalescer:  # pylint: disable=too-many-instance-attributes
+    """Buffers the output until it's flushed to the client. The size of the
+    output is counted in bytes, even when it's decoded.
+    """
+
+    def __init__(self, request, encoding, lines, max_bytes):
+        if encoding is None:
+            self._decoder = None
+            self._newline = b'\n'
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            self._newline = '\n'
+
+        self._encoding = encoding
+        self._lines = lines
+        self._max_bytes = max_bytes
+        self._parts = []
+        self._request = request
+
+        self.size = 0
+
+    def feed(self, data):
+        """Buffers the specified bytes. """
+
+        self.size += len(data)
+        if self._decoder is not None:
+            data = self._decoder.decode(data)
+
+        self._parts.append(data)
+
+    async def flush(self, final=False):
+        """Sends the buffered output to the client. When splitting on lines,
+        an incomplete line is kept until the rest of it is read unless the
+        output is over or the line is too long.
+        """
+
+        value = self._newline[:0].join(self._parts)
+        if final and self._decoder is not None:
+            value += self._decoder.decode(b'', final=True)
+
+        size = self.size
+        self._parts = []
+        self.size = 0
+        if self._lines and not final:
+            end = value.rfind(self._newline) + 1
+            if end or size < self._max_bytes:
+                value, rest = value[:end], value[end:]
+                if rest:
+                    self._parts.append(rest)
+                    self.size = (len(rest) if self._decoder is None else
+                                 len(rest.encode(self._encoding, errors='replace')))
+
+        if value:
+            await self._request.send(value)
+
+
+def _get_fd_reader(fd, read_size):
+    loop = asyncio.get_running_loop()
+
+    def wake_up(future):
+        if not future.done():
+            future.set_result(None)
+
+    async def read():
+        while True:
+            # The reader is registered only while waiting, so the loop doesn't
+            # spin on the level-triggered readiness while the client drains.
+            readable = loop.create_future()
+            loop.add_reader(fd, wake_up, readable)
+            try:
+                await readable
+            finally:
+                loop.remove_reader(fd)
+
+            try:
+                return os.read(fd, read_size)
+            except BlockingIOError:
+                continue
+            except OSError as exc:
+                if exc.errno == errno.EIO:  # the other side of the pty is closed
+                    return b''
+
+                raise
+
+    return read
+
+
+async def _stream(request, read, *, encoding, lines, window, max_bytes):  # pylint: disable=too-many-arguments
+    if window is None:
+        window = options.stream_window / 1000
+    if max_bytes is None:
+        max_bytes = options.stream_max_bytes
+
+    loop = asyncio.get_running_loop()
+    coalescer = _Coalescer(request, encoding, lines, max_bytes)
+    deadline = None
+    read_task = None
+    try:
+        while True:
+            if read_task is None:
+                read_task = asyncio.ensure_future(read())
+
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait((read_task, ), timeout=timeout)
+            if not done:  # the window is over
+                deadline = None
+                await coalescer.flush()
+                continue
+
+            data = read_task.result()
+            read_task = None
+            if not data:
+                break
+
+            coalescer.feed(data)
+            if window <= 0 or coalescer.size >= max_bytes:
+                deadline = None
+                await coalescer.flush()
+            elif deadline is None:
+                deadline = loop.time() + window
+
+        await coalescer.flush(final=True)
+    finally:
+        if read_task is not None:
+            read_task.cancel()
+
+
+async def stream_fd(request, fd, *, encoding='utf-8', lines=False, window=None,  # pylint: disable=too-many-arguments
+                    max_bytes=None):
+    """Sends the output read from the specified file descriptor to the client
+    until the end of file and ends the call. The output is decoded using the
+    encoding, or sent as bytes if the encoding is None. If lines is true, the
+    output is sent in whole lines. The window (in seconds) and the maximum
+    number of bytes to coalesce default to --stream_window and
+    --stream_max_bytes. The file descriptor is left open.
+    """
+
+    await _stream(request, _get_fd_reader(fd, options.stream_read_size), encoding=encoding,
+                  lines=lines, window=window, max_bytes=max_bytes)
+    request.end()
+
+
+async def stream_subprocess(request, process, *, encoding='utf-8', lines=False, window=None,  # pylint: disable=too-many-arguments
+                            max_bytes=None):
+    """Sends the standard output of the specified asyncio subprocess, which
+    must be created with stdout=PIPE, to the client until the process closes
+    it and completes the call with the exit code of the process. If the call
+    is cancelled (for example, the client disconnects), the process is
+    terminated. See stream_fd for the other arguments.
+    """
+
+    try:
+        await _stream(request, lambda: process.stdout.read(options.stream_read_size),
+                      encoding=encoding, lines=lines, window=window, max_bytes=max_bytes)
+        request.complete(await process.wait())
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            with suppress(ProcessLookupError):  # exited, but not reaped yet
+                process.terminate()
+
+        raise
@@ -14,10 +14,22 @@
 
 """This module contains the Shirow tests. """
 
+# pylint: disable=too-many-lines
+
+import asyncio
 import datetime
 import logging
 import os
 import pty
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+from functools import partial
+from unittest import mock
 
 import jwt
 from tornado import gen
@@ -26,11 +38,29 @@ from tornado.escape import json_decode, json_encode
 from tornado.ioloop import IOLoop
 from tornado.options import options
 from tornado.test.util import unittest
-from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, bind_unused_port, gen_test
 from tornado.web import Application
 from tornado.websocket import websocket_connect
 
-from shirow.server import RPCServer, MOCK_TOKEN, TOKEN_PATTERN, remote
+from shirow import broker, codec, ioloop, results
+from shirow.admission import AdmissionController
+from shirow.cache import LRUCache
+from shirow.executors import get_pool_workers, shutdown_executors
+from shirow.heartbeat import HEARTBEAT
+from shirow.metrics import REGISTRY, MetricsHandler, Registry, format_text
+from shirow.pubsub import HUB, TRY_AGAIN_LATER, Hub
+from shirow.ratelimit import RATE_LIMITER, MemoryBackend, RateLimitBackend
+from shirow.scheduler import Scheduler
+from shirow.request import Request
+from shirow.tokens import TOKEN_CACHE
+from shirow.server import RPCServer, MOCK_TOKEN, MSGPACK_SUBPROTOCOL, TOKEN_PATTERN, remote
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 TOKEN_ALGORITHM_ENCODING = 'HS256'
 
@@ -47,6 +77,45 @@ EXPIRED_ENCODED_TOKEN = jwt.encode(
 ).decode('utf8')
 
 
+MULTI_PROCESS_SERVICE = textwrap.dedent('''
+    import asyncio
+    import os
+    import sys
+
+    from tornado.options import options
+    from tornado.web import Application
+
+    from shirow.ioloop import IOLoop
+    from shirow.server import RPCServer, TOKEN_PATTERN, remote
+
+
+    class PidRPCServer(RPCServer):
+        @remote
+        async def get_pid(self, _request):
+            return os.getpid()
+
+        @remote
+        async def sleep(self, _request, delay):
+            await asyncio.sleep(delay)
+            return delay
+
+
+    options.drain_timeout = 1.0
+    options.max_restarts = int(sys.argv[4])
+    options.reuse_port = sys.argv[2] == 'reuse_port'
+    options.token_key = sys.argv[3]
+    app = Application([('/rpc/token/' + TOKEN_PATTERN, PidRPCServer)])
+    IOLoop().start(app, int(sys.argv[1]), workers=2)
+''')
+
+
+def get_children(pid):
+    """Returns the pids of the children of the specified process. """
+
+    with open(f'/proc/{pid}/task/{pid}/children', encoding='utf8') as infile:
+        return {int(child) for child in infile.read().split()}
+
+
 def prepare_payload(procedure_name, parameters_list, marker):
     """Prepares a valid payload for use in the test cases. """
 
@@ -58,9 +127,13 @@ def prepare_payload(procedure_name, parameters_list, marker):
     return json_encode(data)
 
 
-class MockRPCServer(RPCServer):  # pylint: disable=abstract-method
+class MockRPCServer(RPCServer):  # pylint: disable=abstract-method,too-many-public-methods
     """An RPC server based on Shirow used for the testing purposes. """
 
+    cancelled_calls = []
+
+    calls_number = 0
+
     def initialize(self, close_future, compression_options=None):
         self.close_future = close_future  # pylint: disable=attribute-defined-outside-init
         self.compression_options = compression_options  # pylint: disable=attribute-defined-outside-init
@@ -75,10 +148,19 @@ class MockRPCServer(RPCServer):  # pylint: disable=abstract-method
     async def add(self, _request, op_a, op_b):  # pylint: disable=no-self-use
         return op_a + op_b
 
+    @remote
+    async def block(self, _request, seconds):  # pylint: disable=no-self-use
+        time.sleep(seconds)
+        return seconds
+
     @remote
     async def div_by_zero(self, _request):  # pylint: disable=no-self-use
         1 / 0  # pylint: disable=pointless-statement
 
+    @remote
+    async def return_unencodable_value(self, _request):  # pylint: disable=no-self-use
+        return {1, 2}
+
     @remote
     async def echo_via_ret_method(self, request, message):  # pylint: disable=no-self-use
         request.ret(message)
@@ -87,6 +169,17 @@ class MockRPCServer(RPCServer):  # pylint: disable=abstract-method
     async def echo_via_return_statement(self, _request, message):  # pylint: disable=no-self-use
         return message
 
+    @remote(coalesce=True)
+    async def count_coalesced(self, request, count):  # pylint: disable=no-self-use
+        for i in range(count):
+            request.ret_and_continue(i)
+
+        return count
+
+    @remote(rate_limit=1, rate_limit_burst=2)
+    async def limited_echo(self, _request, message):  # pylint: disable=no-self-use
+        return message
+
     @remote
     async def read_from_fd(self, request, master_fd):
         def handler(*_args, **_kwargs):
@@ -97,6 +190,36 @@ class MockRPCServer(RPCServer):  # pylint: disable=abstract-method
             request.ret_and_continue(res.decode('utf8'))
 
         self.io_loop.add_handler(master_fd, handler, self.io_loop.READ)
+        request.add_cancel_callback(partial(self.io_loop.remove_handler, master_fd))
+
+    @remote
+    async def run_script(self, request, script):  # pylint: disable=no-self-use
+        process = await asyncio.create_subprocess_exec(sys.executable, '-c', script,
+                                                       stdout=subprocess.PIPE)
+        await request.stream_subprocess(process, lines=True)
+
+    @remote
+    async def count_up(self, _request, count):  # pylint: disable=no-self-use
+        for i in range(count):
+            yield i
+
+    @remote(max_chunk_bytes=3)
+    async def yield_text(self, _request, text):  # pylint: disable=no-self-use
+        yield text
+        yield [text]
+
+    @remote
+    async def get_raw_json(self, _request):  # pylint: disable=no-self-use
+        return codec.RawJSON('{"spam": [1, 2], "ham": null}')
+
+    @remote
+    async def watch(self, request, topic):
+        HUB.subscribe(topic, self, request)
+
+    @remote(coalesce=True)
+    async def get_bytes(self, request, length):  # pylint: disable=no-self-use
+        request.ret_and_continue('header')
+        return bytes(i % 256 for i in range(length))
 
     @remote
     async def return_more_than_one_value(self, request):  # pylint: disable=no-self-use
@@ -104,10 +227,85 @@ class MockRPCServer(RPCServer):  # pylint: disable=abstract-method
         request.ret_and_continue('ham')
         request.ret_and_continue('eggs')
 
+    @remote
+    async def send_numbers(self, request, count):  # pylint: disable=no-self-use
+        for i in range(count):
+            await request.send(i)
+
+        return count
+
+    @remote(cache_ttl=60)
+    async def count_calls(self, _request, _value):  # pylint: disable=no-self-use
+        MockRPCServer.calls_number += 1
+        return {'calls_number': MockRPCServer.calls_number}
+
+    @remote(cache_ttl=60, per_user=True)
+    async def count_calls_per_user(self, request, key):  # pylint: disable=no-self-use
+        MockRPCServer.calls_number += 1
+        request.ret([key, MockRPCServer.calls_number])
+
+    @remote(single_flight=True)
+    async def count_calls_once(self, request, delays):  # pylint: disable=no-self-use
+        MockRPCServer.calls_number += 1
+        for delay in delays:
+            await gen.sleep(delay)
+            request.ret_and_continue(MockRPCServer.calls_number)
+
+        return MockRPCServer.calls_number
+
+    @remote(single_flight=True)
+    async def wait_forever_once(self, request):
+        request.add_cancel_callback(
+            lambda: self.cancelled_calls.append(('callback', request.marker)))
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled_calls.append(('task', request.marker))
+            raise
+
+    @remote(timeout=10)
+    async def get_time_remaining(self, request):  # pylint: disable=no-self-use
+        return request.time_remaining()
+
+    @remote
+    async def wait_forever(self, request):
+        request.add_cancel_callback(
+            lambda: self.cancelled_calls.append(('callback', request.marker)))
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled_calls.append(('task', request.marker))
+            raise
+
+    @remote(executor='thread')
+    @staticmethod
+    def get_thread_name(prefix, suffix=''):
+        return prefix + threading.current_thread().name + suffix
+
+    @remote(executor='process', pool='test')
+    @staticmethod
+    def get_pid():
+        return os.getpid()
+
+    @remote(executor='process')
+    @staticmethod
+    def fail_in_process(message):
+        raise ValueError(message)
+
     @remote
     async def say_hello(self, _request, name='Shirow'):  # pylint: disable=no-self-use
         return f'Hello {name}!'
 
+    @remote
+    async def sleep(self, _request, seconds):  # pylint: disable=no-self-use
+        await gen.sleep(seconds)
+        return seconds
+
+    @remote(priority=1)
+    async def sleep_urgently(self, _request, seconds):  # pylint: disable=no-self-use
+        await gen.sleep(seconds)
+        return seconds
+
 
 class WebSocketBaseTestCase(AsyncHTTPTestCase):  # pylint: disable=abstract-method
     """A test case that starts up a WebSocket server. """
@@ -119,9 +317,10 @@ class WebSocketBaseTestCase(AsyncHTTPTestCase):  # pylint: disable=abstract-meth
         self.io_loop = IOLoop.current()
 
     @gen.coroutine
-    def ws_connect(self, path, compression_options=None):
+    def ws_connect(self, path, compression_options=None, subprotocols=None):
         ws_conn = yield websocket_connect(f'ws://127.0.0.1:{self.get_http_port()}{path}',
-                                          compression_options=compression_options)
+                                          compression_options=compression_options,
+                                          subprotocols=subprotocols)
         return ws_conn
 
     @gen.coroutine
@@ -135,7 +334,7 @@ class WebSocketBaseTestCase(AsyncHTTPTestCase):  # pylint: disable=abstract-meth
         yield self.close_future  # pylint: disable=no-member
 
 
-class RPCServerTest(WebSocketBaseTestCase):
+class RPCServerTest(WebSocketBaseTestCase):  # pylint: disable=too-many-public-methods
     """Tests various scenarios for an RPC server based on Shirow. """
 
     def get_app(self):
@@ -147,6 +346,7 @@ class RPCServerTest(WebSocketBaseTestCase):
              dict(close_future=self.close_future)),
             ('/rpc/token/' + TOKEN_PATTERN, MockRPCServer,
              dict(close_future=self.close_future)),
+            ('/metrics', MetricsHandler),
         ])
 
     def test_tokenless_request(self):
@@ -180,6 +380,81 @@ class RPCServerTest(WebSocketBaseTestCase):
         response = self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
         self.assertEqual(response.code, 401)  # decode error
 
+    def test_counting_handshake_failures(self):
+        failures = REGISTRY.get('shirow_handshake_failures_total')
+        failures_before = failures.get(('invalid_token', ))
+        self.fetch('/rpc/token/some.non.existent.token')
+        self.assertEqual(failures.get(('invalid_token', )), failures_before + 1)
+
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn(f'shirow_handshake_failures_total{{reason="invalid_token"}} '
+                      f'{failures_before + 1}', response.body.decode('utf8').splitlines())
+
+    def test_rejecting_connections_when_overloaded(self):
+        self.addCleanup(setattr, options, 'max_rss', 0)
+        options.max_rss = 1  # megabyte
+        rejections = REGISTRY.get('shirow_admission_rejections_total')
+        rejections_before = rejections.get(('connection', 'memory'))
+        response = self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(rejections.get(('connection', 'memory')), rejections_before + 1)
+        self.assertGreater(REGISTRY.get('shirow_admission_pressure').get(('memory', )), 1)
+
+    def test_rate_limiting_handshakes(self):
+        self.addCleanup(setattr, RATE_LIMITER, 'backend', None)
+        self.addCleanup(setattr, options, 'rate_limit_handshakes', 0.0)
+        RATE_LIMITER.backend = MemoryBackend()
+        options.rate_limit_handshakes = 1.0
+        rate_limited = REGISTRY.get('shirow_rate_limited_total')
+        rate_limited_before = rate_limited.get(('connection', ))
+
+        response = self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(response.code, 400)  # not a WebSocket handshake
+        response = self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(response.code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(rate_limited.get(('connection', )), rate_limited_before + 1)
+
+    def test_caching_verified_tokens(self):
+        TOKEN_CACHE.clear()
+        hits = REGISTRY.get('shirow_token_cache_hits_total')
+        hits_before = hits.get()
+
+        # The token is verified even though the request is not a WebSocket
+        # handshake.
+        self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(hits.get(), hits_before)
+        self.assertEqual(len(TOKEN_CACHE), 1)
+
+        self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(hits.get(), hits_before + 1)
+
+    @gen_test
+    def test_verifying_tokens_in_executor(self):
+        TOKEN_CACHE.clear()
+        options.token_verification_executor = 'thread'
+        self.addCleanup(setattr, options, 'token_verification_executor', 'none')
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('add', [1, 2], 1))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 3, 'marker': 1, 'eod': 1})
+        yield self.close(ws_conn)
+
+    def test_limiting_pending_token_verifications(self):
+        TOKEN_CACHE.clear()
+        options.token_verification_executor = 'thread'
+        options.max_pending_token_verifications = 0
+        self.addCleanup(setattr, options, 'token_verification_executor', 'none')
+        self.addCleanup(setattr, options, 'max_pending_token_verifications', 1000)
+
+        response = self.fetch(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(response.code, 503)
+        self.assertIn('Retry-After', response.headers)
+
     @gen_test
     def test_using_ret_method_to_return_value(self):
         ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
@@ -207,146 +482,1678 @@ class RPCServerTest(WebSocketBaseTestCase):
         yield self.close(ws_conn)
 
     @gen_test
-    def test_calling_non_existent_function(self):
+    def test_using_non_default_codec(self):
+        options.json_codec = 'orjson'
+        self.addCleanup(setattr, options, 'json_codec', 'stdlib')
+
         ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
-        payload = prepare_payload('non_existent_function', [], 1)
+        payload = prepare_payload('add', [1, 2], 1)
         ws_conn.write_message(payload)
         response = yield ws_conn.read_message()
+        self.assertIsInstance(response, str)  # text frame
         self.assertEqual(json_decode(response), {
-            'error': 'the non_existent_function function is undefined',
-            'marker': 1
+            'result': 3,
+            'marker': 1,
+            'eod': 1,
         })
         yield self.close(ws_conn)
 
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
     @gen_test
-    def test_mismatching_parameters(self):
-        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
-        # less than is required
-        payload = prepare_payload('add', [1], 1)
-        ws_conn.write_message(payload)
-        response = yield ws_conn.read_message()
-        self.assertEqual(json_decode(response), {
-            'error': 'number of arguments mismatch in the add function call',
-            'marker': 1
-        })
-        # more than is required
-        payload = prepare_payload('add', [1, 3, 5], 2)
-        ws_conn.write_message(payload)
-        response = yield ws_conn.read_message()
-        self.assertEqual(json_decode(response), {
-            'error': 'number of arguments mismatch in the add function call',
-            'marker': 2
+    def test_using_msgpack_subprotocol(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}',
+                                        subprotocols=[MSGPACK_SUBPROTOCOL])
+        self.assertEqual(ws_conn.selected_subprotocol, MSGPACK_SUBPROTOCOL)
+        payload = msgpack.packb({
+            'function_name': 'echo_via_return_statement',
+            'parameters_list': [b'\x00\xff'],
+            'marker': 1,
         })
-
-        payload = prepare_payload('add', [1, 3], 3)
-        ws_conn.write_message(payload)
+        ws_conn.write_message(payload, binary=True)
         response = yield ws_conn.read_message()
-        self.assertEqual(json_decode(response), {
-            'result': 4,
-            'marker': 3,
+        self.assertIsInstance(response, bytes)  # binary frame
+        self.assertEqual(msgpack.unpackb(response), {
+            'result': b'\x00\xff',
+            'marker': 1,
             'eod': 1,
         })
         yield self.close(ws_conn)
 
     @gen_test
-    def test_handling_errors_in_remote_procedures(self):
+    def test_passing_raw_results_through(self):
         ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
-        payload = prepare_payload('div_by_zero', [], 1)
-        ws_conn.write_message(payload)
+        ws_conn.write_message(prepare_payload('get_raw_json', [], 1))
         response = yield ws_conn.read_message()
-        self.assertEqual(json_decode(response), {
-            'error': 'an error occurred while executing the function div_by_zero',
-            'marker': 1
-        })
+        # The result is spliced into the response as is.
+        self.assertTrue(response.endswith('"result":{"spam": [1, 2], "ham": null}}'))
+        self.assertEqual(json_decode(response), {'result': {'spam': [1, 2], 'ham': None},
+                                                 'marker': 1, 'eod': 1})
+
+        # Bytes are sent in binary frames, which are never coalesced with the
+        # other responses.
+        ws_conn.write_message(prepare_payload('get_bytes', [300], 2))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 'header', 'marker': 2, 'eod': 0})
+        response = yield ws_conn.read_message()
+        self.assertIsInstance(response, bytes)
+        header_length = int.from_bytes(response[:4], 'big')
+        self.assertEqual(json_decode(response[4:4 + header_length]), {'marker': 2, 'eod': 1})
+        self.assertEqual(response[4 + header_length:], bytes(i % 256 for i in range(300)))
         yield self.close(ws_conn)
 
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
     @gen_test
-    def test_default_parameters(self):
-        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
-        payload = prepare_payload('say_hello', [], 1)
-        ws_conn.write_message(payload)
+    def test_passing_raw_results_through_msgpack(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}',
+                                        subprotocols=[MSGPACK_SUBPROTOCOL])
+        for marker, (procedure_name, parameters_list, result) in enumerate([
+                ('get_raw_json', [], {'spam': [1, 2], 'ham': None}),
+                ('get_bytes', [3], b'\x00\x01\x02')]):
+            ws_conn.write_message(msgpack.packb({
+                'function_name': procedure_name,
+                'parameters_list': parameters_list,
+                'marker': marker,
+            }), binary=True)
+            response = yield ws_conn.read_message()
+            if procedure_name == 'get_bytes':  # the coalesced responses
+                self.assertEqual(msgpack.unpackb(response), [
+                    {'result': 'header', 'marker': marker, 'eod': 0},
+                    {'result': result, 'marker': marker, 'eod': 1},
+                ])
+            else:
+                self.assertEqual(msgpack.unpackb(response),
+                                 {'result': result, 'marker': marker, 'eod': 1})
+
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_falling_back_to_json_without_msgpack(self):
+        with mock.patch('shirow.codec.msgpack', None):
+            ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}',
+                                            subprotocols=[MSGPACK_SUBPROTOCOL])
+        self.assertIsNone(ws_conn.selected_subprotocol)
+        ws_conn.write_message(prepare_payload('add', [1, 2], 1))
         response = yield ws_conn.read_message()
         self.assertEqual(json_decode(response), {
-            'result': 'Hello Shirow!',
+            'result': 3,
             'marker': 1,
             'eod': 1,
         })
-        payload = prepare_payload('say_hello', ['Norris'], 2)
-        ws_conn.write_message(payload)
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_batching_calls(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        batch = [
+            {'function_name': 'add', 'parameters_list': [1, 2], 'marker': 1},
+            {'function_name': 'div_by_zero', 'parameters_list': [], 'marker': 2},
+            {'function_name': 'return_more_than_one_value', 'parameters_list': [], 'marker': 3},
+        ]
+        ws_conn.write_message(json_encode(batch))
         response = yield ws_conn.read_message()
-        self.assertEqual(json_decode(response), {
-            'result': 'Hello Norris!',
-            'marker': 2,
-            'eod': 1,
-        })
+        self.assertEqual(json_decode(response), [
+            {'result': 3, 'marker': 1, 'eod': 1},
+            {'error': 'an error occurred while executing the function div_by_zero', 'marker': 2},
+            {'result': 'spam', 'marker': 3, 'eod': 0},
+            {'result': 'ham', 'marker': 3, 'eod': 0},
+            {'result': 'eggs', 'marker': 3, 'eod': 0},
+        ])
+
+        # A batch consisting of a single call results in a single response.
+        ws_conn.write_message(json_encode(batch[:1]))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 3, 'marker': 1, 'eod': 1})
         yield self.close(ws_conn)
 
     @gen_test
-    def test_returning_more_than_one_value(self):
+    def test_cancelling_calls(self):
+        MockRPCServer.cancelled_calls.clear()
         ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
-        payload = prepare_payload('return_more_than_one_value', [], 1)
-        ws_conn.write_message(payload)
+        ws_conn.write_message(prepare_payload('wait_forever', [], 1))
+        ws_conn.write_message(prepare_payload('wait_forever', [], 2))
+        ws_conn.write_message(json_encode({'cancel': 1}))
+        ws_conn.write_message(json_encode({'cancel': 3}))  # unknown markers are ignored
+        ws_conn.write_message(prepare_payload('add', [1, 2], 4))
         response = yield ws_conn.read_message()
-        self.assertEqual(json_decode(response), {
-            'result': 'spam',
+        self.assertEqual(json_decode(response), {'result': 3, 'marker': 4, 'eod': 1})
+        self.assertEqual(MockRPCServer.cancelled_calls, [('callback', 1), ('task', 1)])
+
+        # The calls in flight are cancelled when the client disconnects.
+        yield self.close(ws_conn)
+        yield gen.sleep(0)
+        self.assertEqual(MockRPCServer.cancelled_calls[2:], [('callback', 2), ('task', 2)])
+
+    @gen_test
+    def test_publishing_to_subscribers(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('watch', ['news'], 1))
+        ws_conn.write_message(prepare_payload('watch', ['news'], 2))
+        while HUB.get_subscribers_number('news') < 2:
+            yield gen.sleep(0.01)
+
+        self.assertEqual(HUB.publish('news', {'spam': 1}), 2)
+        for marker in (1, 2):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response),
+                             {'result': {'spam': 1}, 'marker': marker, 'eod': 0})
+
+        # Cancelling the call cancels the subscription.
+        ws_conn.write_message(json_encode({'cancel': 1}))
+        while HUB.get_subscribers_number('news') > 1:
+            yield gen.sleep(0.01)
+
+        self.assertEqual(HUB.publish('news', 'ham'), 1)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 'ham', 'marker': 2, 'eod': 0})
+
+        # So does disconnecting.
+        yield self.close(ws_conn)
+        self.assertEqual(HUB.get_subscribers_number('news'), 0)
+        self.assertEqual(HUB.publish('news', 'eggs'), 0)
+
+    @gen_test
+    def test_cancelling_queued_calls(self):
+        options.max_calls_per_connection = 1
+        self.addCleanup(setattr, options, 'max_calls_per_connection', 16)
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('sleep', [0.05], 1))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 2))
+        ws_conn.write_message(prepare_payload('add', [3, 4], 3))
+        ws_conn.write_message(json_encode([{'cancel': 2}]))
+        for marker, result in ((1, 0.05), (3, 7)):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': result, 'marker': marker, 'eod': 1})
+
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_timing_out_calls(self):
+        MockRPCServer.cancelled_calls.clear()
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(json_encode({
+            'function_name': 'wait_forever',
+            'parameters_list': [],
             'marker': 1,
-            'eod': 0,
-        })
+            'timeout': 0.05,
+        }))
         response = yield ws_conn.read_message()
         self.assertEqual(json_decode(response), {
-            'result': 'ham',
+            'error': 'the wait_forever call timed out',
+            'code': 'timeout',
             'marker': 1,
-            'eod': 0,
         })
+        yield gen.sleep(0)
+        self.assertEqual(MockRPCServer.cancelled_calls, [('callback', 1), ('task', 1)])
+
+        options.call_timeout = 0.05
+        self.addCleanup(setattr, options, 'call_timeout', 0.0)
+        ws_conn.write_message(prepare_payload('sleep', [10], 2))
         response = yield ws_conn.read_message()
         self.assertEqual(json_decode(response), {
-            'result': 'eggs',
-            'marker': 1,
-            'eod': 0,
+            'error': 'the sleep call timed out',
+            'code': 'timeout',
+            'marker': 2,
         })
         yield self.close(ws_conn)
 
     @gen_test
-    def test_reading_from_fd(self):
+    def test_getting_time_remaining(self):
         ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('get_time_remaining', [], 1))
+        response = yield ws_conn.read_message()
+        self.assertTrue(9 < json_decode(response)['result'] <= 10)
 
-        pid, master_fd = pty.fork()
-        if pid == 0:  # child
-            script = (
-                'from time import sleep\n'
-                'for i in ["foo", "bar", "baz", "qux"]: print(i); sleep(0.5)'
-            )
-            command_line = ['python3', '-c', script]
-            os.execvp(command_line[0], command_line)
-        else:  # parent
-            payload = prepare_payload('read_from_fd', [master_fd], 1)
-            ws_conn.write_message(payload)
+        # Clients may shorten the timeout, but not extend it.
+        for marker, timeout in ((2, 1), (3, 100)):
+            ws_conn.write_message(json_encode({
+                'function_name': 'get_time_remaining',
+                'parameters_list': [],
+                'marker': marker,
+                'timeout': timeout,
+            }))
             response = yield ws_conn.read_message()
-            self.assertEqual(json_decode(response), {
-                'result': 'foo\r\n',
-                'marker': 1,
-                'eod': 0,
-            })
+            expected = min(timeout, 10)
+            self.assertTrue(expected - 1 < json_decode(response)['result'] <= expected)
+
+        ws_conn.write_message(prepare_payload('sleep', [0], 4))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 0, 'marker': 4, 'eod': 1})
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_caching_results(self):
+        results.invalidate()
+        hits = REGISTRY.get('shirow_result_cache_hits_total')
+        hits_before = hits.get(('count_calls', ))
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+
+        @gen.coroutine
+        def call(procedure_name, parameters_list, marker):
+            ws_conn.write_message(prepare_payload(procedure_name, parameters_list, marker))
             response = yield ws_conn.read_message()
-            self.assertEqual(json_decode(response), {
-                'result': 'bar\r\n',
-                'marker': 1,
-                'eod': 0,
-            })
+            return json_decode(response)
+
+        response = yield call('count_calls', [{'a': 1, 'b': 2}], 1)
+        calls_number = response['result']['calls_number']
+        # The order of the keys doesn't matter.
+        response = yield call('count_calls', [{'b': 2, 'a': 1}], 2)
+        self.assertEqual(response, {'result': {'calls_number': calls_number},
+                                    'marker': 2, 'eod': 1})
+        self.assertEqual(hits.get(('count_calls', )), hits_before + 1)
+
+        response = yield call('count_calls', ['spam'], 3)
+        self.assertEqual(response['result']['calls_number'], calls_number + 1)
+
+        # The results are invalidated by the prefix of the arguments.
+        self.assertEqual(results.invalidate('count_calls', prefix=['spam']), 1)
+        response = yield call('count_calls', [{'a': 1, 'b': 2}], 4)
+        self.assertEqual(response['result']['calls_number'], calls_number)
+        response = yield call('count_calls', ['spam'], 5)
+        self.assertEqual(response['result']['calls_number'], calls_number + 2)
+
+        # The results cached per user are cached when returned via ret too.
+        response = yield call('count_calls_per_user', ['eggs'], 6)
+        response = yield call('count_calls_per_user', ['eggs'], 7)
+        self.assertEqual(response['result'], ['eggs', calls_number + 3])
+        self.assertEqual(results.invalidate('count_calls_per_user', user_id=USER_ID + 1), 0)
+        self.assertEqual(results.invalidate('count_calls_per_user', user_id=USER_ID), 1)
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_running_in_executors(self):
+        self.addCleanup(shutdown_executors)
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+
+        @gen.coroutine
+        def call(procedure_name, parameters_list, marker):
+            ws_conn.write_message(prepare_payload(procedure_name, parameters_list, marker))
             response = yield ws_conn.read_message()
-            self.assertEqual(json_decode(response), {
-                'result': 'baz\r\n',
-                'eod': 0,
-                'marker': 1
-            })
+            return json_decode(response)
+
+        response = yield call('get_thread_name', ['<'], 1)
+        self.assertTrue(response['result'].startswith('<'))
+        self.assertNotIn('MainThread', response['result'])
+        response = yield call('get_thread_name', ['<', '>'], 2)
+        self.assertTrue(response['result'].endswith('>'))
+        response = yield call('get_thread_name', [], 3)
+        self.assertEqual(response['error'],
+                         'number of arguments mismatch in the get_thread_name function call')
+
+        response = yield call('get_pid', [], 4)
+        self.assertNotEqual(response['result'], os.getpid())
+
+        response = yield call('fail_in_process', ['spam'], 5)
+        self.assertEqual(response, {
+            'error': 'an error occurred while executing the function fail_in_process',
+            'marker': 5,
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_sharing_flights(self):
+        joined_calls = REGISTRY.get('shirow_joined_calls_total')
+        joined_before = joined_calls.get()
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('count_calls_once', [[0.05]], 1))
+        ws_conn.write_message(prepare_payload('count_calls_once', [[0.05]], 2))
+        responses = []
+        for _ in range(4):
             response = yield ws_conn.read_message()
-            self.assertEqual(json_decode(response), {
-                'result': 'qux\r\n',
-                'marker': 1,
-                'eod': 1,
-            })
+            responses.append(json_decode(response))
 
-            yield self.close(ws_conn)
+        calls_number = responses[0]['result']
+        self.assertEqual(responses, [
+            {'result': calls_number, 'marker': 1, 'eod': 0},
+            {'result': calls_number, 'marker': 2, 'eod': 0},
+            {'result': calls_number, 'marker': 1, 'eod': 1},
+            {'result': calls_number, 'marker': 2, 'eod': 1},
+        ])
+        self.assertEqual(joined_calls.get(), joined_before + 1)
+
+        # The calls joined late receive only the values produced after they
+        # joined.
+        ws_conn.write_message(prepare_payload('count_calls_once', [[0, 0.1]], 3))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': calls_number + 1, 'marker': 3, 'eod': 0})
+        ws_conn.write_message(prepare_payload('count_calls_once', [[0, 0.1]], 4))
+        for marker, eod in ((3, 0), (4, 0), (3, 1), (4, 1)):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response),
+                             {'result': calls_number + 1, 'marker': marker, 'eod': eod})
+
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_cancelling_flights(self):
+        MockRPCServer.cancelled_calls.clear()
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('wait_forever_once', [], 1))
+        ws_conn.write_message(prepare_payload('wait_forever_once', [], 2))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 3))
+        yield ws_conn.read_message()  # both calls have joined the flight
+
+        ws_conn.write_message(json_encode({'cancel': 1}))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 4))
+        yield ws_conn.read_message()
+        self.assertEqual(MockRPCServer.cancelled_calls, [])
+
+        # The flight is cancelled when all the calls sharing it are cancelled.
+        ws_conn.write_message(json_encode({'cancel': 2}))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 5))
+        yield ws_conn.read_message()
+        self.assertEqual(MockRPCServer.cancelled_calls, [('callback', None), ('task', None)])
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_running_calls_concurrently(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('sleep', [0.1], 1))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 2))
+        markers = []
+        for _ in range(2):
+            response = yield ws_conn.read_message()
+            markers.append(json_decode(response)['marker'])
+
+        self.assertEqual(markers, [2, 1])
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_limiting_calls_per_connection(self):
+        options.max_calls_per_connection = 1
+        self.addCleanup(setattr, options, 'max_calls_per_connection', 16)
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('sleep', [0.1], 1))
+        ws_conn.write_message(prepare_payload('sleep', [0], 2))
+        ws_conn.write_message(prepare_payload('sleep_urgently', [0], 3))
+        markers = []
+        for _ in range(3):
+            response = yield ws_conn.read_message()
+            markers.append(json_decode(response)['marker'])
+
+        self.assertEqual(markers, [1, 3, 2])
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_rejecting_calls_when_busy(self):
+        options.max_calls_per_connection = 1
+        self.addCleanup(setattr, options, 'max_calls_per_connection', 16)
+        options.max_queued_calls_per_connection = 1
+        self.addCleanup(setattr, options, 'max_queued_calls_per_connection', 1000)
+        busy_calls = REGISTRY.get('shirow_busy_calls_total')
+        busy_before = busy_calls.get()
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        for marker in range(1, 4):
+            ws_conn.write_message(prepare_payload('sleep', [0.05], marker))
+
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response),
+                         {'error': 'the server is busy', 'code': 'busy', 'marker': 3})
+        for marker in range(1, 3):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': 0.05, 'marker': marker, 'eod': 1})
+
+        self.assertEqual(busy_calls.get(), busy_before + 1)
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_waiting_for_write_buffer_to_drain(self):
+        options.write_high_water_mark = 1
+        self.addCleanup(setattr, options, 'write_high_water_mark', 1024 * 1024)
+        throttled_writes = REGISTRY.get('shirow_throttled_writes_total')
+        throttled_before = throttled_writes.get()
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('send_numbers', [5], 1))
+        for i in range(5):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': i, 'marker': 1, 'eod': 0})
+
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 5, 'marker': 1, 'eod': 1})
+        self.assertEqual(throttled_writes.get() - throttled_before, 5)
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_coalescing_responses(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('count_coalesced', [2], 1))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), [
+            {'result': 0, 'marker': 1, 'eod': 0},
+            {'result': 1, 'marker': 1, 'eod': 0},
+            {'result': 2, 'marker': 1, 'eod': 1},
+        ])
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_limiting_size_of_coalesced_responses(self):
+        options.coalesce_max_bytes = 80
+        self.addCleanup(setattr, options, 'coalesce_max_bytes', 64 * 1024)
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('count_coalesced', [3], 1))
+        responses = []
+        while len(responses) < 4:
+            response = yield ws_conn.read_message()
+            # Each envelope is about 35 bytes, so no more than 3 of them fit.
+            # A single envelope is sent as is.
+            frame = json_decode(response)
+            if isinstance(frame, dict):
+                frame = [frame]
+            self.assertLessEqual(len(frame), 3)
+            responses.extend(frame)
+
+        self.assertEqual([response['result'] for response in responses], [0, 1, 2, 3])
+        self.assertEqual([response['eod'] for response in responses], [0, 0, 0, 1])
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_calling_non_existent_function(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        payload = prepare_payload('non_existent_function', [], 1)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'the non_existent_function function is undefined',
+            'marker': 1
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_mismatching_parameters(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        # less than is required
+        payload = prepare_payload('add', [1], 1)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'number of arguments mismatch in the add function call',
+            'marker': 1
+        })
+        # more than is required
+        payload = prepare_payload('add', [1, 3, 5], 2)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'number of arguments mismatch in the add function call',
+            'marker': 2
+        })
+
+        payload = prepare_payload('add', [1, 3], 3)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'result': 4,
+            'marker': 3,
+            'eod': 1,
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_collecting_call_metrics(self):
+        calls = REGISTRY.get('shirow_calls_total')
+        errors = REGISTRY.get('shirow_call_errors_total')
+        duration = REGISTRY.get('shirow_call_duration_seconds')
+        frames_received = REGISTRY.get('shirow_received_frames_total')
+        before = (calls.get(('add', )), duration.get(('add', )), frames_received.get(),
+                  errors.get(('', 'undefined')), errors.get(('add', 'arity')),
+                  errors.get(('div_by_zero', 'exception')))
+
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        self.assertEqual(REGISTRY.get('shirow_open_connections').get(), 1)
+        for marker, (procedure_name, parameters_list) in enumerate(
+                [('add', [1, 2]), ('add', [1]), ('non_existent_function', []),
+                 ('div_by_zero', [])]):
+            ws_conn.write_message(prepare_payload(procedure_name, parameters_list, marker))
+            yield ws_conn.read_message()
+
+        # The calls with mismatching arguments are counted, but not timed.
+        self.assertEqual((calls.get(('add', )), duration.get(('add', )), frames_received.get(),
+                          errors.get(('', 'undefined')), errors.get(('add', 'arity')),
+                          errors.get(('div_by_zero', 'exception'))),
+                         (before[0] + 2, before[1] + 1, before[2] + 4, before[3] + 1,
+                          before[4] + 1, before[5] + 1))
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_shedding_calls_when_overloaded(self):
+        MockRPCServer.cancelled_calls.clear()
+        self.addCleanup(setattr, options, 'max_loop_lag', 0.0)
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('wait_forever', [], 1))
+
+        # The calls in flight are left alone, while the new ones fail fast.
+        options.max_loop_lag = 0.05
+        ws_conn.write_message(prepare_payload('block', [0.2], 2))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 0.2, 'marker': 2, 'eod': 1})
+        yield gen.sleep(0.01)  # let the lag be sampled
+        ws_conn.write_message(prepare_payload('add', [1, 2], 3))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'the server is overloaded',
+            'code': 'overloaded',
+            'marker': 3,
+        })
+
+        ws_conn.write_message(json_encode({'cancel': 1}))
+        options.max_loop_lag = 0.0
+        ws_conn.write_message(prepare_payload('add', [1, 2], 4))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 3, 'marker': 4, 'eod': 1})
+        self.assertEqual(MockRPCServer.cancelled_calls, [('callback', 1), ('task', 1)])
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_rate_limiting_calls(self):
+        self.addCleanup(setattr, RATE_LIMITER, 'backend', None)
+        self.addCleanup(setattr, options, 'rate_limit_calls', 0.0)
+        RATE_LIMITER.backend = MemoryBackend()
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        rate_limited_error = {'error': 'the rate limit is exceeded', 'code': 'rate_limited'}
+        for marker in range(3):
+            ws_conn.write_message(prepare_payload('limited_echo', ['spam'], marker))
+            response = yield ws_conn.read_message()
+            if marker < 2:  # within the burst of the procedure
+                self.assertEqual(json_decode(response), {'result': 'spam', 'marker': marker,
+                                                         'eod': 1})
+            else:
+                self.assertEqual(json_decode(response), dict(rate_limited_error, marker=2))
+
+        # The limit on all the calls of the user.
+        options.rate_limit_calls = 1.0
+        ws_conn.write_message(prepare_payload('add', [1, 2], 3))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 4))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 3, 'marker': 3, 'eod': 1})
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), dict(rate_limited_error, marker=4))
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_rate_limiting_calls_before_queueing(self):
+        self.addCleanup(setattr, RATE_LIMITER, 'backend', None)
+        self.addCleanup(setattr, options, 'max_calls_per_connection', 16)
+        RATE_LIMITER.backend = MemoryBackend()
+        options.max_calls_per_connection = 1
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        # The calls exceeding the limit are rejected while the others wait for
+        # the slot taken by the first call.
+        ws_conn.write_message(prepare_payload('sleep', [0.05], 1))
+        for marker in range(2, 5):
+            ws_conn.write_message(prepare_payload('limited_echo', ['spam'], marker))
+
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'error': 'the rate limit is exceeded',
+                                                 'code': 'rate_limited', 'marker': 4})
+        for marker, result in ((1, 0.05), (2, 'spam'), (3, 'spam')):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': result, 'marker': marker, 'eod': 1})
+
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_rate_limiting_calls_in_order(self):
+        self.addCleanup(setattr, RATE_LIMITER, 'backend', None)
+        self.addCleanup(setattr, options, 'max_calls_per_connection', 16)
+        RATE_LIMITER.backend = MemoryBackend()
+        options.max_calls_per_connection = 1
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        # The local buckets are checked right away, so the rate-limited calls
+        # don't fall behind the others.
+        ws_conn.write_message(prepare_payload('sleep', [0.05], 1))
+        ws_conn.write_message(prepare_payload('limited_echo', ['spam'], 2))
+        ws_conn.write_message(prepare_payload('add', [1, 2], 3))
+        for marker, result in ((1, 0.05), (2, 'spam'), (3, 3)):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': result, 'marker': marker, 'eod': 1})
+
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_rate_limiting_calls_with_shared_backend(self):
+        class SharedBackend(RateLimitBackend):  # pylint: disable=too-few-public-methods
+            """A backend answering once the check is allowed to finish. """
+
+            def __init__(self):
+                self.checked = Future()
+                self.memory_backend = MemoryBackend()
+
+            async def consume(self, buckets):
+                await self.checked
+                return self.memory_backend.consume_now(buckets)
+
+        backend = SharedBackend()
+        self.addCleanup(setattr, RATE_LIMITER, 'backend', None)
+        RATE_LIMITER.backend = backend
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        for marker in range(3):
+            ws_conn.write_message(prepare_payload('limited_echo', ['spam'], marker))
+
+        # The checks are in progress until the shared backend responds.
+        connection = list(RPCServer.connections)[0]
+        while len(connection._calls) < 3:  # pylint: disable=protected-access
+            yield gen.sleep(0.01)
+        self.assertEqual(len(connection._rate_limit_tasks), 3)  # pylint: disable=protected-access
+
+        backend.checked.set_result(None)
+        responses = []
+        for _ in range(3):
+            responses.append(json_decode((yield ws_conn.read_message())))
+        self.assertEqual(sorted(response.get('code', '') for response in responses),
+                         ['', '', 'rate_limited'])
+        self.assertEqual(connection._rate_limit_tasks, set())  # pylint: disable=protected-access
+
+        # The checks in progress are cancelled when the connection is closed.
+        backend.checked = Future()
+        ws_conn.write_message(prepare_payload('limited_echo', ['spam'], 3))
+        while not connection._rate_limit_tasks:  # pylint: disable=protected-access
+            yield gen.sleep(0.01)
+        tasks = set(connection._rate_limit_tasks)  # pylint: disable=protected-access
+        yield self.close(ws_conn)
+        yield gen.sleep(0.01)
+        self.assertTrue(all(task.cancelled() for task in tasks))
+        self.assertEqual(connection._rate_limit_tasks, set())  # pylint: disable=protected-access
+
+    @gen_test
+    def test_reporting_slow_calls(self):
+        slow_calls = REGISTRY.get('shirow_slow_calls_total')
+        slow_calls_before = slow_calls.get(('block', ))
+        watchdog = ioloop.LagWatchdog(self.io_loop, 0.05)
+        watchdog.start()
+        try:
+            ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+            with self.assertLogs('tornado.general', logging.WARNING) as logs:
+                ws_conn.write_message(prepare_payload('block', [0.2], 1))
+                yield ws_conn.read_message()
+                yield gen.sleep(0)  # the counter is updated from the event loop
+        finally:
+            watchdog.stop()
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('by the block call (marker 1)', logs.output[0])
+        self.assertIn('time.sleep(seconds)', logs.output[0])
+        self.assertEqual(slow_calls.get(('block', )), slow_calls_before + 1)
+        self.assertGreater(REGISTRY.get('shirow_loop_lag_seconds').get_sum(), 0.1)
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_handling_errors_in_remote_procedures(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        payload = prepare_payload('div_by_zero', [], 1)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'an error occurred while executing the function div_by_zero',
+            'marker': 1
+        })
+
+        # So are the errors encoding the returned values.
+        ws_conn.write_message(prepare_payload('return_unencodable_value', [], 2))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'an error occurred while executing the function return_unencodable_value',
+            'marker': 2
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_default_parameters(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        payload = prepare_payload('say_hello', [], 1)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'result': 'Hello Shirow!',
+            'marker': 1,
+            'eod': 1,
+        })
+        payload = prepare_payload('say_hello', ['Norris'], 2)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'result': 'Hello Norris!',
+            'marker': 2,
+            'eod': 1,
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_returning_more_than_one_value(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        payload = prepare_payload('return_more_than_one_value', [], 1)
+        ws_conn.write_message(payload)
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'result': 'spam',
+            'marker': 1,
+            'eod': 0,
+        })
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'result': 'ham',
+            'marker': 1,
+            'eod': 0,
+        })
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'result': 'eggs',
+            'marker': 1,
+            'eod': 0,
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_streaming_from_async_generators(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('count_up', [3], 1))
+        responses = []
+        for _ in range(4):
+            response = yield ws_conn.read_message()
+            responses.append(json_decode(response))
+
+        self.assertEqual(responses, [
+            {'result': 0, 'marker': 1, 'eod': 0},
+            {'result': 1, 'marker': 1, 'eod': 0},
+            {'result': 2, 'marker': 1, 'eod': 0},
+            {'marker': 1, 'eod': 1},  # the end of the generator carries no result
+        ])
+
+        # The strings are split into chunks, while the other values are not.
+        ws_conn.write_message(prepare_payload('yield_text', ['abcdefg'], 2))
+        for result in ('abc', 'def', 'g', ['abcdefg']):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': result, 'marker': 2, 'eod': 0})
+
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'marker': 2, 'eod': 1})
+
+        # The chunks are limited in bytes, while the characters are never
+        # broken.
+        ws_conn.write_message(prepare_payload('yield_text', ['Пр€'], 4))
+        for result in ('П', 'р', '€', ['Пр€']):
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {'result': result, 'marker': 4, 'eod': 0})
+
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'marker': 4, 'eod': 1})
+
+        ws_conn.write_message(prepare_payload('count_up', [], 3))
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {
+            'error': 'number of arguments mismatch in the count_up function call',
+            'marker': 3,
+        })
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_returning_without_raising(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        with mock.patch('shirow.request.Ret.__init__', side_effect=AssertionError):
+            ws_conn.write_message(prepare_payload('add', [1, 2], 1))
+            response = yield ws_conn.read_message()
+
+        self.assertEqual(json_decode(response), {'result': 3, 'marker': 1, 'eod': 1})
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_streaming_subprocess(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+        script = 'import sys; print("foo"); print("bar"); sys.exit(3)'
+        ws_conn.write_message(prepare_payload('run_script', [script], 1))
+        output = ''
+        while True:
+            response = json_decode((yield ws_conn.read_message()))
+            if response['eod']:
+                break
+
+            output += response['result']
+
+        self.assertEqual(output, 'foo\nbar\n')
+        self.assertEqual(response, {'result': 3, 'marker': 1, 'eod': 1})
+        yield self.close(ws_conn)
+
+    @gen_test
+    def test_reading_from_fd(self):
+        ws_conn = yield self.ws_connect(f'/rpc/token/{ENCODED_TOKEN}')
+
+        pid, master_fd = pty.fork()
+        if pid == 0:  # child
+            script = (
+                'from time import sleep\n'
+                'for i in ["foo", "bar", "baz", "qux"]: print(i); sleep(0.5)'
+            )
+            command_line = ['python3', '-c', script]
+            os.execvp(command_line[0], command_line)
+        else:  # parent
+            payload = prepare_payload('read_from_fd', [master_fd], 1)
+            ws_conn.write_message(payload)
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {
+                'result': 'foo\r\n',
+                'marker': 1,
+                'eod': 0,
+            })
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {
+                'result': 'bar\r\n',
+                'marker': 1,
+                'eod': 0,
+            })
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {
+                'result': 'baz\r\n',
+                'eod': 0,
+                'marker': 1
+            })
+            response = yield ws_conn.read_message()
+            self.assertEqual(json_decode(response), {
+                'result': 'qux\r\n',
+                'marker': 1,
+                'eod': 1,
+            })
+
+            yield self.close(ws_conn)
+
+
+class MultiProcessServingTest(AsyncTestCase):
+    """Tests serving an application by several worker processes. """
+
+    def setUp(self):
+        super().setUp()
+
+        sock, self.port = bind_unused_port()
+        sock.close()
+
+    def start_service(self, mode, max_restarts=100):
+        self.process = subprocess.Popen(  # pylint: disable=consider-using-with,attribute-defined-outside-init
+            [sys.executable, '-c', MULTI_PROCESS_SERVICE, str(self.port), mode, TOKEN_KEY,
+             str(max_restarts)],
+            env=dict(os.environ, PYTHONPATH=ROOT_DIR),
+        )
+        self.addCleanup(self.process.wait)
+        self.addCleanup(self.process.kill)
+
+    @gen.coroutine
+    def get_pid(self):
+        url = f'ws://127.0.0.1:{self.port}/rpc/token/{ENCODED_TOKEN}'
+        for _ in range(100):  # wait for the workers to start
+            try:
+                ws_conn = yield websocket_connect(url)
+                break
+            except (ConnectionRefusedError, OSError):
+                yield gen.sleep(0.1)
+
+        ws_conn.write_message(prepare_payload('get_pid', [], 1))
+        response = yield ws_conn.read_message()
+        ws_conn.close()
+        return json_decode(response)['result']
+
+    @gen.coroutine
+    def wait_for(self, predicate):
+        for _ in range(100):
+            if predicate():
+                return True
+            yield gen.sleep(0.1)
+
+        return False
+
+    @gen.coroutine
+    def check_serving(self, mode):
+        self.start_service(mode)
+        pid = yield self.get_pid()
+        self.assertIn(pid, get_children(self.process.pid))
+
+        # The crashed worker is restarted.
+        os.kill(pid, signal.SIGKILL)
+        restarted = yield self.wait_for(lambda: (len(get_children(self.process.pid)) == 2 and
+                                                 pid not in get_children(self.process.pid)))
+        self.assertTrue(restarted)
+        pid = yield self.get_pid()
+        self.assertIn(pid, get_children(self.process.pid))
+
+        # All the processes exit gracefully on SIGTERM.
+        self.process.send_signal(signal.SIGTERM)
+        exited = yield self.wait_for(lambda: self.process.poll() is not None)
+        self.assertTrue(exited)
+        self.assertEqual(self.process.returncode, 0)
+
+    @gen_test(timeout=30)
+    def test_sharing_socket(self):
+        yield self.check_serving('share_socket')
+
+    @gen_test(timeout=30)
+    def test_reusing_port(self):
+        yield self.check_serving('reuse_port')
+
+    @gen_test(timeout=30)
+    def test_draining_calls(self):
+        self.start_service('share_socket')
+        yield self.get_pid()  # wait for the workers to start
+        ws_conn = yield websocket_connect(f'ws://127.0.0.1:{self.port}/rpc/token/{ENCODED_TOKEN}')
+        ws_conn.write_message(prepare_payload('sleep', [0.5], 1))
+        yield gen.sleep(0.1)
+        self.process.send_signal(signal.SIGTERM)
+
+        # The call in flight finishes before the connection is closed.
+        response = yield ws_conn.read_message()
+        self.assertEqual(json_decode(response), {'result': 0.5, 'marker': 1, 'eod': 1})
+        self.assertIsNone((yield ws_conn.read_message()))
+        self.assertEqual(ws_conn.close_code, 1001)
+        exited = yield self.wait_for(lambda: self.process.poll() is not None)
+        self.assertTrue(exited)
+        self.assertEqual(self.process.returncode, 0)
+
+    @gen_test(timeout=30)
+    def test_giving_up_restarting(self):
+        self.start_service('share_socket', max_restarts=0)
+        pid = yield self.get_pid()
+        os.kill(pid, signal.SIGKILL)
+        exited = yield self.wait_for(lambda: self.process.poll() is not None)
+        self.assertTrue(exited)
+        self.assertEqual(self.process.returncode, 1)
+
+
+class SchedulerTest(AsyncTestCase):
+    """Tests the scheduler running the calls of the connections. """
+
+    def setUp(self):
+        super().setUp()
+
+        self.order = []
+        self.scheduler = Scheduler()
+
+    def make_call(self, name):
+        async def run():
+            await gen.sleep(0)
+            self.order.append(name)
+
+        return run
+
+    @gen_test
+    def test_serving_connections_in_turn(self):
+        options.max_calls = 1
+        self.addCleanup(setattr, options, 'max_calls', 0)
+
+        for name in ('a1', 'a2', 'a3'):
+            self.assertTrue(self.scheduler.submit('a', 1, 0, self.make_call(name)))
+        self.assertTrue(self.scheduler.submit('b', 2, 0, self.make_call('b1')))
+        self.assertEqual(self.scheduler.get_queue_depth('a'), 2)
+
+        while len(self.order) < 4:
+            yield gen.sleep(0.01)
+
+        self.assertEqual(self.order, ['a1', 'a2', 'b1', 'a3'])
+
+    @gen_test
+    def test_limiting_calls_per_user(self):
+        options.max_calls_per_user = 1
+        self.addCleanup(setattr, options, 'max_calls_per_user', 0)
+
+        self.scheduler.submit('a', 1, 0, self.make_call('a1'))
+        self.scheduler.submit('b', 1, 0, self.make_call('b1'))
+        self.scheduler.submit('c', 2, 0, self.make_call('c1'))
+        self.assertEqual(self.scheduler.get_queue_depth('b'), 1)
+
+        # The queued calls of a closed connection are dropped.
+        self.scheduler.discard('b')
+        while len(self.order) < 2:
+            yield gen.sleep(0.01)
+
+        yield gen.sleep(0.01)
+        self.assertEqual(sorted(self.order), ['a1', 'c1'])
+
+
+class EventLoopPolicyTest(unittest.TestCase):
+    """Tests installing the event loop policies. """
+
+    def test_installing_asyncio(self):
+        policy = asyncio.get_event_loop_policy()
+        self.assertEqual(ioloop.install_event_loop_policy('asyncio'), 'asyncio')
+        self.assertIs(asyncio.get_event_loop_policy(), policy)
+
+    def test_falling_back_to_asyncio(self):
+        policy = asyncio.get_event_loop_policy()
+        with mock.patch.object(ioloop, 'uvloop', None), \
+                self.assertLogs('tornado.general', 'WARNING'):
+            self.assertEqual(ioloop.install_event_loop_policy('uvloop'), 'asyncio')
+
+        self.assertIs(asyncio.get_event_loop_policy(), policy)
+
+    def test_unknown_event_loop(self):
+        with self.assertRaises(ValueError):
+            ioloop.install_event_loop_policy('trio')
+
+
+class CodecTest(unittest.TestCase):
+    """Tests the codecs used to encode and decode messages. """
+
+    def tearDown(self):
+        codec.get_codec.cache_clear()
+
+    def test_round_trip(self):
+        message = {'marker': 1, 'eod': 1, 'result': ['</script>', 'Привет', 1.5, None]}
+        for name in codec.CODECS:
+            json_codec = codec.get_codec(name)
+            encoded = json_codec.encode(message)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(json_codec.decode(encoded), message)
+            self.assertEqual(json_codec.decode(encoded.decode('utf8')), message)
+
+    def test_falling_back_to_stdlib(self):
+        codec.get_codec.cache_clear()
+        with mock.patch('shirow.codec.orjson', None):
+            self.assertIsInstance(codec.get_codec('orjson'), codec.StdlibCodec)
+
+    def test_joining_encoded_objects(self):
+        objs = [{'marker': i} for i in range(20)]
+        codecs = [codec.get_codec(name) for name in codec.CODECS]
+        if msgpack is not None:
+            codecs.append(codec.MsgPackCodec())
+
+        for some_codec in codecs:
+            for number in (0, 1, 15, 16, 20):
+                joined = some_codec.join([some_codec.encode(obj) for obj in objs[:number]])
+                self.assertEqual(some_codec.decode(joined), objs[:number])
+
+    def test_embedding_encoded_values(self):
+        codecs = [codec.get_codec(name) for name in codec.CODECS]
+        if msgpack is not None:
+            codecs.append(codec.MsgPackCodec())
+
+        for some_codec in codecs:
+            for obj in ({}, {'marker': 1}, {str(i): i for i in range(20)}):
+                encoded = some_codec.embed(obj, 'result', some_codec.encode(['spam', 1]))
+                self.assertEqual(some_codec.decode(encoded), dict(obj, result=['spam', 1]))
+
+    def test_encoding_raw_json(self):
+        raw_json = codec.RawJSON('{"spam": "Привет"}')
+        for name in codec.CODECS:
+            self.assertEqual(codec.get_codec(name).encode_result(raw_json),
+                             '{"spam": "Привет"}'.encode('utf-8'))
+
+        if msgpack is not None:
+            self.assertEqual(codec.MsgPackCodec().encode_result(raw_json),
+                             msgpack.packb({'spam': 'Привет'}))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            codec.get_codec('pickle')
+
+
+class MetricsTest(unittest.TestCase):
+    """Tests the metrics and their exposition. """
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_observing_histograms(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', ['procedure'],
+                                            buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, labels=('add', ))
+
+        self.assertEqual(histogram.get(('add', )), 4)
+        self.assertEqual(histogram.get_sum(('add', )), 2.65)
+        self.assertEqual(histogram.get_buckets(('add', )),
+                         [(0.1, 2), (1, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.get_buckets(('sub', )),
+                         [(0.1, 0), (1, 0), (float('inf'), 0)])
+
+        with self.assertRaises(ValueError):
+            self.registry.counter('latency_seconds', 'Latency')
+
+    def test_formatting_text(self):
+        self.registry.counter('calls_total', 'Number of calls')
+        self.registry.gauge('queued', 'Queued "calls"', ['procedure']).inc(
+            labels=('a"b\\c\n', ))
+        self.registry.histogram('latency_seconds', 'Latency', buckets=(0.5, )).observe(0.25)
+        self.assertEqual(format_text(self.registry), textwrap.dedent('''\
+            # HELP calls_total Number of calls
+            # TYPE calls_total counter
+            calls_total 0
+            # HELP queued Queued "calls"
+            # TYPE queued gauge
+            queued{procedure="a\\"b\\\\c\\n"} 1
+            # HELP latency_seconds Latency
+            # TYPE latency_seconds histogram
+            latency_seconds_bucket{le="0.5"} 1
+            latency_seconds_bucket{le="+Inf"} 1
+            latency_seconds_sum 0.25
+            latency_seconds_count 1
+        '''))
+
+
+class MockConnection:
+    """A connection the write buffer of which is full until it's drained. """
+
+    def __init__(self):
+        self.close_args = None
+        self.drained = Future()
+        self._pending_write_bytes = options.write_high_water_mark + 1
+
+    async def _drain(self):
+        await self.drained
+
+    def close(self, code=None, reason=None):
+        self.close_args = (code, reason)
+
+    def drain(self):
+        self._pending_write_bytes = 0
+        self.drained.set_result(None)
+
+
+class PubSubTest(AsyncTestCase):
+    """Tests the hub of the topics and the slow-subscriber policies. """
+
+    def setUp(self):
+        super().setUp()
+        self.codec = codec.get_codec('stdlib')
+        self.hub = Hub()
+
+    def subscribe(self, connection, policy, max_pending=2):
+        responses = []
+        request = Request(1, responses.append, self.codec)
+        self.hub.subscribe('news', connection, request, policy, max_pending)
+        return request, responses
+
+    def test_encoding_once(self):
+        connection = MockConnection()
+        connection.drain()
+        _, responses = self.subscribe(connection, 'drop_oldest')
+        _, other_responses = self.subscribe(connection, 'drop_oldest')
+        with mock.patch.object(self.codec, 'encode_result',
+                               wraps=self.codec.encode_result) as encode_result:
+            self.assertEqual(self.hub.publish('news', 'spam'), 2)
+
+        encode_result.assert_called_once_with('spam')
+        self.assertEqual(responses, other_responses)
+        self.assertEqual(json_decode(responses[0]), {'result': 'spam', 'marker': 1, 'eod': 0})
+
+    def test_publishing_bytes(self):
+        connection = MockConnection()
+        connection.drain()
+        _, responses = self.subscribe(connection, 'drop_oldest')
+        self.hub.publish('news', b'spam')
+        self.assertIsInstance(responses[0], codec.BinaryFrame)
+        header_length = int.from_bytes(responses[0][:4], 'big')
+        self.assertEqual(json_decode(responses[0][4:4 + header_length]), {'marker': 1, 'eod': 0})
+        self.assertEqual(responses[0][4 + header_length:], b'spam')
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_publishing_unencodable_values(self):
+        connection = MockConnection()
+        connection.drain()
+        _, responses = self.subscribe(connection, 'drop_oldest')
+        other_responses = []
+        self.hub.subscribe('news', connection,
+                           Request(2, other_responses.append, codec.MsgPackCodec()))
+        # The integer is too big for msgpack, so none of the subscribers get
+        # it, even those which use JSON.
+        with self.assertRaises(OverflowError):
+            self.hub.publish('news', 2 ** 70)
+
+        self.assertEqual(responses, [])
+        self.assertEqual(other_responses, [])
+
+    @gen_test
+    def test_dropping_oldest_values(self):
+        connection = MockConnection()
+        _, responses = self.subscribe(connection, 'drop_oldest')
+        for value in range(4):
+            self.hub.publish('news', value)
+
+        self.assertEqual(responses, [])
+        connection.drain()
+        yield gen.sleep(0)
+        self.assertEqual([json_decode(response)['result'] for response in responses], [2, 3])
+
+    @gen_test
+    def test_coalescing_latest_values(self):
+        connection = MockConnection()
+        _, responses = self.subscribe(connection, 'coalesce_latest')
+        for value in range(4):
+            self.hub.publish('news', value)
+
+        connection.drain()
+        yield gen.sleep(0)
+        self.assertEqual([json_decode(response)['result'] for response in responses], [3])
+
+    def test_disconnecting_slow_subscribers(self):
+        connection = MockConnection()
+        request, _ = self.subscribe(connection, 'disconnect', max_pending=1)
+        self.hub.publish('news', 'spam')
+        self.assertIsNone(connection.close_args)
+        self.hub.publish('news', 'ham')
+        self.assertEqual(connection.close_args, (TRY_AGAIN_LATER, 'the subscriber is too slow'))
+        self.assertTrue(request.cancelled)
+        self.assertEqual(self.hub.get_subscribers_number('news'), 0)
+
+    def test_unsubscribing_when_call_is_over(self):
+        request, _ = self.subscribe(MockConnection(), 'drop_oldest')
+        request.end()
+        self.assertEqual(self.hub.get_subscribers_number('news'), 0)
+        with self.assertRaises(ValueError):
+            self.subscribe(MockConnection(), 'spam')
+
+
+class AdmissionTest(AsyncTestCase):
+    """Tests the admission control. """
+
+    @gen_test
+    def test_sampling_only_with_limits(self):
+        self.addCleanup(setattr, options, 'admission_interval', 0.1)
+        self.addCleanup(setattr, options, 'max_rss', 0)
+        options.admission_interval = 0.01
+        controller = AdmissionController()
+        with mock.patch('shirow.admission.get_rss', return_value=0) as get_rss:
+            controller.start(self.io_loop)
+            yield gen.sleep(0.05)
+            self.assertEqual(get_rss.call_count, 0)
+
+            options.max_rss = 1024
+            controller.start(self.io_loop)
+            yield gen.sleep(0.05)
+            self.assertGreater(get_rss.call_count, 1)
+
+            # Sampling stops once the limits are unset.
+            options.max_rss = 0
+            yield gen.sleep(0.02)
+            call_count = get_rss.call_count
+            yield gen.sleep(0.05)
+            self.assertEqual(get_rss.call_count, call_count)
+
+        controller.stop()
+
+    @gen_test
+    def test_sharing_heartbeat_with_watchdog(self):
+        self.addCleanup(setattr, options, 'max_loop_lag', 0.0)
+        options.max_loop_lag = 0.05
+        controller = AdmissionController()
+        controller.start(self.io_loop)
+        watchdog = ioloop.LagWatchdog(self.io_loop, 1.0, interval=0.01)
+        watchdog.start()
+        # The shortest interval is used by the single timer of the heartbeat.
+        self.assertEqual(HEARTBEAT._interval, 0.01)  # pylint: disable=protected-access
+        time.sleep(0.1)
+        yield gen.sleep(0)  # let the late beat run
+        self.assertGreater(HEARTBEAT.lag, 0.05)
+        self.assertEqual(controller.get_overloaded_resource(), 'loop_lag')
+
+        watchdog.stop()
+        self.assertEqual(HEARTBEAT._interval, 0.1)  # pylint: disable=protected-access
+        controller.stop()
+        self.assertIsNone(HEARTBEAT.expected_at)
+
+
+class RateLimitTest(AsyncTestCase):
+    """Tests the token buckets limiting the rate of connections and calls. """
+
+    @gen_test
+    def test_consuming_tokens(self):
+        now = [0.0]
+        backend = MemoryBackend(clock=lambda: now[0])
+        for _ in range(3):
+            allowed = yield backend.consume([('spam', 2, 3)])
+            self.assertTrue(allowed)
+
+        allowed = yield backend.consume([('spam', 2, 3)])
+        self.assertFalse(allowed)
+        allowed = yield backend.consume([('ham', 2, 3)])
+        self.assertTrue(allowed)  # the buckets are per key
+
+        now[0] = 0.5  # a token is added in 1/rate seconds
+        allowed = yield backend.consume([('spam', 2, 3)])
+        self.assertTrue(allowed)
+        allowed = yield backend.consume([('spam', 2, 3)])
+        self.assertFalse(allowed)
+
+        # The bucket holds up to burst tokens.
+        now[0] = 10
+        for _ in range(3):
+            allowed = yield backend.consume([('spam', 2, 3)])
+            self.assertTrue(allowed)
+
+        allowed = yield backend.consume([('spam', 2, 3)])
+        self.assertFalse(allowed)
+
+        # No token is taken unless every bucket has one.
+        allowed = yield backend.consume([('eggs', 2, 1), ('spam', 2, 3)])
+        self.assertFalse(allowed)
+        allowed = yield backend.consume([('eggs', 2, 1)])
+        self.assertTrue(allowed)
+
+
+class BrokerTest(AsyncTestCase):
+    """Tests delivering the published messages across the processes. """
+
+    def setUp(self):
+        super().setUp()
+        self.brokers = []
+
+    def tearDown(self):
+        for instance in self.brokers:
+            self.io_loop.run_sync(instance.stop)
+
+        super().tearDown()
+
+    async def start_broker(self, path, max_buffer_bytes=None):
+        instance = broker.Broker(broker.UnixSocketBackend(path,
+                                                          max_buffer_bytes=max_buffer_bytes))
+        await instance.start()
+        self.brokers.append(instance)
+        received = []
+        instance.subscribe('news', received.append)
+        return instance, received
+
+    def test_delivering_within_process(self):
+        instance = broker.Broker(broker.MemoryBackend())
+        self.io_loop.run_sync(instance.start)
+        received = []
+        instance.subscribe('news', received.append)
+        instance.publish('news', 'spam')
+        instance.publish('weather', 'ham')
+        self.assertEqual(received, ['spam'])
+        instance.unsubscribe('news', received.append)
+        instance.publish('news', 'eggs')
+        self.assertEqual(received, ['spam'])
+
+    @gen_test
+    def test_delivering_over_unix_socket(self):
+        tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'broker.sock')
+        leader, leader_received = yield self.start_broker(path)
+        follower, follower_received = yield self.start_broker(path)
+        other_follower, other_received = yield self.start_broker(path)
+        self.assertTrue(leader.backend.is_leader)
+        self.assertFalse(follower.backend.is_leader)
+
+        # The messages published during an iteration are sent in a batch.
+        batches_sent = broker.BATCHES_SENT.get()
+        for value in range(3):
+            follower.publish('news', value)
+
+        self.assertEqual(follower_received, [0, 1, 2])  # delivered right away
+        while len(other_received) < 3:
+            yield gen.sleep(0.01)
+
+        self.assertEqual(leader_received, [0, 1, 2])
+        self.assertEqual(other_received, [0, 1, 2])
+        self.assertEqual(broker.BATCHES_SENT.get() - batches_sent, 1)
+
+        # The followers elect a new leader when the leader exits.
+        yield leader.stop()
+        while not (follower.backend.is_leader or other_follower.backend.is_leader):
+            yield gen.sleep(0.01)
+
+        while follower_received[-1] != 'spam':
+            other_follower.publish('news', 'spam')
+            yield gen.sleep(0.01)
+
+        self.assertEqual(leader_received, [0, 1, 2])
+
+    @gen_test
+    def test_disconnecting_stalled_peers(self):
+        tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'broker.sock')
+        leader, _ = yield self.start_broker(path, max_buffer_bytes=64 * 1024)
+        _, follower_received = yield self.start_broker(path)
+        # The peer never reads, so the frames are buffered by the leader.
+        reader, writer = yield asyncio.open_unix_connection(path)
+        disconnected_peers = broker.DISCONNECTED_PEERS.get()
+        while broker.DISCONNECTED_PEERS.get() == disconnected_peers:
+            leader.publish('news', 'x' * 64 * 1024)
+            yield gen.sleep(0.001)
+
+        with self.assertRaises((asyncio.IncompleteReadError, ConnectionError)):
+            while True:
+                yield reader.readexactly(64 * 1024)
+
+        writer.close()
+        # The other peers are left alone.
+        leader.publish('news', 'spam')
+        while follower_received[-1] != 'spam':
+            yield gen.sleep(0.01)
+
+    def test_invalidating_and_publishing(self):
+        with mock.patch('shirow.results.invalidate') as invalidate:
+            broker.invalidate('get_news', prefix=('en', ), user_id=USER_ID)
+
+        invalidate.assert_called_once_with('get_news', ['en'], USER_ID)
+        with mock.patch.object(HUB, 'publish') as publish:
+            broker.publish('news', {'spam': 1})
+
+        publish.assert_called_once_with('news', {'spam': 1})
+
+
+class StreamsTest(AsyncTestCase):
+    """Tests streaming the output of file descriptors and subprocesses. """
+
+    def setUp(self):
+        super().setUp()
+        self.read_fd, self.write_fd = os.pipe()
+        self.addCleanup(os.close, self.read_fd)
+        self.responses = []
+        self.request = Request(1, self.responses.append)
+
+    def get_results(self):
+        return [json_decode(response).get('result') for response in self.responses]
+
+    @gen_test
+    def test_coalescing_output(self):
+        task = asyncio.ensure_future(self.request.stream_fd(self.read_fd, window=10))
+        # The character is split between the reads.
+        for data in (b'spam\n', b'ham \xc3', b'\xa9ggs'):
+            os.write(self.write_fd, data)
+            yield gen.sleep(0.01)
+
+        self.assertEqual(self.responses, [])
+        os.close(self.write_fd)
+        yield task
+        self.assertEqual(self.get_results(), ['spam\nham \xe9ggs', None])
+        self.assertTrue(self.request.done)
+
+    @gen_test
+    def test_splitting_lines(self):
+        task = asyncio.ensure_future(self.request.stream_fd(self.read_fd, lines=True, window=0))
+        os.write(self.write_fd, b'foo\nba')
+        yield gen.sleep(0.01)
+        self.assertEqual(self.get_results(), ['foo\n'])
+        os.write(self.write_fd, b'r\nbaz')
+        yield gen.sleep(0.01)
+        self.assertEqual(self.get_results(), ['foo\n', 'bar\n'])
+        os.close(self.write_fd)
+        yield task
+        self.assertEqual(self.get_results(), ['foo\n', 'bar\n', 'baz', None])
+
+    @gen_test
+    def test_sending_enough_bytes_right_away(self):
+        task = asyncio.ensure_future(self.request.stream_fd(self.read_fd, encoding=None,
+                                                            window=10, max_bytes=4))
+        os.write(self.write_fd, b'spam')
+        yield gen.sleep(0.01)
+        self.assertEqual(len(self.responses), 1)
+        self.assertIsInstance(self.responses[0], codec.BinaryFrame)
+        self.assertTrue(self.responses[0].endswith(b'spam'))
+        os.close(self.write_fd)
+        yield task
+
+    @gen_test
+    def test_counting_bytes_of_text(self):
+        task = asyncio.ensure_future(self.request.stream_fd(self.read_fd, window=10,
+                                                            max_bytes=4))
+        os.write(self.write_fd, 'Пр'.encode('utf-8'))
+        yield gen.sleep(0.01)
+        self.assertEqual(self.get_results(), ['Пр'])
+
+        # A line longer than the limit in bytes is not waited for.
+        task.cancel()
+        self.responses.clear()
+        task = asyncio.ensure_future(self.request.stream_fd(self.read_fd, lines=True, window=0,
+                                                            max_bytes=4))
+        os.write(self.write_fd, 'Пр'.encode('utf-8'))
+        yield gen.sleep(0.01)
+        self.assertEqual(self.get_results(), ['Пр'])
+        os.close(self.write_fd)
+        yield task
+
+    @gen_test
+    def test_cleaning_up_when_cancelled(self):
+        task = asyncio.ensure_future(self.request.stream_fd(self.read_fd))
+        yield gen.sleep(0.01)
+        task.cancel()
+        yield gen.sleep(0.01)
+        self.assertFalse(asyncio.get_running_loop().remove_reader(self.read_fd))
+        os.close(self.write_fd)
+
+        process = yield asyncio.create_subprocess_exec('sleep', '10', stdout=subprocess.PIPE)
+        task = asyncio.ensure_future(self.request.stream_subprocess(process))
+        yield gen.sleep(0.01)
+        task.cancel()
+        self.assertEqual((yield process.wait()), -signal.SIGTERM)
+
+
+class ExecutorsTest(unittest.TestCase):
+    """Tests the executors running the blocking remote procedures. """
+
+    def test_getting_pool_workers(self):
+        self.addCleanup(setattr, options, 'pool_workers', [])
+        options.pool_workers = ['images=4', 'reports=1']
+        self.assertEqual(get_pool_workers('images'), 4)
+        self.assertEqual(get_pool_workers('reports'), 1)
+        self.assertIsNone(get_pool_workers('default'))
+
+    def test_rejecting_wrong_procedures(self):
+        with self.assertRaises(ValueError):
+            remote(executor='fiber')(lambda: None)
+
+        async def coroutine_function():
+            pass
+
+        with self.assertRaises(ValueError):
+            remote(executor='thread')(coroutine_function)
+
+
+class ResultCacheTest(unittest.TestCase):
+    """Tests the cache of the results of remote procedures. """
+
+    def test_getting_results(self):
+        cache = results.ResultCache('test_getting_results', 10, 2)
+        key = cache.get_key('stdlib', USER_ID, [1, 2])
+        self.assertEqual(key, cache.get_key('stdlib', USER_ID + 1, [1, 2]))
+        self.assertNotEqual(key, cache.get_key('msgpack', USER_ID, [1, 2]))
+
+        cache.put_result(key, b'3')
+        self.assertEqual(cache.get_result(key), b'3')
+        self.assertEqual(cache.get_result(cache.get_key('stdlib', USER_ID, [2, 1])), None)
+        self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_expiring_results(self):
+        cache = results.ResultCache('test_expiring_results', 0, 2)
+        key = cache.get_key('stdlib', USER_ID, [])
+        cache.put_result(key, b'null')
+        self.assertEqual(cache.get_result(key), None)
+
+
+class LRUCacheTest(unittest.TestCase):
+    """Tests the cache used to store verified tokens and results of remote
+    procedures.
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(2, clock=lambda: self.now)
+
+    def test_evicting_least_recently_used_entries(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)  # b becomes the least recently used
+        self.cache.put('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_evicting_expired_entries(self):
+        self.cache.put('a', 1, expires_at=10)
+        self.cache.put('b', 2)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_removing_entries_by_predicate(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.assertEqual(self.cache.remove_if(lambda key, value: value > 1), 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+
+
+class TokenCacheTest(unittest.TestCase):
+    """Tests the cache of verified tokens. """
+
+    def setUp(self):
+        TOKEN_CACHE.clear()
+
+    def test_getting_claims(self):
+        claims = {'user_id': USER_ID}
+        TOKEN_CACHE.put_claims(ENCODED_TOKEN, TOKEN_KEY, TOKEN_ALGORITHM_ENCODING, claims)
+        self.assertEqual(TOKEN_CACHE.get_claims(ENCODED_TOKEN, TOKEN_KEY,
+                                                TOKEN_ALGORITHM_ENCODING), claims)
+        # The key the token was verified with is a part of the cache key.
+        self.assertIsNone(TOKEN_CACHE.get_claims(ENCODED_TOKEN, 'wrong_' + TOKEN_KEY,
+                                                 TOKEN_ALGORITHM_ENCODING))
+
+    def test_evicting_expired_tokens(self):
+        claims = {'user_id': USER_ID, 'exp': datetime.datetime(1983, 2, 25).timestamp()}
+        TOKEN_CACHE.put_claims(ENCODED_TOKEN, TOKEN_KEY, TOKEN_ALGORITHM_ENCODING, claims)
+        self.assertIsNone(TOKEN_CACHE.get_claims(ENCODED_TOKEN, TOKEN_KEY,
+                                                 TOKEN_ALGORITHM_ENCODING))
+
+    def test_invalidating_tokens_of_user(self):
+        TOKEN_CACHE.put_claims('token1', TOKEN_KEY, TOKEN_ALGORITHM_ENCODING, {'user_id': 1})
+        TOKEN_CACHE.put_claims('token2', TOKEN_KEY, TOKEN_ALGORITHM_ENCODING, {'user_id': 2})
+        self.assertEqual(TOKEN_CACHE.invalidate_user(1), 1)
+        self.assertIsNone(TOKEN_CACHE.get_claims('token1', TOKEN_KEY, TOKEN_ALGORITHM_ENCODING))
+        self.assertIsNotNone(TOKEN_CACHE.get_claims('token2', TOKEN_KEY,
+                                                    TOKEN_ALGORITHM_ENCODING))
+
+    def test_disabling_cache(self):
+        options.token_cache_size = 0
+        self.addCleanup(setattr, options, 'token_cache_size', 4096)
+        TOKEN_CACHE.put_claims(ENCODED_TOKEN, TOKEN_KEY, TOKEN_ALGORITHM_ENCODING, {})
+        self.assertEqual(len(TOKEN_CACHE), 0)
+
+
+class RemoteProceduresRegistryTest(unittest.TestCase):
+    """Tests the registry of remote procedures built for RPC servers. """
+
+    def test_registry_contains_remote_procedures_only(self):
+        registry = MockRPCServer.remote_procedures
+        self.assertIn('add', registry)
+        self.assertIn('say_hello', registry)
+        self.assertNotIn('get_compression_options', registry)
+        self.assertEqual(registry['say_hello'].arguments_range, (2, 3))
+        self.assertFalse(registry['say_hello'].options['coalesce'])
+        self.assertTrue(registry['count_coalesced'].options['coalesce'])
+
+    def test_registry_is_immutable(self):
+        with self.assertRaises(TypeError):
+            MockRPCServer.remote_procedures['add'] = None  # pylint: disable=unsupported-assignment-operation
+
+    def test_overriding_remote_procedure_in_subclass(self):
+        class Subclass(MockRPCServer):  # pylint: disable=abstract-method,too-many-ancestors
+            """An RPC server which hides one of the inherited procedures. """
+
+            add = None
+
+        self.assertNotIn('add', Subclass.remote_procedures)
+        self.assertIn('add', MockRPCServer.remote_procedures)
 
 
 def main():
@@ -0,0 +1,87 @@
+# Copyright 2026 Evgeny Golyshev. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the cache of verified tokens. When clients reconnect,
+they present the same tokens again, so the cache lets RPC servers skip
+verifying the signatures of the tokens they have already seen.
+"""
+
+import hashlib
+import time
+
+from tornado.options import define, options
+
+from shirow.cache import LRUCache
+from shirow.metrics import REGISTRY
+
+define('token_cache_size',
+       help='the maximum number of verified tokens to cache (0 disables the '
+            'cache)', default=4096, type=int)
+
+HITS = REGISTRY.counter('shirow_token_cache_hits_total',
+                        'Number of tokens found in the cache of verified tokens')
+MISSES = REGISTRY.counter('shirow_token_cache_misses_total',
+                          'Number of tokens not found in the cache of verified tokens')
+
+
+class TokenCache(LRUCache):
+    """Cache of the claims of verified tokens. The entries are evicted when the
+    tokens expire or when the cache is full.
+    """
+
+    def __init__(self):
+        super().__init__(None, clock=time.time)  # exp is a Unix timestamp
+
+    @property
+    def max_entries(self):
+        return options.token_cache_size
+
+    @staticmethod
+    def _get_key(encoded_token, token_key, token_algorithm):
+        # The key and the algorithm are a part of the cache key, so changing
+        # any of them makes the tokens verified before be verified again.
+        digest = hashlib.sha256()
+        for part in (token_algorithm, token_key, encoded_token):
+            digest.update(repr(part).encode('utf8'))
+
+        return digest.digest()
+
+    def get_claims(self, encoded_token, token_key, token_algorithm):
+        """Returns the claims of the specified token if the token was verified
+        before and hasn't expired yet, else None.
+        """
+
+        claims = self.get(self._get_key(encoded_token, token_key, token_algorithm))
+        if claims is None:
+            MISSES.inc()
+        else:
+            HITS.inc()
+
+        return claims
+
+    def invalidate_user(self, user_id):
+        """Removes the tokens of the specified user from the cache (for
+        example, when the user is revoked) and returns their number.
+        """
+
+        return self.remove_if(lambda _key, claims: claims.get('user_id') == user_id)
+
+    def put_claims(self, encoded_token, token_key, token_algorithm, claims):
+        """Puts the claims of the verified token into the cache. """
+
+        self.put(self._get_key(encoded_token, token_key, token_algorithm), claims,
+                 claims.get('exp'))
+
+
+TOKEN_CACHE = TokenCache()
@@ -14,6 +14,8 @@
 
 """Miscellaneous utility functions. """
 
+import json
+
 
 def check_number_of_args(method, params):
     """Checks if the number of actual arguments passed to a remote procedure
@@ -26,3 +28,51 @@ def check_number_of_args(method, params):
         return True
 
     return False
+
+
+def canonicalize(value):
+    """Encodes the specified value into a string, so the values equal after
+    decoding produce the same string regardless of the order of the keys in
+    the objects.
+    """
+
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=repr)
+
+
+def split_into_chunks(value, chunk_size):
+    """Splits the specified string or bytes into the chunks of the specified
+    size in bytes. Strings are split on character boundaries, so each chunk
+    takes up to chunk_size bytes in UTF-8 (or a single character which is
+    larger). The other values as well as the values which are not larger than
+    a chunk are returned as the only chunk. A chunk size of 0 means no limit.
+    """
+
+    if chunk_size <= 0 or not isinstance(value, (str, bytes)) or len(value) <= chunk_size // 4:
+        return [value]
+
+    if isinstance(value, bytes):
+        if len(value) <= chunk_size:
+            return [value]
+
+        return [value[i:i + chunk_size] for i in range(0, len(value), chunk_size)]
+
+    encoded = value.encode('utf-8', 'surrogatepass')
+    if len(encoded) <= chunk_size:
+        return [value]
+
+    chunks = []
+    start = 0
+    while start < len(encoded):
+        end = min(start + chunk_size, len(encoded))
+        # Step back to the first byte of the character split by the chunk.
+        while end < len(encoded) and encoded[end] & 0xc0 == 0x80:
+            end -= 1
+        if end == start:  # the character is larger than a chunk
+            end += 1
+            while end < len(encoded) and encoded[end] & 0xc0 == 0x80:
+                end += 1
+
+        chunks.append(encoded[start:end].decode('utf-8', 'surrogatepass'))
+        start = end
+
+    return chunks